@@ -0,0 +1,85 @@
+"""
+Batched speaker embedding in the S3Gen speaker encoder (CAMPPlus): `batch_fbank` against a `Kaldi.fbank` loop, and
+`CAMPPlus.inference` over N clips of different lengths in one padded pass against N single-clip passes.
+
+The embeddings of the batched pass are compared to the single-clip ones, with the length masks (the default) and
+without them (padded frames included, as before), which shows what the padding did to the statistics. Uses
+randomly initialised weights (in eval mode) and random clips unless `--audio` files are given.
+
+    python benchmarks/campplus_batch.py [--device cpu] [--clips 16] [--min-sec 3] [--max-sec 10]
+    python benchmarks/campplus_batch.py --audio a.wav b.wav c.wav
+"""
+import argparse
+import time
+
+import librosa
+import torch
+import torchaudio.compliance.kaldi as Kaldi
+
+from chatterbox.models.s3gen.xvector import CAMPPlus, batch_fbank, extract_feature, pad_list
+
+
+def sync(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+
+
+def timed(fn, device, repeats):
+    elapsed = float("inf")
+    for _ in range(repeats):
+        sync(device)
+        start = time.perf_counter()
+        out = fn()
+        sync(device)
+        elapsed = min(elapsed, time.perf_counter() - start)
+    return out, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--audio", nargs="+", help="clips to embed, instead of random ones")
+    parser.add_argument("--clips", type=int, default=16)
+    parser.add_argument("--min-sec", type=float, default=3.0)
+    parser.add_argument("--max-sec", type=float, default=10.0)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    device = torch.device(args.device)
+    if args.audio:
+        wavs = [torch.from_numpy(librosa.load(path, sr=16000)[0]).to(device) for path in args.audio]
+    else:
+        lengths = torch.randint(int(args.min_sec * 16000), int(args.max_sec * 16000), (args.clips,))
+        wavs = [0.1 * torch.randn(int(n), device=device) for n in lengths]
+    print(f"{len(wavs)} clips, {sum(len(w) for w in wavs) / 16000:.1f}s in total")
+
+    def fbank_loop():
+        return [Kaldi.fbank(w.unsqueeze(0), num_mel_bins=80) for w in wavs]
+
+    def fbank_batch():
+        return batch_fbank(pad_list(wavs, 0), torch.tensor([len(w) for w in wavs], device=device))
+
+    reference, loop_time = timed(fbank_loop, device, args.repeats)
+    (feats, feat_lens), batch_time = timed(fbank_batch, device, args.repeats)
+    diff = max((f - feats[i, :n]).abs().max().item() for i, (f, n) in enumerate(zip(reference, feat_lens)))
+    print(f"fbank: loop {1000 * loop_time:.1f} ms, batched {1000 * batch_time:.1f} ms, max |diff| {diff:.2e}")
+
+    model = CAMPPlus(memory_efficient=False).to(device).eval()
+    with torch.inference_mode():
+        singles, single_time = timed(lambda: torch.cat([model.inference([w]) for w in wavs]), device, args.repeats)
+        batched, batch_time = timed(lambda: model.inference(wavs), device, args.repeats)
+        speech, _, _ = extract_feature(wavs)
+        unmasked = model(speech)
+
+    def report(label, embeds):
+        cos = torch.nn.functional.cosine_similarity(embeds, singles, dim=-1)
+        print(f"{label:>20}: max |diff| {(embeds - singles).abs().max().item():.2e}, min cosine {cos.min().item():.6f}")
+
+    print(f"embeddings: {len(wavs)} single passes {1000 * single_time:.1f} ms, one batch {1000 * batch_time:.1f} ms")
+    report("batched, masked", batched)
+    report("batched, unmasked", unmasked)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+"""
+Latency of `prepare_conditionals` for a voice seen for the first time (a `ConditionalsCache` miss: decode,
+resampling, S3 tokenization, CAMPPlus, voice encoder and prompt mels) against the same voice sent again (a hit:
+decode and content hash only), then the cache counters. Downloads the English checkpoint.
+
+    python benchmarks/conditionals_cache.py --audio-prompt ref.wav [--device cuda] [--repeats 5]
+"""
+import argparse
+import time
+
+import torch
+
+from chatterbox.tts import ChatterboxTTS
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--audio-prompt", required=True)
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    tts = ChatterboxTTS.from_pretrained(args.device)
+    device = torch.device(args.device)
+
+    def prepare(exaggeration=0.5):
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        tts.prepare_conditionals(args.audio_prompt, exaggeration=exaggeration)
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        return time.perf_counter() - start
+
+    miss = float("inf")
+    for _ in range(args.repeats):
+        tts.conds_cache.clear()
+        miss = min(miss, prepare())
+    hit = min(prepare() for _ in range(args.repeats))
+    hit_exaggeration = prepare(exaggeration=0.8)
+
+    print(f"miss {1000 * miss:.0f} ms, hit {1000 * hit:.0f} ms, hit with a new exaggeration "
+          f"{1000 * hit_exaggeration:.0f} ms")
+    print(tts.conds_cache.stats())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""
+Voice enrollment throughput: `enroll_voices` (decoding in a thread pool, batched S3 tokenizer, CAMPPlus and voice
+encoder, into a `VoiceLibrary`) against the sequential loop of `prepare_conditionals` calls, in voices per second,
+and how close the enrolled conditionals are to the sequential ones. Downloads the English checkpoint.
+
+    python benchmarks/enroll_voices.py clips/*.wav [--device cuda] [--batch-size 16] [--num-workers 4]
+"""
+import argparse
+import shutil
+import tempfile
+import time
+
+import torch
+
+from chatterbox.enroll import enroll_voices
+from chatterbox.tts import ChatterboxTTS
+from chatterbox.voice_library import VoiceLibrary
+
+
+def sync(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("paths", nargs="+", help="reference clips, one voice each")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--num-workers", type=int, default=4)
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    tts = ChatterboxTTS.from_pretrained(args.device)
+    tts.conds_cache.max_size = 0  # every sequential call runs the whole pipeline
+    voice_ids = [f"voice-{i:06d}" for i in range(len(args.paths))]
+
+    sync(device)
+    start = time.perf_counter()
+    sequential = []
+    for path in args.paths:
+        tts.prepare_conditionals(path)
+        sequential.append(tts.conds)
+    sync(device)
+    sequential_time = time.perf_counter() - start
+
+    root = tempfile.mkdtemp()
+    library = VoiceLibrary(root, device=args.device)
+    sync(device)
+    start = time.perf_counter()
+    enroll_voices(
+        tts, args.paths, library, voice_ids=voice_ids, batch_size=args.batch_size, num_workers=args.num_workers,
+    )
+    sync(device)
+    enroll_time = time.perf_counter() - start
+
+    n = len(args.paths)
+    print(f"sequential prepare_conditionals: {n / sequential_time:.2f} voices/s")
+    print(f"enroll_voices: {n / enroll_time:.2f} voices/s ({sequential_time / enroll_time:.1f}x)")
+
+    cosine = torch.nn.functional.cosine_similarity
+    ve_cos, x_cos, token_agreement = [], [], []
+    for voice_id, conds in zip(voice_ids, sequential):
+        enrolled = library.get(voice_id)
+        ve_cos.append(cosine(conds.t3.speaker_emb.float(), enrolled.t3.speaker_emb).item())
+        x_cos.append(cosine(conds.gen["embedding"].float(), enrolled.gen["embedding"]).item())
+        a, b = conds.gen["prompt_token"], enrolled.gen["prompt_token"]
+        m = min(a.size(1), b.size(1))
+        token_agreement.append((a[:, :m] == b[:, :m]).float().mean().item())
+    print(f"min voice encoder cosine {min(ve_cos):.5f}, min x-vector cosine {min(x_cos):.5f}, "
+          f"min S3Gen prompt token agreement {min(token_agreement):.2%}")
+    shutil.rmtree(root)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""
+HiFT source excitation (`SineGen` via `SourceModuleHnNSF`) for long outputs: the previous implementation (f0
+upsampled to the sample rate with `nn.Upsample`, one full-rate buffer and cumsum per harmonic) against the
+vectorized one (phase of the fundamental accumulated per mel frame, harmonics by broadcast), in float32 and with
+`float64_phase`, plus the whole vocoder pass.
+
+The random initial phases and the noise are drawn in the same order by both, so with the same seed the sources
+only differ by the phase accumulation; the max abs difference against a float64 reference of the previous
+algorithm is reported. Uses randomly initialised weights and a synthetic f0 contour; peak memory is reported on
+CUDA only.
+
+    python benchmarks/hift_sinegen.py [--device cpu] [--seconds 30] [--repeats 3]
+"""
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from chatterbox.models.s3gen import S3Gen
+
+
+@torch.no_grad()
+def legacy_sine_gen(sine_gen, f0, dtype=torch.float32):
+    """The previous `SineGen.forward`, with the per-harmonic loop, over full-rate f0 (B, 1, sample_len)."""
+    F_mat = torch.zeros((f0.size(0), sine_gen.harmonic_num + 1, f0.size(-1)), dtype=dtype).to(f0.device)
+    for i in range(sine_gen.harmonic_num + 1):
+        F_mat[:, i: i + 1, :] = f0 * (i + 1) / sine_gen.sampling_rate
+    theta_mat = (2 * np.pi * (torch.cumsum(F_mat, dim=-1) % 1)).float()
+    phase_vec = torch.rand(f0.size(0), sine_gen.harmonic_num + 1, 1, device=f0.device) * (2 * np.pi) - np.pi
+    phase_vec[:, 0, :] = 0
+    sine_waves = sine_gen.sine_amp * torch.sin(theta_mat + phase_vec)
+    uv = sine_gen._f02uv(f0)
+    noise_amp = uv * sine_gen.noise_std + (1 - uv) * sine_gen.sine_amp / 3
+    noise = noise_amp * torch.randn_like(sine_waves)
+    return sine_waves * uv + noise, uv, noise
+
+
+def measure(fn, device, repeats):
+    elapsed = float("inf")
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    for _ in range(repeats):
+        torch.manual_seed(0)
+        start = time.perf_counter()
+        out = fn()
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        elapsed = min(elapsed, time.perf_counter() - start)
+    peak = torch.cuda.max_memory_allocated() / 2**20 if device.type == "cuda" else float("nan")
+    return out, elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--seconds", type=float, default=30.0, help="output length")
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    device = torch.device(args.device)
+    hift = S3Gen().to(device).eval().mel2wav
+    sine_gen = hift.m_source.l_sin_gen
+    scale = int(hift.f0_upsamp.scale_factor)
+
+    n_frames = int(args.seconds * sine_gen.sampling_rate / scale)
+    t = torch.arange(n_frames, device=device) / 50
+    f0 = 150 + 40 * torch.sin(2 * np.pi * 0.3 * t) + 10 * torch.sin(2 * np.pi * 2.1 * t)
+    f0 = (f0 * (torch.sin(2 * np.pi * 0.7 * t) > -0.3)).view(1, 1, -1)  # with unvoiced stretches
+    f0_full = hift.f0_upsamp(f0)
+    print(f"{args.seconds:g}s: {n_frames} mel frames, {f0_full.size(-1)} samples, "
+          f"{sine_gen.harmonic_num + 1} harmonics")
+
+    reference, _, _ = legacy_sine_gen(sine_gen, f0_full, dtype=torch.float64)
+    print(f"{'source':>18} {'ms':>8} {'peak MiB':>9} {'max |diff|':>11}")
+    rows = [
+        ("previous", lambda: legacy_sine_gen(sine_gen, hift.f0_upsamp(f0))),
+        ("vectorized", lambda: sine_gen(f0, scale)),
+        ("vectorized f64", lambda: sine_gen(f0, scale)),
+    ]
+    for label, fn in rows:
+        sine_gen.float64_phase = label.endswith("f64")
+        (sines, _, _), elapsed, peak = measure(fn, device, args.repeats)
+        diff = (sines - reference).abs().max().item()
+        print(f"{label:>18} {1000 * elapsed:>8.1f} {peak:>9.1f} {diff:>11.2e}")
+    sine_gen.float64_phase = False
+
+    mels = torch.randn(1, 80, n_frames, device=device)
+    _, elapsed, peak = measure(lambda: hift.inference(speech_feat=mels), device, args.repeats)
+    print(f"{'vocoder (HiFT)':>18} {1000 * elapsed:>8.1f} {peak:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
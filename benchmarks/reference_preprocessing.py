@@ -0,0 +1,79 @@
+"""
+Voice enrollment latency of `ChatterboxTTS.prepare_conditionals` with the shared reference pipeline
+(`ReferenceAudio`: one decode, one resample per rate, one tokenizer pass for the T3 and S3Gen prompts) against the
+previous pipeline, reproduced here (librosa resampling to 16 kHz, a second torchaudio resampling and tokenization
+in `embed_ref`, a separate tokenization of the T3 prompt).
+
+Also reports how much the conditionals moved: the agreement of the T3 and S3Gen prompt tokens (the shared pass
+tokenizes the prompts with the audio that follows them as context, and resamples with torchaudio instead of
+librosa) and the cosine between the voice encoder embeddings. Downloads the English checkpoint.
+
+    python benchmarks/reference_preprocessing.py --audio-prompt ref.wav [--device cuda] [--repeats 5]
+"""
+import argparse
+import time
+
+import librosa
+import numpy as np
+import torch
+
+from chatterbox.models.s3gen import S3GEN_SR
+from chatterbox.models.s3tokenizer import S3_SR
+from chatterbox.tts import ChatterboxTTS
+
+
+def previous_conditionals(tts, wav_fpath):
+    s3gen_ref_wav, _sr = librosa.load(wav_fpath, sr=S3GEN_SR)
+    s3gen_ref_wav = s3gen_ref_wav.astype(np.float32)
+    ref_16k_wav = librosa.resample(s3gen_ref_wav, orig_sr=S3GEN_SR, target_sr=S3_SR).astype(np.float32)
+    s3gen_ref_dict = tts.s3gen.embed_ref(s3gen_ref_wav[:tts.DEC_COND_LEN], S3GEN_SR, device=tts.device)
+    plen = tts.t3.hp.speech_cond_prompt_len
+    t3_tokens, _ = tts.s3gen.tokenizer.forward([ref_16k_wav[:tts.ENC_COND_LEN]], max_len=plen)
+    ve_embed = torch.from_numpy(tts.ve.embeds_from_wavs([ref_16k_wav], sample_rate=S3_SR)).mean(0, keepdim=True)
+    return s3gen_ref_dict["prompt_token"], torch.atleast_2d(t3_tokens), ve_embed
+
+
+def timed(fn, device, repeats):
+    elapsed = float("inf")
+    for _ in range(repeats):
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        out = fn()
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        elapsed = min(elapsed, time.perf_counter() - start)
+    return out, elapsed
+
+
+def agreement(a, b):
+    n = min(a.size(-1), b.size(-1))
+    return (a[..., :n].cpu() == b[..., :n].cpu()).float().mean().item()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--audio-prompt", required=True)
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    tts = ChatterboxTTS.from_pretrained(args.device)
+
+    with torch.inference_mode():
+        (s3gen_tokens, t3_tokens, ve_embed), previous_time = timed(
+            lambda: previous_conditionals(tts, args.audio_prompt), device, args.repeats
+        )
+        _, shared_time = timed(lambda: tts.prepare_conditionals(args.audio_prompt), device, args.repeats)
+
+    print(f"previous pipeline {1000 * previous_time:.0f} ms, shared pipeline {1000 * shared_time:.0f} ms")
+    conds = tts.conds
+    print(f"S3Gen prompt tokens agreeing: {agreement(conds.gen['prompt_token'], s3gen_tokens):.2%}")
+    print(f"T3 prompt tokens agreeing: {agreement(conds.t3.cond_prompt_speech_tokens, t3_tokens):.2%}")
+    cos = torch.nn.functional.cosine_similarity(conds.t3.speaker_emb.cpu(), ve_embed.cpu()).item()
+    print(f"voice encoder embedding cosine: {cos:.5f}")
+
+
+if __name__ == "__main__":
+    main()
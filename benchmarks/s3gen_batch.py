@@ -0,0 +1,95 @@
+"""
+Throughput of batched S3Gen token-to-waveform inference (`S3Token2Wav.inference_batch`) against one
+`S3Token2Wav.inference` call per utterance, for utterances of different lengths.
+
+Uses randomly initialised weights and a random reference, so no checkpoint download is needed. The flow
+encoder outputs of each row in the padded batch are first compared with the same sequence encoded alone (the
+CFM and vocoder draw fresh noise per call, so their outputs can only be compared for lengths).
+
+    python benchmarks/s3gen_batch.py [--device cpu] [--batch-size 8] [--meanflow]
+"""
+import argparse
+import time
+
+import torch
+from torch.nn.utils.rnn import pad_sequence
+
+from chatterbox.models.s3gen import S3Gen
+
+
+def random_ref_dict(device, n_prompt_tokens=150):
+    return dict(
+        prompt_token=torch.randint(0, 6561, (1, n_prompt_tokens), device=device),
+        prompt_token_len=torch.tensor([n_prompt_tokens], device=device),
+        prompt_feat=torch.randn(1, 2 * n_prompt_tokens, 80, device=device),
+        prompt_feat_len=None,
+        embedding=torch.randn(1, 192, device=device),
+    )
+
+
+@torch.inference_mode()
+def encoder_diff(s3gen, speech_tokens, ref_dict):
+    flow = s3gen.flow
+    prompt = ref_dict["prompt_token"][0]
+    rows = [torch.cat([prompt, st]) for st in speech_tokens]
+    lens = torch.tensor([len(r) for r in rows], device=prompt.device)
+    padded = pad_sequence(rows, batch_first=True)
+    mask = torch.arange(padded.size(1), device=padded.device) < lens[:, None]
+    h, _ = flow.encoder(flow.input_embedding(padded) * mask[..., None], lens)
+    diff = 0.0
+    for i, row in enumerate(rows):
+        h_i, _ = flow.encoder(flow.input_embedding(row[None]), lens[i:i + 1])
+        diff = max(diff, (h[i, :h_i.size(1)] - h_i[0]).abs().max().item())
+    return diff
+
+
+def timed(device, fn):
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    out = fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return out, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--min-tokens", type=int, default=50)
+    parser.add_argument("--max-tokens", type=int, default=250)
+    parser.add_argument("--meanflow", action="store_true", help="the Turbo (2 step meanflow) decoder")
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    device = torch.device(args.device)
+    s3gen = S3Gen(meanflow=args.meanflow).to(device).eval()
+    ref_dict = random_ref_dict(device)
+    lengths = torch.linspace(args.min_tokens, args.max_tokens, args.batch_size).long().tolist()
+    speech_tokens = [torch.randint(0, 6561, (n,), device=device) for n in lengths]
+
+    print(f"max |encoder output difference| batched vs alone: {encoder_diff(s3gen, speech_tokens, ref_dict):.3e}")
+
+    def sequential():
+        return [s3gen.inference(speech_tokens=st, ref_dict=dict(ref_dict))[0] for st in speech_tokens]
+
+    def batched():
+        return s3gen.inference_batch(speech_tokens, ref_dicts=dict(ref_dict))
+
+    sequential(), batched()  # warm up
+    seq_wavs, seq_time = min((timed(device, sequential) for _ in range(args.repeats)), key=lambda r: r[1])
+    batch_wavs, batch_time = min((timed(device, batched) for _ in range(args.repeats)), key=lambda r: r[1])
+    assert [w.size(1) for w in seq_wavs] == [w.size(1) for w in batch_wavs], "batched wav lengths differ"
+
+    audio_s = sum(w.size(1) for w in batch_wavs) / s3gen.mel2wav.sampling_rate
+    print(f"{args.batch_size} utterances, {lengths[0]}-{lengths[-1]} tokens, {audio_s:.1f}s of audio")
+    print(f"{'mode':>11} {'seconds':>8} {'x realtime':>11}")
+    print(f"{'sequential':>11} {seq_time:>8.2f} {audio_s / seq_time:>11.1f}")
+    print(f"{'batched':>11} {batch_time:>8.2f} {audio_s / batch_time:>11.1f}")
+    print(f"speedup: {seq_time / batch_time:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
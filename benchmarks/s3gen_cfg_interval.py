@@ -0,0 +1,99 @@
+"""
+Estimator FLOPs saved and mel distance of CFG-interval schedules for the standard (10 step) S3Gen flow, where
+steps outside `inference_cfg_interval` run the estimator on the cond rows only.
+
+Every schedule decodes the same tokens from the same noise (the generator is reseeded before each call), so the
+distance to the full-CFG mels is only due to the schedule. Intervals are in t of the cosine `t_span` (0 = noise,
+1 = data); "none" disables CFG. Without `--pretrained`, weights, tokens and reference are random, so the
+distances are only indicative; with it, the reference clip's own prompt tokens are resynthesized.
+
+    python benchmarks/s3gen_cfg_interval.py [--device cpu] [--intervals 0:1 0:0.5 0:0.3 0.5:1 none]
+    python benchmarks/s3gen_cfg_interval.py --pretrained --audio-prompt ref.wav
+"""
+import argparse
+
+import torch
+from torch.utils.flop_counter import FlopCounterMode
+
+from chatterbox.models.s3gen import S3Gen
+from s3gen_batch import random_ref_dict
+
+
+def parse_interval(text):
+    if text == "none":
+        return "none"
+    t_start, t_end = text.split(":")
+    return float(t_start), float(t_end)
+
+
+def pretrained_inputs(device, audio_prompt):
+    from chatterbox.tts import ChatterboxTTS
+
+    tts = ChatterboxTTS.from_pretrained(device)
+    tts.prepare_conditionals(audio_prompt)
+    ref_dict = tts.conds.gen
+    return tts.s3gen, ref_dict, ref_dict["prompt_token"][0].long()
+
+
+@torch.inference_mode()
+def decode(s3gen, speech_tokens, ref_dict, interval):
+    cfm = s3gen.flow.decoder
+    cfg_rate = cfm.inference_cfg_rate
+    if interval == "none":
+        cfm.inference_cfg_rate = 0.0
+    else:
+        cfm.inference_cfg_interval = interval
+    try:
+        torch.manual_seed(0)
+        counter = FlopCounterMode(display=False)
+        with counter:
+            mels = s3gen.flow_inference(speech_tokens, ref_dict=dict(ref_dict), finalize=True)
+    finally:
+        cfm.inference_cfg_rate = cfg_rate
+        cfm.inference_cfg_interval = None
+    return mels, counter.get_total_flops()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--pretrained", action="store_true", help="use the released English checkpoint")
+    parser.add_argument("--audio-prompt", help="reference clip for --pretrained")
+    parser.add_argument("--tokens", type=int, default=200, help="random speech tokens, without --pretrained")
+    parser.add_argument("--intervals", type=parse_interval, nargs="+",
+                        default=[(0.0, 1.0), (0.0, 0.5), (0.0, 0.3), (0.5, 1.0), "none"])
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    device = torch.device(args.device)
+    if args.pretrained:
+        s3gen, ref_dict, speech_tokens = pretrained_inputs(device, args.audio_prompt)
+    else:
+        s3gen = S3Gen().to(device).eval()
+        ref_dict = random_ref_dict(device)
+        speech_tokens = torch.randint(0, 6561, (args.tokens,), device=device)
+
+    cfm = s3gen.flow.decoder
+    t_span = torch.linspace(0, 1, 11)
+    t_span = 1 - torch.cos(t_span * 0.5 * torch.pi)
+
+    reference, reference_flops = decode(s3gen, speech_tokens, ref_dict, None)
+    print(f"{'interval':>10} {'CFG steps':>10} {'GFLOPs':>8} {'saved':>7} {'mel L1':>8} {'rel L2':>8}")
+    for interval in args.intervals:
+        if interval == "none":
+            n_cfg, label = 0, "none"
+        else:
+            cfm.inference_cfg_interval = interval
+            n_cfg, label = sum(cfm.cfg_steps(t_span)), f"{interval[0]:g}:{interval[1]:g}"
+            cfm.inference_cfg_interval = None
+        mels, flops = decode(s3gen, speech_tokens, ref_dict, interval)
+        l1 = (mels - reference).abs().mean().item()
+        rel_l2 = ((mels - reference).norm() / reference.norm()).item()
+        print(
+            f"{label:>10} {n_cfg:>10} {flops / 1e9:>8.1f} {1 - flops / reference_flops:>7.1%} "
+            f"{l1:>8.4f} {rel_l2:>8.4f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
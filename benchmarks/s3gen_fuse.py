@@ -0,0 +1,77 @@
+"""
+Speedup and output deviation of `S3Token2Wav.fuse_for_inference()` per submodule: the speaker encoder (CAMPPlus,
+BatchNorms folded into convs), the vocoder (HiFT, weight norm removed, Snake constants precomputed) and the flow
+(dropout modules removed), each timed on the same inputs before and after fusion.
+
+The fused model is a deep copy of the unfused one, and the generator is reseeded before each call, so the vocoder's
+random source excitation and the CFM noise match. Uses randomly initialised weights unless `--pretrained` is given
+(downloads the English checkpoint).
+
+    python benchmarks/s3gen_fuse.py [--device cpu] [--mel-frames 500] [--repeats 5] [--pretrained]
+"""
+import argparse
+import copy
+import time
+
+import torch
+
+from chatterbox.models.s3gen import S3Gen
+from s3gen_batch import random_ref_dict
+
+
+def timed(fn, device, repeats):
+    elapsed = float("inf")
+    for _ in range(repeats):
+        torch.manual_seed(0)
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        with torch.inference_mode():
+            out = fn()
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        elapsed = min(elapsed, time.perf_counter() - start)
+    return out, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--pretrained", action="store_true", help="use the released English checkpoint")
+    parser.add_argument("--mel-frames", type=int, default=500, help="vocoder input length (50 frames per second)")
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    device = torch.device(args.device)
+    if args.pretrained:
+        from chatterbox.tts import ChatterboxTTS
+
+        s3gen = ChatterboxTTS.from_pretrained(args.device).s3gen
+    else:
+        s3gen = S3Gen().to(device).eval()
+    fused = copy.deepcopy(s3gen).fuse_for_inference()
+
+    fbank = torch.randn(1, 300, 80, device=device)  # 3 s of Kaldi fbank frames
+    mels = torch.randn(1, 80, args.mel_frames, device=device)
+    ref_dict = random_ref_dict(device)
+    speech_tokens = torch.randint(0, 6561, (args.mel_frames // 2,), device=device)
+    cases = {
+        "speaker_encoder": lambda m: m.speaker_encoder(fbank),
+        "mel2wav": lambda m: m.hift_inference(mels)[0],
+        "flow": lambda m: m.flow_inference(speech_tokens, ref_dict=dict(ref_dict), finalize=True),
+    }
+
+    print(f"{'submodule':>16} {'unfused ms':>11} {'fused ms':>9} {'speedup':>8} {'max |diff|':>11}")
+    for name, fn in cases.items():
+        reference, unfused_time = timed(lambda: fn(s3gen), device, args.repeats)
+        out, fused_time = timed(lambda: fn(fused), device, args.repeats)
+        diff = (out.float() - reference.float()).abs().max().item()
+        print(
+            f"{name:>16} {1000 * unfused_time:>11.1f} {1000 * fused_time:>9.1f} "
+            f"{unfused_time / fused_time:>7.2f}x {diff:>11.2e}"
+        )
+
+
+if __name__ == "__main__":
+    main()
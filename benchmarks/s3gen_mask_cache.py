@@ -0,0 +1,93 @@
+"""
+Profile of the attention bias construction in the S3Gen CFM decoder (`ConditionalDecoder.attention_bias`) over
+one flow solve, rebuilt in every block and Euler step (no cache) against once per solve (shared `bias_cache`).
+
+Uses randomly initialised weights, so no checkpoint download is needed. `add_optional_chunk_mask` and
+`mask_to_bias` are wrapped with timers for the measurement; the reported "bias" time is the time spent inside
+them (including the host sync of the all-false check in `add_optional_chunk_mask`), "solve" the whole loop.
+
+    python benchmarks/s3gen_mask_cache.py [--device cpu] [--mel-frames 500] [--steps 10]
+"""
+import argparse
+import time
+from functools import wraps
+
+import torch
+
+from chatterbox.models.s3gen import S3Gen
+from chatterbox.models.s3gen import decoder as decoder_module
+
+
+class Timer:
+    def __init__(self, device):
+        self.device = device
+        self.calls = 0
+        self.seconds = 0.0
+
+    def wrap(self, fn):
+        @wraps(fn)
+        def timed(*args, **kwargs):
+            if self.device.type == "cuda":
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+            out = fn(*args, **kwargs)
+            if self.device.type == "cuda":
+                torch.cuda.synchronize()
+            self.seconds += time.perf_counter() - start
+            self.calls += 1
+            return out
+        return timed
+
+
+@torch.inference_mode()
+def solve(estimator, x, mask, mu, spks, cond, n_steps, use_cache):
+    """The estimator calls of `CausalConditionalCFM.solve_euler` (2B CFG rows)."""
+    bias_cache = {} if use_cache else None
+    t_span = torch.linspace(0, 1, n_steps + 1, device=x.device)
+    for t, r in zip(t_span[:-1], t_span[1:]):
+        t_in = t.expand(x.size(0))
+        dxdt = estimator(x, mask=mask, mu=mu, t=t_in, spks=spks, cond=cond, bias_cache=bias_cache)
+        x = x + (r - t) * dxdt
+    return x
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--mel-frames", type=int, default=500, help="prompt + generated mel frames")
+    parser.add_argument("--steps", type=int, default=10, help="10 for the standard model, 2 for meanflow")
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    device = torch.device(args.device)
+    estimator = S3Gen().to(device).eval().flow.decoder.estimator
+    B, T = 2, args.mel_frames  # cond + uncond
+    x = torch.randn(B, 80, T, device=device)
+    mask = torch.ones(B, 1, T, device=device)
+    mu, cond = torch.randn(B, 80, T, device=device), torch.randn(B, 80, T, device=device)
+    spks = torch.randn(B, 80, device=device)
+
+    original = decoder_module.add_optional_chunk_mask, decoder_module.mask_to_bias
+    print(f"{'bias cache':>10} {'bias calls':>11} {'bias ms':>8} {'solve ms':>9}")
+    for use_cache in (False, True):
+        timer = Timer(device)
+        decoder_module.add_optional_chunk_mask = timer.wrap(original[0])
+        decoder_module.mask_to_bias = timer.wrap(original[1])
+        try:
+            solve(estimator, x, mask, mu, spks, cond, args.steps, use_cache)  # warm up
+            timer.calls, timer.seconds = 0, 0.0
+            start = time.perf_counter()
+            for _ in range(args.repeats):
+                solve(estimator, x, mask, mu, spks, cond, args.steps, use_cache)
+            total = (time.perf_counter() - start) / args.repeats
+        finally:
+            decoder_module.add_optional_chunk_mask, decoder_module.mask_to_bias = original
+        print(
+            f"{'on' if use_cache else 'off':>10} {timer.calls // args.repeats:>11} "
+            f"{1000 * timer.seconds / args.repeats:>8.2f} {1000 * total:>9.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""
+Flow encoder time of S3Gen with and without the per-voice prompt cache (`S3Token2Mel.cache_prompt`), against the
+number of new speech tokens, plus how far the cached encoder outputs drift from the full-context ones.
+
+The encoder attends over the full context, so with the cache the prompt no longer sees the new tokens and the
+outputs are not identical; the printed difference is over the new tokens' frames. Uses randomly initialised
+weights (no checkpoint download), so the drift is only indicative.
+
+    python benchmarks/s3gen_prompt_cache.py [--device cpu] [--prompt-tokens 250]
+"""
+import argparse
+import time
+
+import torch
+
+from chatterbox.models.s3gen import S3Gen
+
+
+@torch.inference_mode()
+def encode(flow, prompt_token, token, prompt_cache=None):
+    n_cached = 0 if prompt_cache is None else prompt_cache.n_tokens
+    tokens = torch.cat([prompt_token[:, n_cached:], token], dim=1)
+    lens = torch.tensor([tokens.size(1)], device=tokens.device)
+    if prompt_cache is None:
+        h, _ = flow.encoder(flow.input_embedding(tokens), lens)
+    else:
+        h, _ = flow.encoder.forward_with_prompt_cache(flow.input_embedding(tokens), lens, prompt_cache)
+        h = torch.cat([prompt_cache.output, h], dim=1)
+    return h
+
+
+def timed(device, fn, repeats):
+    fn()  # warm up
+    best = float("inf")
+    for _ in range(repeats):
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        out = fn()
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        best = min(best, time.perf_counter() - start)
+    return out, best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--prompt-tokens", type=int, default=250, help="10 s of reference audio")
+    parser.add_argument("--new-tokens", type=int, nargs="+", default=[25, 50, 100, 200, 400])
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    device = torch.device(args.device)
+    flow = S3Gen().to(device).eval().flow
+    prompt_token = torch.randint(0, 6561, (1, args.prompt_tokens), device=device)
+    prompt_cache = flow.encode_prompt(prompt_token, torch.tensor([args.prompt_tokens], device=device))
+
+    print(f"prompt tokens: {args.prompt_tokens} ({prompt_cache.n_tokens} cached)")
+    print(f"{'new':>5} {'full ms':>8} {'cached ms':>10} {'speedup':>8} {'max |diff|':>11}")
+    for n_new in args.new_tokens:
+        token = torch.randint(0, 6561, (1, n_new), device=device)
+        h_full, t_full = timed(device, lambda: encode(flow, prompt_token, token), args.repeats)
+        h_cached, t_cached = timed(device, lambda: encode(flow, prompt_token, token, prompt_cache), args.repeats)
+        diff = (h_full - h_cached)[:, -2 * n_new:].abs().max().item()
+        print(f"{n_new:>5} {1000 * t_full:>8.1f} {1000 * t_cached:>10.1f} {t_full / t_cached:>7.2f}x {diff:>11.3e}")
+
+
+if __name__ == "__main__":
+    main()
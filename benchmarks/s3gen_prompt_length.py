@@ -0,0 +1,75 @@
+"""
+Sweep of the S3Gen reference prompt length (`prepare_conditionals(s3gen_prompt_sec=...)`, the most voiced window
+of the clip) against S3Gen latency and speaker similarity, to pick an operating point.
+
+The speech tokens are generated once by T3 (whose conditioning does not depend on the S3Gen prompt), then every
+prompt length vocodes the same tokens. Similarity is the cosine between the `VoiceEncoder` speaker embeddings of
+the output and of the whole reference clip (`VoiceEncoder.voice_similarity`). Downloads the English checkpoint.
+
+    python benchmarks/s3gen_prompt_length.py --audio-prompt ref.wav [--device cuda] [--seconds 2 4 6 8 10]
+"""
+import argparse
+import time
+
+import librosa
+import torch
+
+from chatterbox.models.s3gen import S3GEN_SR
+from chatterbox.models.s3tokenizer import S3_SR
+from chatterbox.tts import ChatterboxTTS, punc_norm
+
+
+TEXT = (
+    "The quick brown fox jumps over the lazy dog, while the rest of the pack watches quietly from the edge of "
+    "the forest."
+)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--audio-prompt", required=True, help="reference clip, ideally longer than 10 s")
+    parser.add_argument("--seconds", type=float, nargs="+", default=[2, 3, 4, 6, 8, 10])
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    device = torch.device(args.device)
+    tts = ChatterboxTTS.from_pretrained(args.device)
+    tts.prepare_conditionals(args.audio_prompt)
+
+    text_tokens = tts.tokenizer.text_to_tokens(punc_norm(TEXT)).to(device)
+    text_tokens = torch.cat([text_tokens, text_tokens])
+    text_tokens = torch.nn.functional.pad(text_tokens, (1, 0), value=tts.t3.hp.start_text_token)
+    text_tokens = torch.nn.functional.pad(text_tokens, (0, 1), value=tts.t3.hp.stop_text_token)
+    with torch.inference_mode():
+        speech_tokens = tts.t3.inference(t3_cond=tts.conds.t3, text_tokens=text_tokens, max_new_tokens=1000)[0]
+    speech_tokens = tts._clean_speech_tokens(speech_tokens)
+
+    ref_wav, _ = librosa.load(args.audio_prompt, sr=S3_SR)
+    ref_embed = tts.ve.embeds_from_wavs([ref_wav], sample_rate=S3_SR, as_spk=True)
+
+    print(f"{len(speech_tokens)} speech tokens ({len(speech_tokens) / 25:.1f}s)")
+    print(f"{'prompt s':>9} {'tokens':>7} {'S3Gen ms':>9} {'similarity':>11}")
+    for seconds in [None] + args.seconds:
+        tts.prepare_conditionals(args.audio_prompt, s3gen_prompt_sec=seconds)
+        ref_dict = tts.conds.gen
+        elapsed = float("inf")
+        for _ in range(args.repeats):
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+            wav, _ = tts.s3gen.inference(speech_tokens=speech_tokens, ref_dict=ref_dict)
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+            elapsed = min(elapsed, time.perf_counter() - start)
+
+        wav_16k = librosa.resample(wav[0].float().cpu().numpy(), orig_sr=S3GEN_SR, target_sr=S3_SR)
+        embed = tts.ve.embeds_from_wavs([wav_16k], sample_rate=S3_SR, as_spk=True)
+        similarity = tts.ve.voice_similarity(embed, ref_embed)
+        label = "first 10" if seconds is None else f"{seconds:g}"
+        print(f"{label:>9} {ref_dict['prompt_token'].size(-1):>7} {1000 * elapsed:>9.0f} {similarity:>11.3f}")
+
+
+if __name__ == "__main__":
+    main()
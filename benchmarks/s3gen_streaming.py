@@ -0,0 +1,101 @@
+"""
+Time to first audio of `S3GenStreamer` (speech tokens pushed in chunks) against one `S3Token2Wav.inference`
+call over the whole utterance, plus a check for clicks at the chunk boundaries: the largest sample-to-sample step
+next to a boundary against the 99.9th percentile of the steps elsewhere.
+
+Uses randomly initialised weights and a random reference unless `--pretrained` is given (downloads the checkpoint;
+the reference clip's own prompt tokens are resynthesized), in which case `--out` saves both renditions.
+
+    python benchmarks/s3gen_streaming.py [--device cpu] [--chunk-tokens 25] [--context-tokens 50] [--tokens 300]
+    python benchmarks/s3gen_streaming.py --pretrained --audio-prompt ref.wav --out streamed.wav
+"""
+import argparse
+import time
+
+import torch
+
+from chatterbox.models.s3gen import S3Gen, S3GenStreamer, S3GEN_SR
+from s3gen_batch import random_ref_dict
+
+
+def pretrained_inputs(device, audio_prompt):
+    from chatterbox.tts import ChatterboxTTS
+
+    tts = ChatterboxTTS.from_pretrained(device)
+    tts.prepare_conditionals(audio_prompt)
+    ref_dict = tts.conds.gen
+    return tts.s3gen, ref_dict, ref_dict["prompt_token"][0].long()
+
+
+def sync(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--pretrained", action="store_true", help="use the released English checkpoint")
+    parser.add_argument("--audio-prompt", help="reference clip for --pretrained")
+    parser.add_argument("--tokens", type=int, default=300, help="random speech tokens, without --pretrained")
+    parser.add_argument("--chunk-tokens", type=int, default=25)
+    parser.add_argument("--context-tokens", type=int, default=50, help="flow context of a chunk, see S3GenStreamer")
+    parser.add_argument("--out", help="save the streamed audio here (and the one-shot audio next to it)")
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    device = torch.device(args.device)
+    if args.pretrained:
+        s3gen, ref_dict, speech_tokens = pretrained_inputs(device, args.audio_prompt)
+    else:
+        s3gen = S3Gen().to(device).eval()
+        ref_dict = random_ref_dict(device)
+        speech_tokens = torch.randint(0, 6561, (args.tokens,), device=device)
+
+    sync(device)
+    start = time.perf_counter()
+    full_wav, _ = s3gen.inference(speech_tokens=speech_tokens, ref_dict=dict(ref_dict))
+    sync(device)
+    full_time = time.perf_counter() - start
+
+    streamer = S3GenStreamer(s3gen, dict(ref_dict), context_tokens=args.context_tokens)
+    chunks, first_audio, push_times = [], None, []
+    sync(device)
+    start = time.perf_counter()
+    for i in range(0, len(speech_tokens), args.chunk_tokens):
+        push_start = time.perf_counter()
+        chunks.append(streamer.push(speech_tokens[i:i + args.chunk_tokens]))
+        sync(device)
+        push_times.append(time.perf_counter() - push_start)
+        if first_audio is None and chunks[-1].size(1) > 0:
+            first_audio = time.perf_counter() - start
+    chunks.append(streamer.flush())
+    sync(device)
+    stream_time = time.perf_counter() - start
+    stream_wav = torch.cat(chunks, dim=1)
+
+    print(f"audio: {full_wav.size(1) / S3GEN_SR:.2f}s one-shot, {stream_wav.size(1) / S3GEN_SR:.2f}s streamed")
+    print(f"one-shot: {full_time:.2f}s to any audio")
+    print(f"streamed: {first_audio:.2f}s to first audio, {stream_time:.2f}s in total, {len(chunks)} chunks")
+    # with the bounded flow window, the late chunks should cost about as much as the early ones
+    if len(push_times) > 1:
+        print(f"per chunk: {1000 * push_times[1]:.0f}ms for the second, {1000 * push_times[-1]:.0f}ms for the last")
+
+    steps = (stream_wav[0, 1:] - stream_wav[0, :-1]).abs()
+    boundaries = torch.tensor([c.size(1) for c in chunks]).cumsum(0)[:-1]
+    near = torch.zeros_like(steps, dtype=torch.bool)
+    for b in boundaries.tolist():
+        near[max(b - 3, 0):b + 2] = True
+    if near.any():
+        print(f"max |step| at chunk boundaries: {steps[near].max().item():.4f}, "
+              f"99.9th percentile elsewhere: {steps[~near].float().quantile(0.999).item():.4f}")
+
+    if args.out:
+        import torchaudio as ta
+
+        ta.save(args.out, stream_wav.float().cpu(), S3GEN_SR)
+        ta.save(args.out.replace(".wav", "") + "_oneshot.wav", full_wav.float().cpu(), S3GEN_SR)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""
+Batched `S3Tokenizer.forward`: N clips of different lengths through one padded log-mel and `quantize` pass,
+against one `forward` call per clip (what the previous per-wav loop amounted to, apart from the final quantize).
+
+Reports both timings, the max log-mel difference between each clip's batched and single-clip features (over its
+own frames) and the fraction of speech tokens that agree. Uses randomly initialised tokenizer weights and random
+clips unless `--pretrained` (downloads the English checkpoint) and `--audio` files are given.
+
+    python benchmarks/s3tokenizer_batch.py [--device cpu] [--clips 32] [--min-sec 2] [--max-sec 10]
+    python benchmarks/s3tokenizer_batch.py --pretrained --audio a.wav b.wav c.wav
+"""
+import argparse
+import time
+
+import librosa
+import torch
+
+from chatterbox.models.s3tokenizer import S3_SR, S3Tokenizer
+
+
+def timed(fn, device, repeats):
+    elapsed = float("inf")
+    for _ in range(repeats):
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        out = fn()
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        elapsed = min(elapsed, time.perf_counter() - start)
+    return out, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--pretrained", action="store_true", help="use the tokenizer of the English checkpoint")
+    parser.add_argument("--audio", nargs="+", help="clips to tokenize, instead of random ones")
+    parser.add_argument("--clips", type=int, default=32)
+    parser.add_argument("--min-sec", type=float, default=2.0)
+    parser.add_argument("--max-sec", type=float, default=10.0)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    device = torch.device(args.device)
+    if args.pretrained:
+        from chatterbox.tts import ChatterboxTTS
+
+        tokenizer = ChatterboxTTS.from_pretrained(args.device).s3gen.tokenizer
+    else:
+        tokenizer = S3Tokenizer().to(device).eval()
+    if args.audio:
+        wavs = [librosa.load(path, sr=S3_SR)[0] for path in args.audio]
+    else:
+        lengths = torch.randint(int(args.min_sec * S3_SR), int(args.max_sec * S3_SR), (args.clips,))
+        wavs = [0.1 * torch.randn(int(n)) for n in lengths]
+    wavs = tokenizer.pad(wavs, S3_SR)
+    print(f"{len(wavs)} clips, {sum(w.size(-1) for w in wavs) / S3_SR:.1f}s in total")
+
+    singles, single_time = timed(lambda: [tokenizer(w) for w in wavs], device, args.repeats)
+    (tokens, token_lens), batch_time = timed(lambda: tokenizer(wavs), device, args.repeats)
+    print(f"{len(wavs)} single calls {1000 * single_time:.1f} ms, one batched call {1000 * batch_time:.1f} ms")
+
+    mels, mel_lens = tokenizer.batch_log_mel_spectrogram(wavs)
+    mel_diff = max(
+        (tokenizer.log_mel_spectrogram(w)[0] - mels[i, :, :n]).abs().max().item()
+        for i, (w, n) in enumerate(zip(wavs, mel_lens.tolist()))
+    )
+    agree = sum(
+        (tokens[i, :n] == single[0][0, :n]).sum().item()
+        for i, (single, n) in enumerate(zip(singles, token_lens.tolist()))
+    )
+    print(f"max log-mel |diff| {mel_diff:.2e}, tokens agreeing {agree / token_lens.sum().item():.2%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""
+Decode throughput of `T3BatchEngine` across batch sizes, against one `T3.inference` call per request, plus a
+greedy equivalence check of both paths.
+
+Uses randomly initialised weights, so no checkpoint download is needed; the runaway guard is off and EOS is
+rarely sampled, so most requests decode `--tokens` tokens. Requests get texts of different lengths, so the
+engine's left padding is exercised. For the check, `min_p=1` keeps only the most likely token (greedy
+decoding, with the repetition penalty applied first on both paths), and every request of the engine should
+produce the same tokens as its single-request run.
+
+    python benchmarks/t3_batch_engine.py [--device cpu] [--requests 16] [--tokens 100] [--batch-sizes 1 2 4 8 16]
+"""
+import argparse
+import dataclasses
+import time
+
+import torch
+
+from chatterbox.models.t3.inference.batch_engine import T3BatchEngine, T3Request
+from t3_static_cache import build_t3, random_inputs
+
+
+def make_requests(t3, device, n_requests, n_tokens, **sampling):
+    requests = []
+    for i in range(n_requests):
+        t3_cond, text_tokens = random_inputs(t3, device, n_text_tokens=20 + 10 * (i % 5))
+        requests.append(T3Request(
+            t3_cond=t3_cond,
+            text_tokens=text_tokens[0],
+            max_new_tokens=n_tokens,
+            runaway_guard=False,
+            **sampling,
+        ))
+    return requests
+
+
+def run_single(t3, requests):
+    return [
+        t3.inference(
+            t3_cond=r.t3_cond,
+            text_tokens=torch.stack([r.text_tokens, r.text_tokens]),
+            max_new_tokens=r.max_new_tokens,
+            temperature=r.temperature,
+            top_p=r.top_p,
+            min_p=r.min_p,
+            repetition_penalty=r.repetition_penalty,
+            cfg_weight=r.cfg_weight,
+            runaway_guard=False,
+        )
+        for r in requests
+    ]
+
+
+def run_engine(t3, requests, max_batch_size):
+    # fresh copies, the engine writes its results into the requests
+    requests = [
+        dataclasses.replace(r, request_id=None, speech_tokens=None, stop_reason=None, finished=False)
+        for r in requests
+    ]
+    engine = T3BatchEngine(t3, max_batch_size=max_batch_size)
+    for request in requests:
+        engine.submit(request)
+    engine.run()
+    return [r.speech_tokens for r in requests]
+
+
+def first_divergence(a, b):
+    n = min(a.size(1), b.size(1))
+    diff = (a[0, :n] != b[0, :n]).nonzero()
+    return int(diff[0]) if len(diff) else n
+
+
+def timed(fn, device):
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    tokens = fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return tokens, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--requests", type=int, default=16)
+    parser.add_argument("--tokens", type=int, default=100)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    t3 = build_t3(False, args.device)
+    device = t3.device
+
+    # greedy equivalence
+    greedy = make_requests(t3, args.device, min(args.requests, 8), args.tokens, min_p=1.0, top_p=1.0)
+    single = run_single(t3, greedy)
+    batched = run_engine(t3, greedy, max_batch_size=len(greedy))
+    n_equal = sum(torch.equal(a, b) for a, b in zip(single, batched))
+    divergence = min(first_divergence(a, b) for a, b in zip(single, batched))
+    print(f"greedy: {n_equal}/{len(greedy)} requests identical to their single-request run, "
+          f"earliest divergence at token {divergence} of {args.tokens}")
+
+    # throughput
+    requests = make_requests(t3, args.device, args.requests, args.tokens)
+    run_engine(t3, make_requests(t3, args.device, 2, 8), max_batch_size=2)  # warm up
+
+    print(f"{'path':>8} {'batch':>6} {'tokens/s':>10} {'s':>8}")
+    tokens, elapsed = timed(lambda: run_single(t3, requests), device)
+    n_tokens = sum(t.size(1) for t in tokens)
+    print(f"{'single':>8} {1:>6} {n_tokens / elapsed:>10.1f} {elapsed:>8.2f}")
+    for batch_size in args.batch_sizes:
+        tokens, elapsed = timed(lambda: run_engine(t3, requests, batch_size), device)
+        n_tokens = sum(t.size(1) for t in tokens)
+        print(f"{'engine':>8} {batch_size:>6} {n_tokens / elapsed:>10.1f} {elapsed:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
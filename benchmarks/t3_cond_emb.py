@@ -0,0 +1,72 @@
+"""
+T3 conditioning embeddings (`T3.prepare_conditioning`) over a sweep of exaggeration values, rebuilding the `T3Cond`
+for each value (speech prompt embeddings, Perceiver and speaker projection every time, as before) against
+`T3Cond.with_emotion_adv` (the voice embeddings are memoized on the first call, then only the emotion embedding is
+added), plus the largest difference between the two.
+
+Uses randomly initialised weights, so no checkpoint download is needed.
+
+    python benchmarks/t3_cond_emb.py [--device cpu] [--values 32]
+"""
+import argparse
+import time
+
+import torch
+
+from chatterbox.models.t3.modules.cond_enc import T3Cond
+from t3_static_cache import build_t3, random_inputs
+
+
+def timed(fn, device):
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    out = fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return out, time.perf_counter() - start
+
+
+@torch.inference_mode()
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--values", type=int, default=32, help="exaggeration values in the sweep")
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    device = torch.device(args.device)
+    t3 = build_t3(False, args.device)
+    t3_cond, _ = random_inputs(t3, args.device)
+    exaggerations = torch.linspace(0.25, 2.0, args.values).tolist()
+
+    def rebuilt():
+        return [
+            t3.prepare_conditioning(T3Cond(
+                speaker_emb=t3_cond.speaker_emb,
+                cond_prompt_speech_tokens=t3_cond.cond_prompt_speech_tokens,
+                emotion_adv=e * torch.ones(1, 1, 1, device=device),
+            ))
+            for e in exaggerations
+        ]
+
+    def memoized():
+        cond = t3_cond
+        cond_embs = []
+        for e in exaggerations:
+            cond = cond.with_emotion_adv(e * torch.ones(1, 1, 1, device=device))
+            cond_embs.append(t3.prepare_conditioning(cond))
+        return cond_embs
+
+    rebuilt()  # warm-up
+    reference, rebuilt_time = timed(rebuilt, device)
+    cond_embs, memo_time = timed(memoized, device)
+    diff = max((a - b).abs().max().item() for a, b in zip(reference, cond_embs))
+    print(f"{args.values} exaggeration values, cond_emb {tuple(reference[0].shape)}")
+    print(f"rebuilt T3Cond: {1000 * rebuilt_time / args.values:.3f} ms/value")
+    print(f"with_emotion_adv: {1000 * memo_time / args.values:.3f} ms/value (first call included)")
+    print(f"max |diff| {diff:.2e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""
+Time to first speech token of T3 with and without a KV-cache snapshot of the conditioning prefix
+(`T3.prefill_conditioning`), plus the largest difference between the prefill logits of both paths.
+
+Uses randomly initialised weights, so no checkpoint download is needed. The gain grows with the share of the
+prompt taken by the conditioning, ie it is largest for Turbo's 375 prompt speech tokens. Without a snapshot,
+the standard model still computes one per call, shared by the CFG rows; the logits are compared against the
+plain two-row prefill over the whole prompt.
+
+    python benchmarks/t3_prefix_cache.py [--turbo] [--device cpu] [--text-tokens 60]
+"""
+import argparse
+import time
+
+import torch
+
+from t3_static_cache import build_t3, random_inputs
+
+
+@torch.inference_mode()
+def prefill_logits(t3, t3_cond, text_tokens, prefix_cache=None):
+    """Logits of the first speech token, computed like the dynamic cache paths of `inference(_turbo)`."""
+    if t3.is_gpt:
+        speech_start_token = t3.hp.start_speech_token * torch.ones_like(text_tokens[:, :1])
+        if prefix_cache is None:
+            embeds, _ = t3.prepare_input_embeds(t3_cond=t3_cond, text_tokens=text_tokens, speech_tokens=speech_start_token)
+            hidden_states = t3.tfmr(inputs_embeds=embeds).last_hidden_state
+        else:
+            text_emb, speech_emb = t3._embed_text_and_speech(text_tokens, speech_start_token)
+            embeds = torch.cat([text_emb, speech_emb], dim=1)
+            attention_mask = torch.ones(1, prefix_cache.len_cond + embeds.size(1), dtype=torch.long, device=embeds.device)
+            hidden_states = t3.tfmr(
+                inputs_embeds=embeds,
+                past_key_values=prefix_cache.legacy_cache(),
+                attention_mask=attention_mask,
+            ).last_hidden_state
+    else:
+        text_tokens = torch.cat([text_tokens, text_tokens])
+        embeds, _ = t3.prepare_inference_embeds(
+            t3_cond=t3_cond,
+            text_tokens=text_tokens,
+            cfg_weight=0.5,
+            prefix_cache=prefix_cache,
+        )
+        past_key_values = None if prefix_cache is None else prefix_cache.dynamic_cache(embeds.size(0))
+        hidden_states = t3.tfmr(inputs_embeds=embeds, past_key_values=past_key_values).last_hidden_state
+    return t3.speech_head(hidden_states[:, -1]).float()
+
+
+def time_first_token(t3, t3_cond, text_tokens, prefix_cache, cache_implementation):
+    if t3.device.type == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    if t3.is_gpt:
+        t3.inference_turbo(
+            t3_cond=t3_cond,
+            text_tokens=text_tokens,
+            max_gen_len=0,
+            cache_implementation=cache_implementation,
+            prefix_cache=prefix_cache,
+        )
+    else:
+        t3.inference(
+            t3_cond=t3_cond,
+            text_tokens=torch.cat([text_tokens, text_tokens]),
+            max_new_tokens=1,
+            cache_implementation=cache_implementation,
+            prefix_cache=prefix_cache,
+        )
+    if t3.device.type == "cuda":
+        torch.cuda.synchronize()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--turbo", action="store_true", help="benchmark the GPT2 (Turbo) backbone")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--text-tokens", type=int, default=60)
+    parser.add_argument("--repeats", type=int, default=10)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    t3 = build_t3(args.turbo, args.device)
+    t3_cond, text_tokens = random_inputs(t3, args.device, n_text_tokens=args.text_tokens)
+    prefix_cache = t3.prefill_conditioning(t3_cond)
+
+    diff = (prefill_logits(t3, t3_cond, text_tokens) - prefill_logits(t3, t3_cond, text_tokens, prefix_cache)).abs().max()
+    print(f"conditioning positions: {prefix_cache.len_cond}, text positions: {text_tokens.size(1)}")
+    print(f"max |logits difference|: {diff.item():.3e}")
+
+    print(f"{'cache':>8} {'prefix':>8} {'ms to first token':>18}")
+    for cache_implementation in ("dynamic", "static"):
+        for label, cache in (("none", None), ("snapshot", prefix_cache)):
+            time_first_token(t3, t3_cond, text_tokens, cache, cache_implementation)  # warm up
+            elapsed = min(
+                time_first_token(t3, t3_cond, text_tokens, cache, cache_implementation)
+                for _ in range(args.repeats)
+            )
+            print(f"{cache_implementation:>8} {label:>8} {1000 * elapsed:>18.1f}")
+
+
+if __name__ == "__main__":
+    main()
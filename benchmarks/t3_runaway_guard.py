@@ -0,0 +1,86 @@
+"""
+How early `RunawayGuard` stops runaway speech token streams, and how often it fires on real generations.
+
+Without arguments, synthetic streams (speech-like random tokens followed by a loop, a silence run or endless
+babble) are replayed through the guard, printing the step it fires at and the decode steps saved against
+`max_new_tokens=1000`. With `--pretrained` (downloads the checkpoint), the English model generates every line
+of `--texts` and the stop reasons counted in `T3.stop_counts` are printed.
+
+    python benchmarks/t3_runaway_guard.py
+    python benchmarks/t3_runaway_guard.py --pretrained --texts lines.txt --audio-prompt ref.wav --device cuda
+"""
+import argparse
+import random
+
+from chatterbox.models.s3gen.const import S3GEN_SIL
+from chatterbox.models.t3.inference.runaway_guard import RunawayGuard
+
+
+MAX_NEW_TOKENS = 1000
+
+
+def speech(n, rng):
+    return [rng.randrange(6561) for _ in range(n)]
+
+
+def synthetic_streams(n_text_tokens, rng):
+    # ~2 speech tokens per text token is a normal reading speed for the English tokenizer
+    n_speech = 2 * n_text_tokens
+    unit = speech(12, rng)
+    return {
+        "normal": speech(n_speech, rng),
+        "loop": speech(n_speech // 2, rng) + unit * (MAX_NEW_TOKENS // len(unit) + 1),
+        "silence": speech(n_speech // 2, rng) + [S3GEN_SIL] * MAX_NEW_TOKENS,
+        "babble": speech(MAX_NEW_TOKENS, rng),
+    }
+
+
+def replay(stream, n_text_tokens):
+    guard = RunawayGuard(n_text_tokens)
+    for step, token in enumerate(stream[:MAX_NEW_TOKENS], start=1):
+        reason = guard.step(token)
+        if reason is not None:
+            return step, reason, guard.num_trim
+    return min(len(stream), MAX_NEW_TOKENS), None, 0
+
+
+def run_synthetic():
+    rng = random.Random(0)
+    print(f"{'text':>5} {'stream':>8} {'stops at':>9} {'reason':>13} {'trimmed':>8} {'steps saved':>12}")
+    for n_text_tokens in (20, 80, 200):
+        for name, stream in synthetic_streams(n_text_tokens, rng).items():
+            step, reason, num_trim = replay(stream, n_text_tokens)
+            saved = MAX_NEW_TOKENS - step if reason is not None else 0
+            print(f"{n_text_tokens:>5} {name:>8} {step:>9} {reason or '-':>13} {num_trim:>8} {saved:>12}")
+
+
+def run_pretrained(args):
+    from chatterbox.tts import ChatterboxTTS
+
+    tts = ChatterboxTTS.from_pretrained(args.device)
+    tts.prepare_conditionals(args.audio_prompt)
+    with open(args.texts) as f:
+        texts = [line.strip() for line in f if line.strip()]
+    for text in texts:
+        tts.generate(text)
+    total = sum(tts.t3.stop_counts.values())
+    for reason, count in tts.t3.stop_counts.most_common():
+        print(f"{reason:>15} {count:>6} {count / total:>7.1%}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pretrained", action="store_true")
+    parser.add_argument("--texts", help="one text per line, for --pretrained")
+    parser.add_argument("--audio-prompt", help="reference clip for --pretrained")
+    parser.add_argument("--device", default="cpu")
+    args = parser.parse_args()
+
+    if args.pretrained:
+        run_pretrained(args)
+    else:
+        run_synthetic()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""
+Microbenchmark of the speech token sampling stage: HF's logits processor chain, as previously used by
+`T3.inference`, against the fused `T3Sampler`.
+
+    python benchmarks/t3_sampler.py [--device cpu] [--steps 1000]
+"""
+import argparse
+import time
+
+import torch
+from transformers.generation.logits_process import (
+    LogitsProcessorList,
+    RepetitionPenaltyLogitsProcessor,
+    TemperatureLogitsWarper,
+    TopKLogitsWarper,
+    TopPLogitsWarper,
+    MinPLogitsWarper,
+)
+
+from chatterbox.models.t3.inference.sampler import T3Sampler
+
+
+VOCAB_SIZE = 8194
+
+
+def run_hf(logits, steps, temperature, top_k, top_p, min_p, repetition_penalty):
+    processors = LogitsProcessorList([RepetitionPenaltyLogitsProcessor(repetition_penalty)])
+    processors.append(TemperatureLogitsWarper(temperature))
+    if top_k > 0:
+        processors.append(TopKLogitsWarper(top_k))
+    processors.append(MinPLogitsWarper(min_p))
+    processors.append(TopPLogitsWarper(top_p))
+
+    B = logits.size(1)
+    generated_ids = torch.zeros(B, 1, dtype=torch.long, device=logits.device)
+    for i in range(steps):
+        scores = processors(generated_ids, logits[i % len(logits)].clone())
+        next_token = torch.multinomial(torch.softmax(scores, dim=-1), num_samples=1)
+        generated_ids = torch.cat([generated_ids, next_token], dim=1)
+    return generated_ids
+
+
+def run_fused(logits, steps, temperature, top_k, top_p, min_p, repetition_penalty):
+    B = logits.size(1)
+    sampler = T3Sampler(
+        B,
+        VOCAB_SIZE,
+        temperature=temperature,
+        top_k=top_k,
+        top_p=top_p,
+        min_p=min_p,
+        repetition_penalty=repetition_penalty,
+        device=logits.device,
+    )
+    sampler.update(torch.zeros(B, 1, dtype=torch.long, device=logits.device))
+    tokens = torch.empty(B, steps, dtype=torch.long, device=logits.device)
+    for i in range(steps):
+        tokens[:, i:i + 1] = sampler(logits[i % len(logits)])
+    return tokens
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    fn(*args)
+    if args[0].device.type == "cuda":
+        torch.cuda.synchronize()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--steps", type=int, default=1000)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    settings = {
+        # temperature, top_k, top_p, min_p, repetition_penalty
+        "standard": (0.8, 0, 1.0, 0.05, 1.2),
+        "turbo": (0.8, 1000, 0.95, 0.0, 1.2),
+    }
+    print(f"{'setting':>9} {'batch':>6} {'hf us/step':>11} {'fused us/step':>14} {'speedup':>8}")
+    for name, params in settings.items():
+        for batch_size in (1, 8):
+            logits = 4 * torch.randn(64, batch_size, VOCAB_SIZE, device=args.device)
+            run_hf(logits, 10, *params)
+            run_fused(logits, 10, *params)
+            hf = timed(run_hf, logits, args.steps, *params)
+            fused = timed(run_fused, logits, args.steps, *params)
+            print(
+                f"{name:>9} {batch_size:>6} {1e6 * hf / args.steps:>11.1f} "
+                f"{1e6 * fused / args.steps:>14.1f} {hf / fused:>7.2f}x"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""
+Soak test of repeated multilingual T3 generations: per-token latency and the number of forward hooks on the
+aligned attention layers should be the same on request 1 and request 1000.
+
+Uses randomly initialised weights; EOS is ignored so every request decodes the same number of tokens.
+
+    python benchmarks/t3_soak.py [--requests 1000] [--max-new-tokens 20] [--device cpu]
+"""
+import argparse
+import time
+
+import torch
+
+from chatterbox.models.t3 import T3
+from chatterbox.models.t3.modules.cond_enc import T3Cond
+from chatterbox.models.t3.modules.t3_config import T3Config
+from chatterbox.models.t3.inference.alignment_stream_analyzer import LLAMA_ALIGNED_HEADS
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--max-new-tokens", type=int, default=20)
+    parser.add_argument("--report-every", type=int, default=100)
+    parser.add_argument("--device", default="cpu")
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    hp = T3Config.multilingual()
+    t3 = T3(hp).to(args.device).eval()
+    t3_cond = T3Cond(
+        speaker_emb=torch.randn(1, hp.speaker_embed_size),
+        cond_prompt_speech_tokens=torch.randint(0, 6561, (1, hp.speech_cond_prompt_len)),
+        emotion_adv=0.5 * torch.ones(1, 1, 1),
+    ).to(device=args.device)
+    text_tokens = torch.randint(1, hp.start_text_token, (1, 40))
+    text_tokens[:, 0] = hp.start_text_token
+    text_tokens[:, -1] = hp.stop_text_token
+    text_tokens = torch.cat([text_tokens, text_tokens]).to(args.device)
+
+    aligned_layers = [t3.tfmr.layers[layer_idx].self_attn for layer_idx, _ in LLAMA_ALIGNED_HEADS]
+
+    print(f"{'request':>8} {'ms/token':>9} {'hooks':>6}")
+    for request in range(1, args.requests + 1):
+        if t3.device.type == "cuda":
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        t3.inference(
+            t3_cond=t3_cond,
+            text_tokens=text_tokens,
+            max_new_tokens=args.max_new_tokens,
+            stop_on_eos=False,
+        )
+        if t3.device.type == "cuda":
+            torch.cuda.synchronize()
+        elapsed = time.perf_counter() - start
+
+        if request == 1 or request % args.report_every == 0:
+            n_hooks = sum(len(layer._forward_hooks) for layer in aligned_layers)
+            print(f"{request:>8} {1000 * elapsed / args.max_new_tokens:>9.2f} {n_hooks:>6}")
+
+
+if __name__ == "__main__":
+    main()
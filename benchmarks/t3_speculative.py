@@ -0,0 +1,87 @@
+"""
+Acceptance rate and tokens/s of speculative T3 decoding (prompt-lookup drafts, `T3SpeculativeDecoder`)
+against the plain decode loop of `T3.inference`.
+
+With randomly initialised weights the drafts are almost never accepted, so this only measures the overhead
+of verification. Use `--pretrained` with a reference clip for the real acceptance rate (downloads the
+checkpoint):
+
+    python benchmarks/t3_speculative.py [--device cpu] [--draft-tokens 2 4 8]
+    python benchmarks/t3_speculative.py --pretrained --audio-prompt ref.wav --device cuda
+"""
+import argparse
+import time
+
+import torch
+import torch.nn.functional as F
+
+from chatterbox.models.t3.inference.speculative import T3SpeculativeDecoder
+from t3_static_cache import build_t3, random_inputs
+
+
+TEXT = (
+    "Speculative decoding drafts several speech tokens ahead and lets the full model check all of them at once, "
+    "so long utterances need far fewer sequential forward passes."
+)
+
+
+def pretrained_inputs(device, audio_prompt):
+    from chatterbox.tts import ChatterboxTTS, punc_norm
+
+    tts = ChatterboxTTS.from_pretrained(device)
+    tts.prepare_conditionals(audio_prompt)
+    text_tokens = tts.tokenizer.text_to_tokens(punc_norm(TEXT)).to(device)
+    text_tokens = F.pad(text_tokens, (1, 0), value=tts.t3.hp.start_text_token)
+    text_tokens = F.pad(text_tokens, (0, 1), value=tts.t3.hp.stop_text_token)
+    return tts.t3, tts.conds.t3, text_tokens
+
+
+def timed(t3, fn):
+    if t3.device.type == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    speech_tokens = fn()
+    if t3.device.type == "cuda":
+        torch.cuda.synchronize()
+    return speech_tokens, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--pretrained", action="store_true", help="use the released English checkpoint")
+    parser.add_argument("--audio-prompt", help="reference clip for --pretrained")
+    parser.add_argument("--draft-tokens", type=int, nargs="+", default=[2, 4, 8])
+    parser.add_argument("--max-new-tokens", type=int, default=400)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    if args.pretrained:
+        t3, t3_cond, text_tokens = pretrained_inputs(args.device, args.audio_prompt)
+    else:
+        t3 = build_t3(False, args.device)
+        t3_cond, text_tokens = random_inputs(t3, args.device)
+    text_tokens = torch.cat([text_tokens, text_tokens])  # CFG
+    prefix_cache = t3.prefill_conditioning(t3_cond)
+    kwargs = dict(
+        t3_cond=t3_cond,
+        text_tokens=text_tokens,
+        max_new_tokens=args.max_new_tokens,
+        stop_on_eos=args.pretrained,  # random weights would stop at arbitrary lengths
+        prefix_cache=prefix_cache,
+    )
+
+    print(f"{'drafts':>7} {'tokens':>7} {'accepted':>9} {'tokens/pass':>12} {'tokens/s':>9}")
+    speech_tokens, elapsed = timed(t3, lambda: t3.inference(**kwargs, runaway_guard=False))
+    print(f"{'plain':>7} {speech_tokens.size(1):>7} {'-':>9} {1.0:>12.2f} {speech_tokens.size(1) / elapsed:>9.1f}")
+    for num_draft_tokens in args.draft_tokens:
+        decoder = T3SpeculativeDecoder(t3, num_draft_tokens=num_draft_tokens)
+        speech_tokens, elapsed = timed(t3, lambda: decoder.generate(**kwargs))
+        print(
+            f"{num_draft_tokens:>7} {speech_tokens.size(1):>7} {decoder.acceptance_rate:>9.1%} "
+            f"{decoder.tokens_per_step:>12.2f} {speech_tokens.size(1) / elapsed:>9.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+Per-token decode latency of T3 with the dynamic (growing) and the static (preallocated) KV cache.
+
+Uses randomly initialised weights, so no checkpoint download is needed; EOS is ignored so every run decodes
+exactly the requested number of tokens. With the static cache the per-token latency should stay flat
+between the 200 and 1000 token runs.
+
+    python benchmarks/t3_static_cache.py [--turbo] [--compile] [--device cpu]
+"""
+import argparse
+import time
+
+import torch
+
+from chatterbox.models.t3 import T3
+from chatterbox.models.t3.modules.cond_enc import T3Cond
+from chatterbox.models.t3.modules.t3_config import T3Config
+
+
+def build_t3(turbo, device):
+    if turbo:
+        hp = T3Config(text_tokens_dict_size=50276)
+        hp.llama_config_name = "GPT2_medium"
+        hp.speech_tokens_dict_size = 6563
+        hp.input_pos_emb = None
+        hp.speech_cond_prompt_len = 375
+        hp.use_perceiver_resampler = False
+        hp.emotion_adv = False
+    else:
+        hp = T3Config.english_only()
+    return T3(hp).to(device).eval()
+
+
+def random_inputs(t3, device, n_text_tokens=60):
+    hp = t3.hp
+    t3_cond = T3Cond(
+        speaker_emb=torch.randn(1, hp.speaker_embed_size),
+        cond_prompt_speech_tokens=torch.randint(0, 6561, (1, hp.speech_cond_prompt_len)),
+        emotion_adv=0.5 * torch.ones(1, 1, 1),
+    ).to(device=device)
+    text_tokens = torch.randint(1, hp.start_text_token, (1, n_text_tokens))
+    text_tokens[:, 0] = hp.start_text_token
+    text_tokens[:, -1] = hp.stop_text_token
+    return t3_cond, text_tokens.to(device)
+
+
+def time_generation(t3, t3_cond, text_tokens, n_tokens, cache_implementation, compile):
+    if t3.device.type == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    if t3.is_gpt:
+        # the turbo loop forwards `max_gen_len` tokens after the first sampled one
+        t3.inference_turbo(
+            t3_cond=t3_cond,
+            text_tokens=text_tokens,
+            max_gen_len=n_tokens - 1,
+            cache_implementation=cache_implementation,
+            compile=compile,
+            runaway_guard=False,
+        )
+    else:
+        t3.inference(
+            t3_cond=t3_cond,
+            text_tokens=torch.cat([text_tokens, text_tokens]),
+            max_new_tokens=n_tokens,
+            stop_on_eos=False,
+            runaway_guard=False,
+            cache_implementation=cache_implementation,
+            compile=compile,
+        )
+    if t3.device.type == "cuda":
+        torch.cuda.synchronize()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--turbo", action="store_true", help="benchmark the GPT2 (Turbo) backbone")
+    parser.add_argument("--compile", action="store_true", help="torch.compile the static decode step")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--lengths", type=int, nargs="+", default=[200, 1000])
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    t3 = build_t3(args.turbo, args.device)
+    if args.turbo:
+        # the turbo stop token is inside the sampled vocabulary; make sure it is never picked
+        t3.speech_head.bias.data[t3.hp.stop_speech_token] = -1e4
+    t3_cond, text_tokens = random_inputs(t3, args.device)
+
+    print(f"{'cache':>8} {'tokens':>7} {'total s':>8} {'ms/token':>9}")
+    for cache_implementation in ("dynamic", "static"):
+        compile = args.compile and cache_implementation == "static"
+        for n_tokens in args.lengths:
+            # warm up (and compile for this cache size) before timing
+            time_generation(t3, t3_cond, text_tokens, n_tokens if compile else 20, cache_implementation, compile)
+            elapsed = time_generation(t3, t3_cond, text_tokens, n_tokens, cache_implementation, compile)
+            print(f"{cache_implementation:>8} {n_tokens:>7} {elapsed:>8.2f} {1000 * elapsed / n_tokens:>9.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""
+Voice lookup in a `VoiceLibrary` (safetensors shards, memory-mapped, and an index) against one `Conditionals.save`
+file per voice read back with `Conditionals.load`, for N random voices: cold lookups (first read of each voice),
+warm lookups (resident LRU hits), and the growth of the resident memory (max RSS) of each.
+
+    python benchmarks/voice_library.py [--voices 2000] [--lookups 500] [--device cpu] [--dir /tmp/voices]
+"""
+import argparse
+import random
+import resource
+import shutil
+import tempfile
+import time
+from pathlib import Path
+
+import torch
+
+from chatterbox.models.t3.modules.cond_enc import T3Cond
+from chatterbox.tts import Conditionals
+from chatterbox.voice_library import VoiceLibrary
+from s3gen_batch import random_ref_dict
+
+
+def random_conditionals():
+    t3 = T3Cond(
+        speaker_emb=torch.randn(1, 256),
+        cond_prompt_speech_tokens=torch.randint(0, 6561, (1, 150)),
+        emotion_adv=0.5 * torch.ones(1, 1, 1),
+    )
+    return Conditionals(t3, random_ref_dict("cpu"))
+
+
+def max_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def timed_lookups(lookup, voice_ids, device):
+    rss = max_rss_mb()
+    start = time.perf_counter()
+    for voice_id in voice_ids:
+        lookup(voice_id)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    elapsed = time.perf_counter() - start
+    return 1000 * elapsed / len(voice_ids), max_rss_mb() - rss
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--voices", type=int, default=2000)
+    parser.add_argument("--shard-size", type=int, default=500, help="voices per `add` call")
+    parser.add_argument("--lookups", type=int, default=500)
+    parser.add_argument("--max-resident", type=int, default=256)
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--dir", help="where to write the voices (a temporary directory by default)")
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    random.seed(0)
+    device = torch.device(args.device)
+    root = Path(args.dir or tempfile.mkdtemp())
+    shutil.rmtree(root / "library", ignore_errors=True)
+    (root / "files").mkdir(parents=True, exist_ok=True)
+
+    library = VoiceLibrary(root / "library", device=args.device, max_resident=args.max_resident)
+    start = time.perf_counter()
+    voice_ids = [f"voice-{i:06d}" for i in range(args.voices)]
+    for i in range(0, args.voices, args.shard_size):
+        batch = {voice_id: random_conditionals() for voice_id in voice_ids[i:i + args.shard_size]}
+        library.add(batch)
+        for voice_id, conds in batch.items():
+            conds.save(root / "files" / f"{voice_id}.pt")
+    print(f"wrote {args.voices} voices in {time.perf_counter() - start:.1f}s")
+
+    cold_ids = random.sample(voice_ids, min(args.lookups, args.voices))
+    warm_ids = cold_ids[-min(args.max_resident, len(cold_ids)):]
+
+    def load_file(voice_id):
+        return Conditionals.load(root / "files" / f"{voice_id}.pt", map_location="cpu").to(args.device)
+
+    # a fresh library, so that no shard is open yet
+    library = VoiceLibrary(root / "library", device=args.device, max_resident=args.max_resident)
+    file_ms, file_rss = timed_lookups(load_file, cold_ids, device)
+    cold_ms, cold_rss = timed_lookups(library.get, cold_ids, device)
+    warm_ms, _ = timed_lookups(library.get, warm_ids, device)
+    print(f"Conditionals.load per file: {file_ms:.3f} ms/voice, max RSS +{file_rss:.0f} MB")
+    print(f"VoiceLibrary cold lookup: {cold_ms:.3f} ms/voice, max RSS +{cold_rss:.0f} MB")
+    print(f"VoiceLibrary warm lookup: {warm_ms:.4f} ms/voice, {library.resident.stats()}")
+
+    a, b = load_file(cold_ids[0]), library.get(cold_ids[0])
+    assert torch.equal(a.gen["prompt_feat"], b.gen["prompt_feat"])
+    assert torch.equal(a.t3.cond_prompt_speech_tokens, b.t3.cond_prompt_speech_tokens)
+    if not args.dir:
+        shutil.rmtree(root)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+"""
+Bulk voice enrollment: the conditionals of many reference clips, written to a `VoiceLibrary`.
+
+    python -m chatterbox.enroll --library voices/ clips/*.wav [--model tts|multilingual|turbo] [--device cuda]
+"""
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, List, Optional, Sequence
+
+import torch
+
+from .models.s3gen import S3GEN_SR
+from .models.s3tokenizer import S3_SR, S3_TOKEN_HOP
+from .models.t3.modules.cond_enc import T3Cond
+from .reference import ReferenceAudio
+from .voice_library import VoiceLibrary
+
+
+@torch.inference_mode()
+def batch_conditionals(tts, refs: List[ReferenceAudio], exaggeration=0.5, conds_cls=None):
+    """
+    The conditionals of `prepare_conditionals(wav_fpath, exaggeration)` (default S3Gen prompt) for a batch of
+    reference clips, with one S3 tokenizer, one CAMPPlus and one voice encoder pass for the whole batch. Only the
+    prompt mels are computed clip by clip.
+    """
+    if conds_cls is None:
+        from .tts import Conditionals as conds_cls
+    prompt_refs = [ref.head(max(tts.ENC_COND_LEN / S3_SR, tts.DEC_COND_LEN / S3GEN_SR)) for ref in refs]
+    s3gen_refs = [ref.head(tts.DEC_COND_LEN / S3GEN_SR) for ref in prompt_refs]
+
+    speech_tokens, speech_token_lens = tts.s3gen.tokenizer([ref.wav_16 for ref in prompt_refs])
+    x_vectors = tts.s3gen.speaker_encoder.inference([ref.wav_16.to(dtype=tts.s3gen.dtype) for ref in s3gen_refs])
+    ve_embeds = torch.from_numpy(tts.ve.embeds_from_wavs([ref.wav_16.cpu().numpy() for ref in refs], S3_SR))
+
+    conds = []
+    plen = tts.t3.hp.speech_cond_prompt_len
+    for i, s3gen_ref in enumerate(s3gen_refs):
+        tokens = speech_tokens[i:i + 1, :int(speech_token_lens[i])]
+        s3gen_ref_dict = tts.s3gen.embed_ref(
+            s3gen_ref.wav_24, S3GEN_SR, device=tts.device, ref_wav_16=s3gen_ref.wav_16, ref_speech_tokens=tokens,
+            ref_x_vector=x_vectors[i:i + 1],
+        )
+        t3_cond = T3Cond(
+            speaker_emb=ve_embeds[i:i + 1],
+            cond_prompt_speech_tokens=tokens[:, :min(plen, tts.ENC_COND_LEN // S3_TOKEN_HOP)] if plen else None,
+            emotion_adv=exaggeration * torch.ones(1, 1, 1),
+        ).to(device=tts.device)
+        conds.append(conds_cls(t3_cond, s3gen_ref_dict))
+    return conds
+
+
+def enroll_voices(
+    tts,
+    paths: Sequence,
+    library: VoiceLibrary,
+    voice_ids: Optional[Sequence[str]] = None,
+    exaggeration=0.5,
+    transform: Optional[Callable] = None,
+    batch_size: int = 16,
+    num_workers: int = 4,
+    shard_size: int = 1024,
+) -> List[str]:
+    """
+    Enrolls the reference clips `paths` of a TTS wrapper (`ChatterboxTTS`, `ChatterboxMultilingualTTS` or
+    `ChatterboxTurboTTS`) into `library`, under `voice_ids` (the file stems by default), and returns the ids.
+
+    The clips are decoded and resampled by `num_workers` threads, one batch ahead of the encoders, which run
+    `batch_size` clips at a time (see `batch_conditionals`); the library gets a shard every `shard_size` voices.
+    `transform` is the `ReferenceAudio.load` one, eg `tts.norm_loudness` for Turbo.
+    """
+    paths = list(paths)
+    voice_ids = [Path(path).stem for path in paths] if voice_ids is None else list(voice_ids)
+    assert len(voice_ids) == len(paths), "one voice id per path"
+
+    def load(path):
+        return ReferenceAudio.load(path, tts.device, transform=transform)
+
+    batches = [paths[i:i + batch_size] for i in range(0, len(paths), batch_size)]
+    pending = {}
+    with ThreadPoolExecutor(num_workers) as pool:
+        if batches:
+            loading = [pool.submit(load, path) for path in batches[0]]
+        for b in range(len(batches)):
+            refs = [future.result() for future in loading]
+            if b + 1 < len(batches):
+                loading = [pool.submit(load, path) for path in batches[b + 1]]
+            conds = batch_conditionals(tts, refs, exaggeration=exaggeration, conds_cls=library.conds_cls)
+            pending.update(zip(voice_ids[b * batch_size:(b + 1) * batch_size], conds))
+            if len(pending) >= shard_size or b + 1 == len(batches):
+                library.add(pending)
+                pending = {}
+    return voice_ids
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("paths", nargs="+", help="reference clips, one voice each (named after the file stem)")
+    parser.add_argument("--library", required=True, help="VoiceLibrary directory")
+    parser.add_argument("--model", choices=["tts", "multilingual", "turbo"], default="tts")
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--exaggeration", type=float, default=0.5)
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--num-workers", type=int, default=4)
+    parser.add_argument("--shard-size", type=int, default=1024)
+    args = parser.parse_args()
+
+    transform = None
+    if args.model == "tts":
+        from .tts import ChatterboxTTS, Conditionals
+        tts = ChatterboxTTS.from_pretrained(args.device)
+    elif args.model == "multilingual":
+        from .mtl_tts import ChatterboxMultilingualTTS, Conditionals
+        tts = ChatterboxMultilingualTTS.from_pretrained(args.device)
+    else:
+        from .tts_turbo import ChatterboxTurboTTS, Conditionals
+        tts = ChatterboxTurboTTS.from_pretrained(args.device)
+        transform = tts.norm_loudness
+
+    library = VoiceLibrary(args.library, device=args.device, conds_cls=Conditionals)
+    start = time.perf_counter()
+    voice_ids = enroll_voices(
+        tts, args.paths, library, exaggeration=args.exaggeration, transform=transform, batch_size=args.batch_size,
+        num_workers=args.num_workers, shard_size=args.shard_size,
+    )
+    elapsed = time.perf_counter() - start
+    print(f"enrolled {len(voice_ids)} voices in {elapsed:.1f}s ({len(voice_ids) / elapsed:.1f} voices/s), "
+          f"{len(library)} in {args.library}")
+
+
+if __name__ == "__main__":
+    main()
@@ -6,5 +6,6 @@ CFM_PARAMS = AttrDict({
     "t_scheduler": "cosine",
     "training_cfg_rate": 0.2,
     "inference_cfg_rate": 0.7,
+    "inference_cfg_interval": None,
     "reg_loss_type": "l1"
 })
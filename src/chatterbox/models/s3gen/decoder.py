@@ -240,7 +240,25 @@ class ConditionalDecoder(nn.Module):
                 if m.bias is not None:
                     nn.init.constant_(m.bias, 0)
 
-    def forward(self, x, mask, mu, t, spks=None, cond=None, r=None):
+    def attention_bias(self, x, mask, bias_cache=None):
+        """
+        Additive attention bias of the transformer blocks for `x` (B, T, C) and its `mask` (B, 1, T).
+
+        The mask does not change between the Euler steps of a flow solve, so the solver passes one `bias_cache`
+        dict per solve and the bias is built once per (rows, length, chunk size, dtype, device), instead of once per
+        block and step.
+        """
+        key = (x.size(0), x.size(1), self.static_chunk_size, x.dtype, x.device)
+        if bias_cache is not None and key in bias_cache:
+            return bias_cache[key]
+        # attn_mask = torch.matmul(mask.transpose(1, 2).contiguous(), mask)
+        attn_mask = add_optional_chunk_mask(x, mask.bool(), False, False, 0, self.static_chunk_size, -1)
+        attn_mask = mask_to_bias(attn_mask == 1, x.dtype)
+        if bias_cache is not None:
+            bias_cache[key] = attn_mask
+        return attn_mask
+
+    def forward(self, x, mask, mu, t, spks=None, cond=None, r=None, bias_cache=None):
         """Forward pass of the UNet1DConditional model.
 
         Args:
@@ -250,6 +268,7 @@ class ConditionalDecoder(nn.Module):
             spks (_type_, optional) Defaults to None.
             cond (_type_, optional)
             r: end time for meanflow mode (shape (1,) tensor)
+            bias_cache: dict shared by the calls of one flow solve, see `attention_bias`
 
         Raises:
             ValueError: _description_
@@ -281,9 +300,7 @@ class ConditionalDecoder(nn.Module):
             mask_down = masks[-1]
             x = resnet(x, mask_down, t)
             x = rearrange(x, "b c t -> b t c").contiguous()
-            # attn_mask = torch.matmul(mask_down.transpose(1, 2).contiguous(), mask_down)
-            attn_mask = add_optional_chunk_mask(x, mask_down.bool(), False, False, 0, self.static_chunk_size, -1)
-            attn_mask = mask_to_bias(attn_mask == 1, x.dtype)
+            attn_mask = self.attention_bias(x, mask_down, bias_cache)
             for transformer_block in transformer_blocks:
                 x = transformer_block(
                     hidden_states=x,
@@ -300,9 +317,7 @@ class ConditionalDecoder(nn.Module):
         for resnet, transformer_blocks in self.mid_blocks:
             x = resnet(x, mask_mid, t)
             x = rearrange(x, "b c t -> b t c").contiguous()
-            # attn_mask = torch.matmul(mask_mid.transpose(1, 2).contiguous(), mask_mid)
-            attn_mask = add_optional_chunk_mask(x, mask_mid.bool(), False, False, 0, self.static_chunk_size, -1)
-            attn_mask = mask_to_bias(attn_mask == 1, x.dtype)
+            attn_mask = self.attention_bias(x, mask_mid, bias_cache)
             for transformer_block in transformer_blocks:
                 x = transformer_block(
                     hidden_states=x,
@@ -317,9 +332,7 @@ class ConditionalDecoder(nn.Module):
             x = pack([x[:, :, :skip.shape[-1]], skip], "b * t")[0]
             x = resnet(x, mask_up, t)
             x = rearrange(x, "b c t -> b t c").contiguous()
-            # attn_mask = torch.matmul(mask_up.transpose(1, 2).contiguous(), mask_up)
-            attn_mask = add_optional_chunk_mask(x, mask_up.bool(), False, False, 0, self.static_chunk_size, -1)
-            attn_mask = mask_to_bias(attn_mask == 1, x.dtype)
+            attn_mask = self.attention_bias(x, mask_up, bias_cache)
             for transformer_block in transformer_blocks:
                 x = transformer_block(
                     hidden_states=x,
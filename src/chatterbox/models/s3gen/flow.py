@@ -21,6 +21,7 @@ import torch.nn as nn
 from torch.nn import functional as F
 from .utils.mask import make_pad_mask
 from .configs import CFM_PARAMS
+from .transformer.upsample_encoder import EncoderPromptCache
 from omegaconf import DictConfig
 
 
@@ -140,9 +141,11 @@ class CausalMaskedDiffWithXvec(torch.nn.Module):
                   finalize,
                   n_timesteps=10,
                   noised_mels=None,
-                  meanflow=False):
+                  meanflow=False,
+                  prompt_cache: Optional[EncoderPromptCache] = None):
         # token: (B, n_toks)
         # token_len: (B,)
+        # prompt_cache: `encode_prompt(prompt_token, prompt_token_len)`, to skip encoding most of the prompt again
         B = token.size(0)
 
         # xvec projection
@@ -157,8 +160,10 @@ class CausalMaskedDiffWithXvec(torch.nn.Module):
         prompt_feat_len = _repeat_batch_dim(prompt_feat_len, B, ndim=1)  # (B,) or None
         embedding = _repeat_batch_dim(embedding, B, ndim=2)  # (B, emb_dim)
 
-        # concat text and prompt_text
-        token, token_len = torch.concat([prompt_token, token], dim=1), prompt_token_len + token_len
+        # concat text and prompt_text; the cached prompt tokens are left out
+        n_cached = 0 if prompt_cache is None else prompt_cache.n_tokens
+        token = torch.concat([prompt_token[:, n_cached:], token], dim=1)
+        token_len = prompt_token_len - n_cached + token_len
         mask = (~make_pad_mask(token_len)).unsqueeze(-1).to(embedding)
 
         if (token >= self.vocab_size).any():
@@ -166,7 +171,12 @@ class CausalMaskedDiffWithXvec(torch.nn.Module):
         token = self.input_embedding(token.long()) * mask
 
         # text encode
-        h, h_masks = self.encoder(token, token_len)
+        if prompt_cache is None:
+            h, h_masks = self.encoder(token, token_len)
+        else:
+            h, h_masks = self.encoder.forward_with_prompt_cache(token, token_len, prompt_cache)
+            h = torch.concat([prompt_cache.output.expand(B, -1, -1), h], dim=1)
+            h_masks = F.pad(h_masks, (prompt_cache.output.size(1), 0), value=True)
         if finalize is False:
             h = h[:, :-self.pre_lookahead_len * self.token_mel_ratio]
 
@@ -196,3 +206,83 @@ class CausalMaskedDiffWithXvec(torch.nn.Module):
         feat = feat[:, :, mel_len1:]
         assert feat.shape[2] == mel_len2
         return feat, None  # NOTE jrm: why are they returning None here?
+
+    @torch.inference_mode()
+    def encode_prompt(self, prompt_token, prompt_token_len) -> EncoderPromptCache:
+        """
+        Encoder state of a voice's prompt tokens (1, n_prompt), for `inference(prompt_cache=...)`.
+
+        NOTE: the encoder attends over the full context, so in a regular call the prompt positions also see the
+        tokens that follow. With the cache they only see the prompt, which changes the mels slightly.
+        """
+        prompt_token = torch.atleast_2d(prompt_token).long()
+        prompt_token_len = torch.atleast_1d(prompt_token_len).to(prompt_token.device)
+        return self.encoder.prompt_cache(self.input_embedding(prompt_token), prompt_token_len)
+
+    @torch.inference_mode()
+    def inference_batch(self,
+                        token,
+                        token_len,
+                        prompt_token,
+                        prompt_token_len,
+                        prompt_feat,
+                        prompt_feat_len,
+                        embedding,
+                        n_timesteps=10,
+                        meanflow=False):
+        """
+        Finalized `inference` over a padded batch where every row may have its own prompt (voice) and length.
+
+        token: (B, n_toks) right-padded, token_len: (B,)
+        prompt_token: (B, n_prompt) right-padded, prompt_token_len: (B,)
+        prompt_feat: (B, n_feat, 80) right-padded, prompt_feat_len: (B,)
+        embedding: (B, emb_dim)
+
+        Returns the generated mels, right-padded to (B, 80, max mel_len2), and their lengths mel_len2 (B,).
+        """
+        B = token.size(0)
+        device = token.device
+
+        # xvec projection
+        embedding = F.normalize(embedding, dim=1)
+        embedding = self.spk_embed_affine_layer(embedding)  # (B, emb_dim)
+
+        # concat prompt and tokens row by row, so the padding of a short prompt does not sit between them
+        token_len = prompt_token_len + token_len
+        combined = torch.zeros(B, int(token_len.max()), dtype=torch.long, device=device)
+        for i in range(B):
+            n_prompt = int(prompt_token_len[i])
+            combined[i, :n_prompt] = prompt_token[i, :n_prompt]
+            combined[i, n_prompt:token_len[i]] = token[i, :token_len[i] - n_prompt]
+        mask = (~make_pad_mask(token_len)).unsqueeze(-1).to(embedding)
+
+        if (combined >= self.vocab_size).any():
+            logger.error(f"{combined.max()}>{self.vocab_size}\n out-of-range special tokens found in flow, fix inputs!")
+        combined = self.input_embedding(combined) * mask
+
+        # text encode
+        h, h_masks = self.encoder(combined, token_len)
+        h_lengths = h_masks.sum(dim=-1).squeeze(dim=-1)
+        h = self.encoder_proj(h)
+
+        # get conditions, each row's prompt mels in front of its own generated frames
+        conds = torch.zeros([B, h.size(1), self.output_size], device=device).to(h.dtype)
+        for i in range(B):
+            conds[i, :prompt_feat_len[i]] = prompt_feat[i, :prompt_feat_len[i]]
+        conds = conds.transpose(1, 2)
+
+        mask = (~make_pad_mask(h_lengths, h.size(1))).unsqueeze(1).to(h)
+        feat, _ = self.decoder(
+            mu=h.transpose(1, 2).contiguous(),
+            mask=mask,
+            spks=embedding,
+            cond=conds,
+            n_timesteps=n_timesteps,
+            meanflow=meanflow,
+        )
+
+        mel_len2 = h_lengths - prompt_feat_len
+        out = feat.new_zeros(B, feat.size(1), int(mel_len2.max()))
+        for i in range(B):
+            out[i, :, :mel_len2[i]] = feat[i, :, prompt_feat_len[i]:h_lengths[i]]
+        return out, mel_len2
@@ -34,6 +34,8 @@ class ConditionalCFM(BASECFM):
         self.t_scheduler = cfm_params.t_scheduler
         self.training_cfg_rate = cfm_params.training_cfg_rate
         self.inference_cfg_rate = cfm_params.inference_cfg_rate
+        # (t_start, t_end): only steps starting in this range of t_span apply CFG, None for all steps
+        self.inference_cfg_interval = cfm_params.get("inference_cfg_interval")
         in_channels = in_channels + (spk_emb_dim if n_spks > 0 else 0)
         # Just change the architecture of the estimator here
         self.estimator = estimator
@@ -75,6 +77,20 @@ class ConditionalCFM(BASECFM):
             t_span = 1 - torch.cos(t_span * 0.5 * torch.pi)
         return self.solve_euler(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond), flow_cache
 
+    def cfg_steps(self, t_span):
+        """
+        Whether each step of `t_span` applies CFG (estimator on the cond and uncond rows) or runs the estimator on
+        the cond rows only: steps starting inside `inference_cfg_interval`, all steps if it is None, none if
+        `inference_cfg_rate` is 0.
+        """
+        n_steps = len(t_span) - 1
+        if self.inference_cfg_rate == 0:
+            return [False] * n_steps
+        if self.inference_cfg_interval is None:
+            return [True] * n_steps
+        t_start, t_end = self.inference_cfg_interval
+        return [t_start <= t < t_end for t in t_span[:-1].tolist()]
+
     def solve_euler(self, x, t_span, mu, mask, spks, cond, meanflow=False):
         """
         Fixed euler solver for ODEs.
@@ -105,43 +121,51 @@ class ConditionalCFM(BASECFM):
         cond_in = torch.zeros([2 * B, 80, T], device=x.device, dtype=x.dtype)
         r_in    = torch.zeros([2 * B       ], device=x.device, dtype=x.dtype) # (only used for meanflow)
 
-        for t, r in zip(t_span[:-1], t_span[1:]):
+        # Shapes:
+        #      x_in  ( 2B, 80, T )
+        #   mask_in  ( 2B,  1, T )
+        #     mu_in  ( 2B, 80, T )
+        #      t_in  ( 2B,       )
+        #   spks_in  ( 2B, 80,   )
+        #   cond_in  ( 2B, 80, T )
+        #      r_in  ( 2B,       )
+        #         x  (  B, 80, T )
+        #      mask  (  B,  1, T )
+        #        mu  (  B, 80, T )
+        #         t  (  B,       )
+        #      spks  (  B, 80,   )
+        #      cond  (  B, 80, T )
+        #         r  (  B,       )
+
+        # only x, t and r change between steps; the uncond halves of mu, spks and cond stay zero
+        mask_in[:B] = mask_in[B:] = mask
+        mu_in[:B] = mu
+        spks_in[:B] = spks
+        cond_in[:B] = cond
+
+        # the masks are the same at every step, build the attention bias once
+        bias_cache = {}
+        for t, r, use_cfg in zip(t_span[:-1], t_span[1:], self.cfg_steps(t_span)):
             t = t.unsqueeze(dim=0)
             r = r.unsqueeze(dim=0)
-            # Shapes:
-            #      x_in  ( 2B, 80, T )
-            #   mask_in  ( 2B,  1, T )
-            #     mu_in  ( 2B, 80, T )
-            #      t_in  ( 2B,       )
-            #   spks_in  ( 2B, 80,   )
-            #   cond_in  ( 2B, 80, T )
-            #      r_in  ( 2B,       )
-            #         x  (  B, 80, T )
-            #      mask  (  B,  1, T )
-            #        mu  (  B, 80, T )
-            #         t  (  B,       )
-            #      spks  (  B, 80,   )
-            #      cond  (  B, 80, T )
-            #         r  (  B,       )
-
-            x_in[:B] = x_in[B:] = x
-            mask_in[:B] = mask_in[B:] = mask
-            mu_in[:B] = mu
-            t_in[:B] = t_in[B:] = t
-            spks_in[:B] = spks
-            cond_in[:B] = cond
-            r_in[:B] = r_in[B:] = r # (only used for meanflow)
-            dxdt = self.estimator.forward(
-                x=x_in, mask=mask_in, mu=mu_in, t=t_in, spks=spks_in, cond=cond_in,
-                r=r_in if meanflow else None,
-            )
-            dxdt, cfg_dxdt = torch.split(dxdt, [B, B], dim=0)
-            dxdt = ((1.0 + self.inference_cfg_rate) * dxdt - self.inference_cfg_rate * cfg_dxdt)
+            t_in[:] = t
+            r_in[:] = r # (only used for meanflow)
+            if use_cfg:
+                x_in[:B] = x_in[B:] = x
+                dxdt = self.estimator.forward(
+                    x=x_in, mask=mask_in, mu=mu_in, t=t_in, spks=spks_in, cond=cond_in,
+                    r=r_in if meanflow else None, bias_cache=bias_cache,
+                )
+                dxdt, cfg_dxdt = torch.split(dxdt, [B, B], dim=0)
+                dxdt = ((1.0 + self.inference_cfg_rate) * dxdt - self.inference_cfg_rate * cfg_dxdt)
+            else:
+                dxdt = self.estimator.forward(
+                    x=x, mask=mask, mu=mu, t=t_in[:B], spks=spks, cond=cond,
+                    r=r_in[:B] if meanflow else None, bias_cache=bias_cache,
+                )
             dt = r - t
             x = x + dt * dxdt
 
-
-
         return x.to(in_dtype)
 
     def compute_loss(self, x1, mask, mu, spks=None, cond=None):
@@ -237,9 +261,10 @@ class CausalConditionalCFM(ConditionalCFM):
         x, t_span, mu, mask, spks, cond = cast_all(x, t_span, mu, mask, spks, cond, dtype=self.estimator.dtype)
 
         print("S3 Token -> Mel Inference...")
+        bias_cache = {}
         for t, r in tqdm(zip(t_span[..., :-1], t_span[..., 1:]), total=t_span.shape[-1] - 1):
             t, r = t[None], r[None]
-            dxdt = self.estimator.forward(x, mask=mask, mu=mu, t=t, spks=spks, cond=cond, r=r)
+            dxdt = self.estimator.forward(x, mask=mask, mu=mu, t=t, spks=spks, cond=cond, r=r, bias_cache=bias_cache)
             dt = r - t
             x = x + dt * dxdt
 
@@ -24,9 +24,8 @@ import torch
 import torch.nn.functional as F
 from torch.nn import Conv1d
 from torch.nn import ConvTranspose1d
-from torch.nn.utils import remove_weight_norm
+from torch.nn.utils.parametrize import is_parametrized, remove_parametrizations
 from torch.nn.utils.parametrizations import weight_norm
-from torch.distributions.uniform import Uniform
 from torch import nn, sin, pow
 from torch.nn import Parameter
 
@@ -69,6 +68,17 @@ class Snake(nn.Module):
         self.alpha.requires_grad = alpha_trainable
 
         self.no_div_by_zero = 0.000000001
+        # alpha and 1 / alpha lined up with x, precomputed by fuse_for_inference()
+        self.register_buffer("fused_alpha", None, persistent=False)
+        self.register_buffer("fused_inv_alpha", None, persistent=False)
+
+    @torch.no_grad()
+    def fuse_for_inference(self):
+        alpha = self.alpha.detach().unsqueeze(0).unsqueeze(-1)
+        if self.alpha_logscale:
+            alpha = torch.exp(alpha)
+        self.fused_alpha = alpha
+        self.fused_inv_alpha = 1.0 / (alpha + self.no_div_by_zero)
 
     def forward(self, x):
         '''
@@ -76,6 +86,8 @@ class Snake(nn.Module):
         Applies the function to the input elementwise.
         Snake ∶= x + 1/a * sin^2 (xa)
         '''
+        if self.fused_alpha is not None:
+            return torch.addcmul(x, self.fused_inv_alpha, sin(x * self.fused_alpha).pow_(2))
         alpha = self.alpha.unsqueeze(0).unsqueeze(-1) # line up with x to [B, C, T]
         if self.alpha_logscale:
             alpha = torch.exp(alpha)
@@ -85,6 +97,12 @@ class Snake(nn.Module):
 
 
 
+def remove_weight_norm(module):
+    """Folds the `weight_norm` parametrization of `module` into a plain weight; no-op without one."""
+    if is_parametrized(module, "weight"):
+        remove_parametrizations(module, "weight")
+
+
 def get_padding(kernel_size, dilation=1):
     return int((kernel_size * dilation - dilation) / 2)
 
@@ -184,50 +202,63 @@ class SineGen(torch.nn.Module):
 
     def __init__(self, samp_rate, harmonic_num=0,
                  sine_amp=0.1, noise_std=0.003,
-                 voiced_threshold=0):
+                 voiced_threshold=0, float64_phase=False):
         super(SineGen, self).__init__()
         self.sine_amp = sine_amp
         self.noise_std = noise_std
         self.harmonic_num = harmonic_num
         self.sampling_rate = samp_rate
         self.voiced_threshold = voiced_threshold
+        # accumulate the phase in float64, for long outputs
+        self.float64_phase = float64_phase
 
     def _f02uv(self, f0):
         # generate uv signal
         uv = (f0 > self.voiced_threshold).type(torch.float32)
         return uv
 
+    def _phase(self, f0, upsample_scale):
+        """Phase of the fundamental in cycles, wrapped to [0, 1): (B, 1, sample_len), float32."""
+        f0 = f0.to(torch.float64 if self.float64_phase else torch.float32) / self.sampling_rate  # cycles per sample
+        if upsample_scale == 1:
+            return (torch.cumsum(f0, dim=-1) % 1).float()
+        # f0 is constant over each frame: accumulate per frame, then ramp within frames
+        frame_start = F.pad(torch.cumsum(f0 * upsample_scale, dim=-1)[..., :-1], (1, 0)) % 1
+        ramp = torch.arange(1, upsample_scale + 1, device=f0.device, dtype=f0.dtype)
+        phase = (frame_start[..., None] + f0[..., None] * ramp) % 1  # (B, 1, frame_len, upsample_scale)
+        return phase.flatten(2).float()
+
     @torch.no_grad()
-    def forward(self, f0):
+    def forward(self, f0, upsample_scale: int = 1):
         """
-        :param f0: [B, 1, sample_len], Hz
-        :return: [B, 1, sample_len]
+        :param f0: [B, 1, sample_len], Hz, or [B, 1, frame_len] with `upsample_scale` samples per frame
+            (nearest upsampling, done here without materializing the upsampled f0 phase)
+        :return: [B, harmonic_num + 1, sample_len]
         """
-
-        F_mat = torch.zeros((f0.size(0), self.harmonic_num + 1, f0.size(-1))).to(f0.device)
-        for i in range(self.harmonic_num + 1):
-            F_mat[:, i: i + 1, :] = f0 * (i + 1) / self.sampling_rate
-
-        theta_mat = 2 * np.pi * (torch.cumsum(F_mat, dim=-1) % 1)
-        u_dist = Uniform(low=-np.pi, high=np.pi)
-        phase_vec = u_dist.sample(sample_shape=(f0.size(0), self.harmonic_num + 1, 1)).to(F_mat.device)
+        # all harmonics from the phase of the fundamental: cumsum(f0 * k) % 1 == (k * (cumsum(f0) % 1)) % 1
+        harmonics = torch.arange(1, self.harmonic_num + 2, device=f0.device, dtype=torch.float32)[None, :, None]
+        theta_mat = 2 * np.pi * ((self._phase(f0, upsample_scale) * harmonics) % 1)
+        # drawn from the CPU generator, as the previous Uniform(-pi, pi) was, so seeded outputs match on any device
+        phase_vec = (torch.rand(f0.size(0), self.harmonic_num + 1, 1) * (2 * np.pi) - np.pi).to(f0.device)
         phase_vec[:, 0, :] = 0
 
         # generate sine waveforms
-        sine_waves = self.sine_amp * torch.sin(theta_mat + phase_vec)
+        sine_waves = theta_mat.add_(phase_vec).sin_().mul_(self.sine_amp)
 
         # generate uv signal
         uv = self._f02uv(f0)
+        if upsample_scale > 1:
+            uv = uv.repeat_interleave(upsample_scale, dim=-1)
 
         # noise: for unvoiced should be similar to sine_amp
         #        std = self.sine_amp/3 -> max value ~ self.sine_amp
         # .       for voiced regions is self.noise_std
         noise_amp = uv * self.noise_std + (1 - uv) * self.sine_amp / 3
-        noise = noise_amp * torch.randn_like(sine_waves)
+        noise = torch.randn_like(sine_waves).mul_(noise_amp)
 
         # first: set the unvoiced part to 0 by uv
         # then: additive noise
-        sine_waves = sine_waves * uv + noise
+        sine_waves = sine_waves.mul_(uv).add_(noise)
         return sine_waves, uv, noise
 
 
@@ -264,16 +295,16 @@ class SourceModuleHnNSF(torch.nn.Module):
         self.l_linear = torch.nn.Linear(harmonic_num + 1, 1)
         self.l_tanh = torch.nn.Tanh()
 
-    def forward(self, x):
+    def forward(self, x, upsample_scale: int = 1):
         """
         Sine_source, noise_source = SourceModuleHnNSF(F0_sampled)
-        F0_sampled (batchsize, length, 1)
+        F0_sampled (batchsize, length, 1), or (batchsize, length / upsample_scale, 1) at frame rate
         Sine_source (batchsize, length, 1)
         noise_source (batchsize, length 1)
         """
         # source for harmonic branch
         with torch.no_grad():
-            sine_wavs, uv, _ = self.l_sin_gen(x.transpose(1, 2))
+            sine_wavs, uv, _ = self.l_sin_gen(x.transpose(1, 2), upsample_scale)
             sine_wavs = sine_wavs.transpose(1, 2)
             uv = uv.transpose(1, 2)
         sine_merge = self.l_tanh(self.l_linear(sine_wavs))
@@ -387,11 +418,19 @@ class HiFTGenerator(nn.Module):
             l.remove_weight_norm()
         remove_weight_norm(self.conv_pre)
         remove_weight_norm(self.conv_post)
-        self.m_source.remove_weight_norm()
         for l in self.source_downs:
             remove_weight_norm(l)
         for l in self.source_resblocks:
             l.remove_weight_norm()
+        for l in self.f0_predictor.condnet:
+            remove_weight_norm(l)
+
+    def fuse_for_inference(self):
+        """Removes the weight norm and precomputes the Snake constants; the weights can't be trained afterwards."""
+        self.remove_weight_norm()
+        for m in self.modules():
+            if isinstance(m, Snake):
+                m.fuse_for_inference()
 
     def _stft(self, x):
         spec = torch.stft(
@@ -451,9 +490,8 @@ class HiFTGenerator(nn.Module):
         speech_feat = batch['speech_feat'].transpose(1, 2).to(device)
         # mel->f0
         f0 = self.f0_predictor(speech_feat)
-        # f0->source
-        s = self.f0_upsamp(f0[:, None]).transpose(1, 2)  # bs,n,t
-        s, _, _ = self.m_source(s)
+        # f0->source, upsampled to the sample rate inside the source module
+        s, _, _ = self.m_source(f0[:, :, None], upsample_scale=int(self.f0_upsamp.scale_factor))
         s = s.transpose(1, 2)
         # mel+source->speech
         generated_speech = self.decode(x=speech_feat, s=s)
@@ -463,9 +501,8 @@ class HiFTGenerator(nn.Module):
     def inference(self, speech_feat: torch.Tensor, cache_source: torch.Tensor = torch.zeros(1, 1, 0)) -> torch.Tensor:
         # mel->f0
         f0 = self.f0_predictor(speech_feat)
-        # f0->source
-        s = self.f0_upsamp(f0[:, None]).transpose(1, 2)  # bs,n,t
-        s, _, _ = self.m_source(s)
+        # f0->source, upsampled to the sample rate inside the source module
+        s, _, _ = self.m_source(f0[:, :, None], upsample_scale=int(self.f0_upsamp.scale_factor))
         s = s.transpose(1, 2)
         # use cache_source to avoid glitch
         if cache_source.shape[2] != 0:
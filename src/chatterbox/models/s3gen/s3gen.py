@@ -18,9 +18,10 @@ import numpy as np
 import torch
 import torchaudio as ta
 from functools import lru_cache
-from typing import Optional
+from typing import List, Optional, Union
+from torch.nn.utils.rnn import pad_sequence
 
-from ..s3tokenizer import S3_SR, SPEECH_VOCAB_SIZE, S3Tokenizer
+from ..s3tokenizer import S3_SR, S3_TOKEN_RATE, SPEECH_VOCAB_SIZE, S3Tokenizer
 from .const import S3GEN_SR
 from .flow import CausalMaskedDiffWithXvec
 from .xvector import CAMPPlus
@@ -38,6 +39,31 @@ def drop_invalid_tokens(x):
     return x[x < SPEECH_VOCAB_SIZE]
 
 
+def prompt_segment_start(wav: torch.Tensor, sr: int, max_len: int, frame_s=0.02, silence_db=-40.0) -> int:
+    """
+    Start of the `max_len` samples of `wav` (L,) or (1, L) with the most voiced frames, ie frames whose RMS is
+    within `silence_db` of the loudest one, so that a shorter prompt is not spent on pauses. Ties go to the
+    earliest window; 0 if `wav` is not longer than `max_len`. The window spans at least one frame.
+    """
+    if wav.size(-1) <= max_len:
+        return 0
+    frame_len = int(frame_s * sr)
+    n_frames = wav.size(-1) // frame_len
+    frames = wav.reshape(-1)[:n_frames * frame_len].view(n_frames, frame_len)
+    db = 10 * torch.log10(frames.float().pow(2).mean(dim=1) + 1e-10)
+    voiced = (db > db.max() + silence_db).float()
+
+    win = max(max_len // frame_len, 1)
+    counts = torch.nn.functional.pad(voiced.cumsum(0), (1, 0))
+    return int((counts[win:] - counts[:-win]).argmax()) * frame_len
+
+
+def select_prompt_segment(wav: torch.Tensor, sr: int, max_len: int, frame_s=0.02, silence_db=-40.0):
+    """The most voiced `max_len` samples of `wav`, see `prompt_segment_start`."""
+    start = prompt_segment_start(wav, sr, max_len, frame_s=frame_s, silence_db=silence_db)
+    return wav[..., start:start + max_len]
+
+
 # TODO: global resampler cache
 @lru_cache(100)
 def get_resampler(src_sr, dst_sr, device):
@@ -121,10 +147,37 @@ class S3Token2Mel(torch.nn.Module):
         ref_sr: int,
         device="auto",
         ref_fade_out=True,
+        cache_prompt=False,
+        prompt_budget_s: Optional[float] = None,
+        ref_wav_16: Optional[torch.Tensor] = None,
+        ref_speech_tokens: Optional[torch.Tensor] = None,
+        ref_x_vector: Optional[torch.Tensor] = None,
     ):
+        """
+        Reference conditionals of S3Gen. With `prompt_budget_s`, a longer `ref_wav` is cut to its most voiced
+        window of that length (see `prompt_segment_start`): the prompt mels and tokens run through the flow
+        encoder and every CFM step, so a shorter prompt lowers the latency of every call.
+
+        `ref_wav_16` (the same clip at S3_SR) and `ref_speech_tokens` (1, T) (its S3 tokens from its start, possibly
+        over more audio) are reused instead of being computed again, see `ReferenceAudio`, and so is `ref_x_vector`
+        (1, 192), the speaker embedding of the prompt (eg from a batched `speaker_encoder.inference`).
+        """
         device = self.device if device == "auto" else device
         if isinstance(ref_wav, np.ndarray):
             ref_wav = torch.from_numpy(ref_wav).float()
+        if isinstance(ref_wav_16, np.ndarray):
+            ref_wav_16 = torch.from_numpy(ref_wav_16).float()
+
+        # whole 40 ms token frames, so that the mels are exactly twice the tokens
+        token_len = ref_sr // S3_TOKEN_RATE
+        start = 0
+        if prompt_budget_s is not None:
+            max_len = int(prompt_budget_s * ref_sr) // token_len * token_len
+            assert max_len > 0, f"prompt_budget_s={prompt_budget_s} is shorter than one token ({1 / S3_TOKEN_RATE}s)"
+            start = prompt_segment_start(ref_wav, ref_sr, max_len, frame_s=1 / S3_TOKEN_RATE)
+            ref_wav = ref_wav[..., start:start + max_len]
+            if ref_wav_16 is not None:
+                ref_wav_16 = ref_wav_16[..., start * S3_SR // ref_sr:(start + max_len) * S3_SR // ref_sr]
 
         if ref_wav.device != device:
             ref_wav = ref_wav.to(device)
@@ -144,15 +197,25 @@ class S3Token2Mel(torch.nn.Module):
         ref_mels_24_len = None
 
         # Resample to 16kHz
-        ref_wav_16 = ref_wav
-        if ref_sr != S3_SR:
+        if ref_wav_16 is not None:
+            ref_wav_16 = torch.atleast_2d(ref_wav_16).to(device)
+        elif ref_sr != S3_SR:
             ref_wav_16 = get_resampler(ref_sr, S3_SR, device)(ref_wav)
+        else:
+            ref_wav_16 = ref_wav
 
         # Speaker embedding
-        ref_x_vector = self.speaker_encoder.inference(ref_wav_16.to(dtype=self.dtype))
+        if ref_x_vector is None:
+            ref_x_vector = self.speaker_encoder.inference(ref_wav_16.to(dtype=self.dtype))
+        ref_x_vector = ref_x_vector.to(device)
 
         # Tokenize 16khz reference
-        ref_speech_tokens, ref_speech_token_lens = self.tokenizer(ref_wav_16.float())
+        if ref_speech_tokens is None:
+            ref_speech_tokens, ref_speech_token_lens = self.tokenizer(ref_wav_16.float())
+        else:
+            ref_speech_tokens = torch.atleast_2d(ref_speech_tokens)[:, start // token_len:]
+            ref_speech_tokens = ref_speech_tokens[:, :ref_mels_24.shape[1] // 2]
+            ref_speech_token_lens = torch.tensor([ref_speech_tokens.shape[1]], device=ref_speech_tokens.device)
 
         # Make sure mel_len = 2 * stoken_len (happens when the input is not padded to multiple of 40ms)
         if ref_mels_24.shape[1] != 2 * ref_speech_tokens.shape[1]:
@@ -162,13 +225,51 @@ class S3Token2Mel(torch.nn.Module):
             ref_speech_tokens = ref_speech_tokens[:, :ref_mels_24.shape[1] // 2]
             ref_speech_token_lens[0] = ref_speech_tokens.shape[1]
 
-        return dict(
+        ref_dict = dict(
             prompt_token=ref_speech_tokens.to(device),
             prompt_token_len=ref_speech_token_lens,
             prompt_feat=ref_mels_24,
             prompt_feat_len=ref_mels_24_len,
             embedding=ref_x_vector,
         )
+        if cache_prompt:
+            self.cache_prompt(ref_dict)
+        return ref_dict
+
+    def cache_prompt(self, ref_dict: dict):
+        """
+        Adds the flow encoder state of the prompt tokens to `ref_dict` (as "prompt_cache"), so that every
+        call with this `ref_dict` only encodes the new tokens. It is not exact: see `flow.encode_prompt`.
+        """
+        self._cast_ref_dict(ref_dict)
+        ref_dict["prompt_cache"] = self.flow.encode_prompt(ref_dict["prompt_token"], ref_dict["prompt_token_len"])
+        return ref_dict
+
+    def _cast_ref_dict(self, ref_dict: dict):
+        # type/device casting (all values will be numpy if it's from a prod API call)
+        for rk in list(ref_dict):
+            if isinstance(ref_dict[rk], np.ndarray):
+                ref_dict[rk] = torch.from_numpy(ref_dict[rk])
+            if torch.is_tensor(ref_dict[rk]):
+                ref_dict[rk] = ref_dict[rk].to(device=self.device, dtype=self.dtype)
+        return ref_dict
+
+    def _batch_ref_dicts(self, ref_dicts: List[dict]):
+        """Stacks the prompts of `ref_dicts` (one per row) into right-padded tensors, see `flow.inference_batch`."""
+        prompt_tokens, prompt_feats, embeddings = [], [], []
+        for ref_dict in ref_dicts:
+            ref_dict = self._cast_ref_dict(ref_dict)
+            prompt_tokens.append(torch.atleast_2d(ref_dict["prompt_token"])[0].long())
+            prompt_feat = ref_dict["prompt_feat"]
+            prompt_feats.append(prompt_feat[0] if prompt_feat.ndim == 3 else prompt_feat)
+            embeddings.append(torch.atleast_2d(ref_dict["embedding"])[0])
+        return dict(
+            prompt_token=pad_sequence(prompt_tokens, batch_first=True),
+            prompt_token_len=torch.tensor([len(t) for t in prompt_tokens], device=self.device),
+            prompt_feat=pad_sequence(prompt_feats, batch_first=True),
+            prompt_feat_len=torch.tensor([len(f) for f in prompt_feats], device=self.device),
+            embedding=torch.stack(embeddings),
+        )
 
     def forward(
         self,
@@ -204,12 +305,7 @@ class S3Token2Mel(torch.nn.Module):
         if ref_dict is None:
             ref_dict = self.embed_ref(ref_wav, ref_sr)
         else:
-            # type/device casting (all values will be numpy if it's from a prod API call)
-            for rk in list(ref_dict):
-                if isinstance(ref_dict[rk], np.ndarray):
-                    ref_dict[rk] = torch.from_numpy(ref_dict[rk])
-                if torch.is_tensor(ref_dict[rk]):
-                    ref_dict[rk] = ref_dict[rk].to(device=self.device, dtype=self.dtype)
+            self._cast_ref_dict(ref_dict)
 
         speech_tokens = torch.atleast_2d(speech_tokens)
 
@@ -286,7 +382,7 @@ class S3Token2Wav(S3Token2Mel):
         if skip_vocoder:
             return output_mels
 
-        # TODO jrm: ignoring the speed control (mel interpolation) and the HiFTGAN caching mechanisms for now.
+        # TODO jrm: ignoring the speed control (mel interpolation) for now. HiFT caching is done by `S3GenStreamer`.
         hift_cache_source = torch.zeros(1, 1, 0).to(self.device)
 
         output_wavs, *_ = self.mel2wav.inference(speech_feat=output_mels, cache_source=hift_cache_source)
@@ -297,6 +393,24 @@ class S3Token2Wav(S3Token2Mel):
 
         return output_wavs
 
+    @torch.no_grad()
+    def fuse_for_inference(self):
+        """
+        Folds the training-time structure out of the inference graph, in place: the vocoder's weight norm and
+        Snake constants (`HiFTGenerator.fuse_for_inference`), the speaker encoder's BatchNorms into the convs
+        before them (`CAMPPlus.fuse_for_inference`), and the dropout modules, which are identities in eval mode.
+        Outputs match the unfused model up to float rounding. The model can't be trained, nor a checkpoint loaded
+        into it, afterwards.
+        """
+        assert not self.training, "fuse_for_inference() needs eval mode"
+        self.mel2wav.fuse_for_inference()
+        self.speaker_encoder.fuse_for_inference()
+        for module in list(self.modules()):
+            for name, child in module.named_children():
+                if isinstance(child, torch.nn.Dropout):
+                    setattr(module, name, torch.nn.Identity())
+        return self
+
     @torch.inference_mode()
     def flow_inference(
         self,
@@ -309,14 +423,14 @@ class S3Token2Wav(S3Token2Mel):
         n_cfm_timesteps = None,
         finalize: bool = False,
         speech_token_lens=None,
+        noised_mels=None,
     ):
         n_cfm_timesteps = n_cfm_timesteps or (2 if self.meanflow else 10)
-        noise = None
-        if self.meanflow:
-            noise = torch.randn(1, 80, speech_tokens.size(-1) * 2, dtype=self.dtype, device=self.device)
+        if self.meanflow and noised_mels is None:
+            noised_mels = torch.randn(1, 80, speech_tokens.size(-1) * 2, dtype=self.dtype, device=self.device)
         output_mels = super().forward(
             speech_tokens, speech_token_lens=speech_token_lens, ref_wav=ref_wav, ref_sr=ref_sr, ref_dict=ref_dict,
-            n_cfm_timesteps=n_cfm_timesteps, finalize=finalize, noised_mels=noise,
+            n_cfm_timesteps=n_cfm_timesteps, finalize=finalize, noised_mels=noised_mels,
         )
         return output_mels
 
@@ -360,3 +474,52 @@ class S3Token2Wav(S3Token2Mel):
         output_wavs[:, :len(self.trim_fade)] *= self.trim_fade
 
         return output_wavs, output_sources
+
+    @torch.inference_mode()
+    def inference_batch(
+        self,
+        speech_tokens: List[torch.Tensor],
+        ref_dicts: Union[dict, List[dict]],
+        n_cfm_timesteps=None,
+    ):
+        """
+        Finalized `inference` for many utterances at once: the token sequences, of any lengths, are right-padded
+        into a single masked flow pass and a single vocoder pass.
+
+        Args
+        ----
+        - `speech_tokens`: one 1D tensor of valid S3 speech tokens per utterance (see `drop_invalid_tokens`)
+        - `ref_dicts`: one `embed_ref` output shared by all utterances, or one per utterance
+
+        Returns one wav (1, n_samples) per utterance, trimmed to its true length.
+
+        NOTE: the flow is causal and masked, so padding does not change the mels of the shorter rows. The vocoder is
+        not causal: its last few ms see the (zero) padding frames through its convolutions instead of the
+        zero padding of each layer, a difference far below the noise injected by its source module.
+        """
+        if isinstance(ref_dicts, dict):
+            ref_dicts = [ref_dicts] * len(speech_tokens)
+        assert len(ref_dicts) == len(speech_tokens), "need one ref_dict per utterance"
+        n_cfm_timesteps = n_cfm_timesteps or (2 if self.meanflow else 10)
+
+        speech_tokens = [torch.atleast_1d(st.squeeze()).long().to(self.device) for st in speech_tokens]
+        token_len = torch.tensor([len(st) for st in speech_tokens], device=self.device)
+        output_mels, mel_lens = self.flow.inference_batch(
+            token=pad_sequence(speech_tokens, batch_first=True),
+            token_len=token_len,
+            n_timesteps=n_cfm_timesteps,
+            meanflow=self.meanflow,
+            **self._batch_ref_dicts(ref_dicts),
+        )
+        output_mels = output_mels.to(dtype=self.dtype)
+        output_wavs, _ = self.hift_inference(output_mels, None)
+
+        samples_per_frame = output_wavs.size(1) // output_mels.size(2)
+        wavs = []
+        for wav, mel_len in zip(output_wavs, mel_lens.tolist()):
+            wav = wav[None, :mel_len * samples_per_frame].clone()
+            # NOTE: ad-hoc method to reduce "spillover" from the reference clip.
+            n_fade = min(len(self.trim_fade), wav.size(1))
+            wav[:, :n_fade] *= self.trim_fade[:n_fade]
+            wavs.append(wav)
+        return wavs
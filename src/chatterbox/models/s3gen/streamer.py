@@ -0,0 +1,169 @@
+from typing import Optional
+
+import numpy as np
+import torch
+
+from .s3gen import S3Token2Wav
+
+
+def fade_in_out(fade_in_wav: torch.Tensor, fade_out_wav: torch.Tensor, window: torch.Tensor) -> torch.Tensor:
+    """Cross-fades the start of `fade_in_wav` with the end of `fade_out_wav`, over half of `window` each."""
+    overlap = window.size(0) // 2
+    fade_in_wav = fade_in_wav.clone()
+    fade_in_wav[..., :overlap] = fade_in_wav[..., :overlap] * window[:overlap] + \
+        fade_out_wav[..., -overlap:] * window[overlap:]
+    return fade_in_wav
+
+
+class S3GenStreamer:
+    """
+    Incremental S3Gen synthesis for one utterance: speech tokens go in by chunks (`push`), and each call returns the
+    audio that is final so far, so playback can start after the first chunk.
+
+    Every chunk runs the flow with `finalize=False` over a bounded window: the new tokens, after the last
+    `context_tokens` tokens whose mels were already taken. These context tokens join the voice prompt, with their
+    mels as the prompt mels, so the CFM continues the frames it has emitted instead of generating them again, and a
+    chunk costs the same however long the utterance is. The mels of the last `pre_lookahead_len` tokens are left for
+    the next chunk (they still have to see the tokens that follow). The CFM noise is drawn once per frame of the
+    utterance. The vocoder follows CosyVoice2: the last `mel_cache_len` frames of a chunk are held back and vocoded
+    again with the next chunk, whose source excitation starts with the one of the previous pass (HiFT
+    `cache_source`), and the two renditions of these frames are cross-faded with a Hamming window.
+
+    NOTE: the flow encoder and the CFM decoder attend over their whole input, so the streamed mels are an
+    approximation of the one-shot ones: a frame sees the prompt, at most `context_tokens` tokens before its chunk
+    and the tokens of the chunk, instead of the whole utterance.
+    """
+
+    def __init__(
+        self,
+        s3gen: S3Token2Wav,
+        ref_dict: dict,
+        n_cfm_timesteps: Optional[int] = None,
+        mel_cache_len: int = 8,
+        context_tokens: int = 50,
+    ):
+        self.s3gen = s3gen
+        self.ref_dict = s3gen._cast_ref_dict(ref_dict)
+        self.n_cfm_timesteps = n_cfm_timesteps
+        self.mel_cache_len = mel_cache_len
+        self.context_tokens = context_tokens
+        # the vocoder's f0 upsampling goes from mel frames to samples
+        self.source_cache_len = mel_cache_len * int(s3gen.mel2wav.f0_upsamp.scale_factor)
+        self.speech_window = torch.from_numpy(np.hamming(2 * self.source_cache_len)).to(s3gen.device, s3gen.dtype)
+
+        self.speech_tokens = torch.zeros(1, 0, dtype=torch.long, device=s3gen.device)
+        self.noise = torch.zeros(1, 80, 0, dtype=s3gen.dtype, device=s3gen.device)
+        self.n_mels = 0  # mel frames of the utterance taken from the flow so far
+        self.context_mels = torch.zeros(1, 80, 0, dtype=s3gen.dtype, device=s3gen.device)  # the latest of them
+        self.pending_mels = torch.zeros(1, 80, 0, dtype=s3gen.dtype, device=s3gen.device)
+        self.hift_cache = None
+        self.n_samples = 0  # samples returned so far
+        self.finished = False
+
+    @property
+    def n_done(self):
+        """Number of tokens whose mels were taken from the flow."""
+        return self.n_mels // self.s3gen.flow.token_mel_ratio
+
+    def _flow(self, finalize):
+        flow = self.s3gen.flow
+        ratio = flow.token_mel_ratio
+        n_prompt_frames = ratio * self.ref_dict["prompt_token"].size(-1)
+        n_done = self.n_done
+        n_context = min(n_done, self.context_tokens)
+
+        # noise of the prompt frames, then of the utterance frames from the first context token on
+        n_frames = ratio * self.speech_tokens.size(1)
+        if not finalize:
+            n_frames -= ratio * flow.pre_lookahead_len
+        n_more = n_prompt_frames + n_frames - self.noise.size(2)
+        if n_more > 0:
+            more = torch.randn(1, 80, n_more, dtype=self.noise.dtype, device=self.noise.device)
+            self.noise = torch.cat([self.noise, more], dim=2)
+        noise = torch.cat([
+            self.noise[:, :, :n_prompt_frames],
+            self.noise[:, :, n_prompt_frames + ratio * (n_done - n_context):n_prompt_frames + n_frames],
+        ], dim=2)
+
+        # the context tokens and their mels extend the prompt; the prompt mels are cut to whole tokens, so that the
+        # frames of the context line up with its tokens
+        ref_dict = dict(self.ref_dict)
+        prompt_token = torch.atleast_2d(ref_dict["prompt_token"])
+        context = self.speech_tokens[:, n_done - n_context:n_done].to(prompt_token.dtype)
+        ref_dict["prompt_token"] = torch.cat([prompt_token, context], dim=1)
+        ref_dict["prompt_token_len"] = ref_dict["prompt_token_len"] + n_context
+        prompt_feat = ref_dict["prompt_feat"][:, :n_prompt_frames]  # (1, n_feat, 80)
+        context_mels = self.context_mels[:, :, self.context_mels.size(2) - ratio * n_context:]
+        ref_dict["prompt_feat"] = torch.cat([prompt_feat, context_mels.transpose(1, 2).to(prompt_feat)], dim=1)
+        ref_dict["prompt_feat_len"] = None
+
+        return self.s3gen.flow_inference(
+            self.speech_tokens[:, n_done:],
+            ref_dict=ref_dict,
+            n_cfm_timesteps=self.n_cfm_timesteps,
+            finalize=finalize,
+            noised_mels=noise,
+        )
+
+    def _vocode(self, mels, finalize):
+        if self.hift_cache is not None:
+            mels = torch.cat([self.hift_cache["mel"], mels], dim=2)
+            cache_source = self.hift_cache["source"]
+        else:
+            cache_source = None
+        wav, source = self.s3gen.hift_inference(mels, cache_source)
+        if self.hift_cache is not None:
+            wav = fade_in_out(wav, self.hift_cache["speech"], self.speech_window)
+        if finalize:
+            self.hift_cache = None
+        else:
+            self.hift_cache = dict(
+                mel=mels[:, :, -self.mel_cache_len:],
+                source=source[:, :, -self.source_cache_len:],
+                speech=wav[:, -self.source_cache_len:],
+            )
+            wav = wav[:, :-self.source_cache_len]
+        return wav
+
+    @torch.inference_mode()
+    def push(self, speech_tokens: torch.Tensor, finalize: bool = False) -> torch.Tensor:
+        """
+        Adds the next valid speech tokens (see `drop_invalid_tokens`) of the utterance and returns the new audio
+        (1, n_samples), possibly empty. `finalize=True` marks the last chunk and returns the rest of the audio.
+        """
+        assert not self.finished, "the stream is finalized"
+        speech_tokens = torch.atleast_2d(speech_tokens).long().to(self.s3gen.device)
+        self.speech_tokens = torch.cat([self.speech_tokens, speech_tokens], dim=1)
+        self.finished = finalize
+
+        empty = torch.zeros(1, 0, dtype=self.s3gen.dtype, device=self.s3gen.device)
+        n_new = self.speech_tokens.size(1) - self.n_done
+        if not finalize and n_new <= self.s3gen.flow.pre_lookahead_len:
+            return empty
+        if n_new > 0:
+            mels = self._flow(finalize).to(dtype=self.s3gen.dtype)
+            self.pending_mels = torch.cat([self.pending_mels, mels], dim=2)
+            self.n_mels += mels.size(2)
+            context_mels = torch.cat([self.context_mels, mels], dim=2)
+            n_keep = min(context_mels.size(2), self.s3gen.flow.token_mel_ratio * self.context_tokens)
+            self.context_mels = context_mels[:, :, context_mels.size(2) - n_keep:]
+        if self.pending_mels.size(2) > 0 and (finalize or self.pending_mels.size(2) > self.mel_cache_len):
+            wav = self._vocode(self.pending_mels, finalize)
+            self.pending_mels = self.pending_mels[:, :, :0]
+        elif finalize and self.hift_cache is not None:
+            wav, self.hift_cache = self.hift_cache["speech"], None
+        else:
+            # a chunk has to outlast the held back frames
+            return empty
+
+        # NOTE: ad-hoc method to reduce "spillover" from the reference clip.
+        n_fade = min(len(self.s3gen.trim_fade) - self.n_samples, wav.size(1))
+        if n_fade > 0:
+            wav = wav.clone()
+            wav[:, :n_fade] *= self.s3gen.trim_fade[self.n_samples:self.n_samples + n_fade]
+        self.n_samples += wav.size(1)
+        return wav
+
+    def flush(self) -> torch.Tensor:
+        """Finalizes the stream and returns the rest of the audio."""
+        return self.push(torch.zeros(1, 0, dtype=torch.long), finalize=True)
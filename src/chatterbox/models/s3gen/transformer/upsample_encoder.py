@@ -15,7 +15,8 @@
 # limitations under the License.
 # Modified from ESPnet(https://github.com/espnet/espnet)
 """Encoder definition."""
-from typing import Tuple
+from dataclasses import dataclass
+from typing import List, Tuple
 
 import torch
 from torch import nn
@@ -96,6 +97,30 @@ class PreLookaheadLayer(nn.Module):
         return outputs
 
 
+@dataclass
+class EncoderPromptCache:
+    """
+    Encoder state of a voice's prompt tokens, from `UpsampleConformerEncoder.prompt_cache`, so that
+    `UpsampleConformerEncoder.forward_with_prompt_cache` only has to encode the tokens that follow the prompt.
+
+    It covers the first `n_tokens` prompt tokens. The last `pre_lookahead_len` prompt tokens look ahead into the
+    tokens that follow them, so they are encoded again with every request.
+    """
+    n_tokens: int
+    att_caches: List[torch.Tensor]  # per encoder layer, (1, head, n_tokens, d_k * 2)
+    up_att_caches: List[torch.Tensor]  # per up encoder layer, (1, head, 2 * n_tokens, d_k * 2)
+    lookahead_context: torch.Tensor  # embedded inputs before `n_tokens`, (1, t, size)
+    up_context: torch.Tensor  # encoder layer outputs before `n_tokens`, (1, t, size)
+    output: torch.Tensor  # encoder output of the cached tokens, (1, 2 * n_tokens, size)
+
+    def to(self, device=None, dtype=None):
+        for name in ("att_caches", "up_att_caches"):
+            setattr(self, name, [c.to(device=device, dtype=dtype) for c in getattr(self, name)])
+        for name in ("lookahead_context", "up_context", "output"):
+            setattr(self, name, getattr(self, name).to(device=device, dtype=dtype))
+        return self
+
+
 class UpsampleConformerEncoder(torch.nn.Module):
 
     def __init__(
@@ -277,6 +302,8 @@ class UpsampleConformerEncoder(torch.nn.Module):
                                               self.static_chunk_size,
                                               num_decoding_left_chunks)
         # lookahead + conformer encoder
+        # zero the padding first, or the last valid frames of a shorter sequence in a batch would look ahead into it
+        xs = xs.masked_fill(~mask_pad.transpose(1, 2), 0.0)
         xs = self.pre_lookahead_layer(xs)
         xs = self.forward_layers(xs, chunk_masks, pos_emb, mask_pad)
 
@@ -303,6 +330,95 @@ class UpsampleConformerEncoder(torch.nn.Module):
         # for cross attention with decoder later
         return xs, masks
 
+    def prompt_cache(self, xs: torch.Tensor, xs_lens: torch.Tensor) -> EncoderPromptCache:
+        """Encodes the prompt alone (B=1, full context) and keeps the state `forward_with_prompt_cache` needs.
+
+        Args:
+            xs: embedded prompt tokens (1, T, D)
+            xs_lens: (1,)
+        """
+        assert xs.size(0) == 1, "the prompt cache holds a single prompt"
+        n = xs.size(1) - self.pre_lookahead_layer.pre_lookahead_len
+        # the causal convs after the lookahead and in the up layer see this many earlier (token rate) frames
+        n_lookahead_context = self.pre_lookahead_layer.conv2.kernel_size[0] - 1
+        n_up_context = (self.up_layer.conv.kernel_size[0] - 1) // self.up_layer.stride
+        assert n >= max(n_lookahead_context, n_up_context), "prompt too short to cache"
+
+        masks = ~make_pad_mask(xs_lens, xs.size(1)).unsqueeze(1)  # (1, 1, T)
+        xs, pos_emb, masks = self.embed(xs, masks)
+        lookahead_context = xs[:, n - n_lookahead_context:n]
+        xs = self.pre_lookahead_layer(xs)
+        att_caches = []
+        for layer in self.encoders:
+            xs, _, att_cache, _ = layer(xs, masks, pos_emb, masks)
+            att_caches.append(att_cache[:, :, :n])
+        up_context = xs[:, n - n_up_context:n]
+
+        xs, xs_lens = self.up_layer(xs.transpose(1, 2).contiguous(), xs_lens)
+        xs = xs.transpose(1, 2).contiguous()
+        masks = ~make_pad_mask(xs_lens, xs.size(1)).unsqueeze(1)
+        xs, pos_emb, masks = self.up_embed(xs, masks)
+        up_att_caches = []
+        for layer in self.up_encoders:
+            xs, _, att_cache, _ = layer(xs, masks, pos_emb, masks)
+            up_att_caches.append(att_cache[:, :, :self.up_layer.stride * n])
+        if self.normalize_before:
+            xs = self.after_norm(xs)
+
+        return EncoderPromptCache(
+            n_tokens=n,
+            att_caches=att_caches,
+            up_att_caches=up_att_caches,
+            lookahead_context=lookahead_context,
+            up_context=up_context,
+            output=xs[:, :self.up_layer.stride * n],
+        )
+
+    def forward_with_prompt_cache(
+        self,
+        xs: torch.Tensor,
+        xs_lens: torch.Tensor,
+        prompt_cache: EncoderPromptCache,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Encodes the tokens that follow the first `prompt_cache.n_tokens` prompt tokens, attending to the cached
+        prompt keys / values. Full context only (no chunk masks).
+
+        Args:
+            xs: embedded tokens after the cached ones, ie the uncached prompt tail then the new tokens (B, T, D)
+            xs_lens: (B,)
+        Returns:
+            the encoder output of these tokens only (B, 2T, D) and its mask (B, 1, 2T)
+        """
+        B = xs.size(0)
+        n = prompt_cache.n_tokens
+
+        masks = ~make_pad_mask(xs_lens, xs.size(1)).unsqueeze(1)  # (B, 1, T)
+        xs, _, masks = self.embed(xs, masks)
+        xs = xs.masked_fill(~masks.transpose(1, 2), 0.0)
+        context = prompt_cache.lookahead_context.expand(B, -1, -1)
+        xs = self.pre_lookahead_layer(torch.cat([context, xs], dim=1))[:, context.size(1):]
+        # the queries are the last positions of the cached prompt + xs, which is what rel_shift assumes
+        att_masks = F.pad(masks, (n, 0), value=True)
+        pos_emb = self.embed.pos_enc.position_encoding(offset=0, size=n + xs.size(1))
+        for layer, att_cache in zip(self.encoders, prompt_cache.att_caches):
+            xs, _, _, _ = layer(xs, att_masks, pos_emb, masks, att_cache=att_cache.expand(B, -1, -1, -1))
+
+        context = prompt_cache.up_context.expand(B, -1, -1)
+        xs = torch.cat([context, xs], dim=1).transpose(1, 2).contiguous()
+        xs, xs_lens = self.up_layer(xs, xs_lens)
+        xs = xs[:, :, self.up_layer.stride * context.size(1):].transpose(1, 2).contiguous()
+        n = self.up_layer.stride * n
+        masks = ~make_pad_mask(xs_lens, xs.size(1)).unsqueeze(1)
+        xs, _, masks = self.up_embed(xs, masks)
+        att_masks = F.pad(masks, (n, 0), value=True)
+        pos_emb = self.up_embed.pos_enc.position_encoding(offset=0, size=n + xs.size(1))
+        for layer, att_cache in zip(self.up_encoders, prompt_cache.up_att_caches):
+            xs, _, _, _ = layer(xs, att_masks, pos_emb, masks, att_cache=att_cache.expand(B, -1, -1, -1))
+
+        if self.normalize_before:
+            xs = self.after_norm(xs)
+        return xs, masks
+
     def forward_layers(self, xs: torch.Tensor, chunk_masks: torch.Tensor,
                        pos_emb: torch.Tensor,
                        mask_pad: torch.Tensor) -> torch.Tensor:
@@ -9,6 +9,7 @@ from collections import OrderedDict
 import torch
 import torch.nn.functional as F
 import torch.utils.checkpoint as cp
+from torch.nn.utils.fusion import fuse_conv_bn_eval
 import torchaudio.compliance.kaldi as Kaldi
 
 
@@ -42,20 +43,54 @@ def pad_list(xs, pad_value):
     return pad
 
 
+def batch_fbank(wavs, wav_lens, num_mel_bins=80, sample_rate=16000):
+    """
+    `Kaldi.fbank` with its default options over a batch of padded waveforms.
+
+    Args:
+        wavs (Tensor): (B, N) waveforms, padded at the end.
+        wav_lens (Tensor): (B,) number of valid samples of each waveform.
+
+    Returns:
+        Tensor: (B, T, num_mel_bins) log mel filterbank energies, zero past each waveform's frames.
+        Tensor: (B,) number of frames of each waveform.
+    """
+    window_size = int(sample_rate * 0.025)
+    window_shift = int(sample_rate * 0.010)
+    n_fft = 1 << (window_size - 1).bit_length()
+    if wavs.size(1) < window_size:
+        wavs = F.pad(wavs, (0, window_size - wavs.size(1)))
+    feat_lens = torch.where(wav_lens >= window_size, 1 + (wav_lens - window_size) // window_shift, 0)
+
+    frames = wavs.unfold(1, window_size, window_shift)  # (B, T, window_size), snip_edges
+    frames = frames - frames.mean(dim=-1, keepdim=True)  # remove_dc_offset
+    frames = frames - 0.97 * torch.cat([frames[..., :1], frames[..., :-1]], dim=-1)  # preemphasis
+    window = torch.hann_window(window_size, periodic=False, device=wavs.device, dtype=wavs.dtype).pow(0.85)
+    power = torch.fft.rfft(frames * window, n=n_fft).abs().pow(2.0)
+
+    mel_banks, _ = Kaldi.get_mel_banks(num_mel_bins, n_fft, float(sample_rate), 20.0, 0.0, 100.0, -500.0, 1.0)
+    mel_banks = F.pad(mel_banks, (0, 1)).to(device=wavs.device, dtype=wavs.dtype)
+    eps = torch.tensor(torch.finfo(torch.float).eps, device=wavs.device, dtype=wavs.dtype)
+    feats = torch.max(power @ mel_banks.T, eps).log()
+
+    mask = (torch.arange(feats.size(1), device=wavs.device) < feat_lens[:, None])[..., None]
+    return feats.masked_fill(~mask, 0.0), feat_lens
+
+
 def extract_feature(audio):
-    features = []
-    feature_times = []
-    feature_lengths = []
-    for au in audio:
-        feature = Kaldi.fbank(au.unsqueeze(0), num_mel_bins=80)
-        feature = feature - feature.mean(dim=0, keepdim=True)
-        features.append(feature)
-        feature_times.append(au.shape[0])
-        feature_lengths.append(feature.shape[0])
-    # padding for batch inference
-    features_padded = pad_list(features, pad_value=0)
-    # features = torch.cat(features)
-    return features_padded, feature_lengths, feature_times
+    feature_times = [au.shape[0] for au in audio]
+    wav_lens = torch.tensor(feature_times, device=audio[0].device)
+    features, feature_lens = batch_fbank(pad_list(list(audio), pad_value=0), wav_lens)
+    # mean normalization over each waveform's own frames
+    mask = (torch.arange(features.size(1), device=features.device) < feature_lens[:, None])[..., None]
+    features = features - features.sum(dim=1, keepdim=True) / feature_lens.clamp(min=1)[:, None, None]
+    features_padded = features.masked_fill(~mask, 0.0)
+    return features_padded, feature_lens.tolist(), feature_times
+
+
+def masked(x, mask):
+    """Zeroes the padded frames of `x` (mask broadcastable to x, 1 for valid frames); no-op without a mask."""
+    return x if mask is None else x * mask
 
 
 class BasicResBlock(torch.nn.Module):
@@ -83,9 +118,10 @@ class BasicResBlock(torch.nn.Module):
                 torch.nn.BatchNorm2d(self.expansion * planes),
             )
 
-    def forward(self, x):
-        out = F.relu(self.bn1(self.conv1(x)))
-        out = self.bn2(self.conv2(out))
+    def forward(self, x, mask=None):
+        # the inputs of the convs over time are masked, as in the unpadded forward
+        out = F.relu(self.bn1(self.conv1(masked(x, mask))))
+        out = self.bn2(self.conv2(masked(out, mask)))
         out += self.shortcut(x)
         out = F.relu(out)
         return out
@@ -115,12 +151,13 @@ class FCM(torch.nn.Module):
             self.in_planes = planes * block.expansion
         return torch.nn.Sequential(*layers)
 
-    def forward(self, x):
+    def forward(self, x, mask=None):
         x = x.unsqueeze(1)
-        out = F.relu(self.bn1(self.conv1(x)))
-        out = self.layer1(out)
-        out = self.layer2(out)
-        out = F.relu(self.bn2(self.conv2(out)))
+        mask = None if mask is None else mask.unsqueeze(1)  # (B, 1, 1, T)
+        out = F.relu(self.bn1(self.conv1(masked(x, mask))))
+        for block in (*self.layer1, *self.layer2):
+            out = block(out, mask)
+        out = F.relu(self.bn2(self.conv2(masked(out, mask))))
 
         shape = out.shape
         out = out.reshape(shape[0], shape[1] * shape[2], shape[3])
@@ -143,9 +180,23 @@ def get_nonlinear(config_str, channels):
     return nonlinear
 
 
-def statistics_pooling(x, dim=-1, keepdim=False, unbiased=True, eps=1e-2):
-    mean = x.mean(dim=dim)
-    std = x.std(dim=dim, unbiased=unbiased)
+def fuse_conv_bn(conv_owner, conv_name, bn_owner, bn_name):
+    """Folds the BatchNorm `bn_owner.<bn_name>` into the conv `conv_owner.<conv_name>` that feeds it (eval mode)."""
+    conv, bn = getattr(conv_owner, conv_name), getattr(bn_owner, bn_name)
+    setattr(conv_owner, conv_name, fuse_conv_bn_eval(conv, bn))
+    setattr(bn_owner, bn_name, torch.nn.Identity())
+
+
+def statistics_pooling(x, dim=-1, keepdim=False, unbiased=True, eps=1e-2, mask=None):
+    if mask is None:
+        mean = x.mean(dim=dim)
+        std = x.std(dim=dim, unbiased=unbiased)
+    else:
+        # statistics over the valid frames only
+        n = mask.sum(dim=dim)
+        mean = (x * mask).sum(dim=dim) / n
+        var = (((x - mean.unsqueeze(dim)) * mask) ** 2).sum(dim=dim) / (n - 1 if unbiased else n)
+        std = var.sqrt()
     stats = torch.cat([mean, std], dim=-1)
     if keepdim:
         stats = stats.unsqueeze(dim=dim)
@@ -153,8 +204,8 @@ def statistics_pooling(x, dim=-1, keepdim=False, unbiased=True, eps=1e-2):
 
 
 class StatsPool(torch.nn.Module):
-    def forward(self, x):
-        return statistics_pooling(x)
+    def forward(self, x, mask=None):
+        return statistics_pooling(x, mask=mask)
 
 
 class TDNNLayer(torch.nn.Module):
@@ -211,17 +262,27 @@ class CAMLayer(torch.nn.Module):
         self.linear2 = torch.nn.Conv1d(bn_channels // reduction, out_channels, 1)
         self.sigmoid = torch.nn.Sigmoid()
 
-    def forward(self, x):
-        y = self.linear_local(x)
-        context = x.mean(-1, keepdim=True) + self.seg_pooling(x)
+    def forward(self, x, mask=None):
+        y = self.linear_local(masked(x, mask))
+        if mask is None:
+            context = x.mean(-1, keepdim=True)
+        else:
+            context = (x * mask).sum(-1, keepdim=True) / mask.sum(-1, keepdim=True)
+        context = context + self.seg_pooling(x, mask=mask)
         context = self.relu(self.linear1(context))
         m = self.sigmoid(self.linear2(context))
         return y * m
 
-    def seg_pooling(self, x, seg_len=100, stype="avg"):
-        if stype == "avg":
+    def seg_pooling(self, x, seg_len=100, stype="avg", mask=None):
+        if stype == "avg" and mask is not None:
+            # the mean of the valid frames of each segment; the padded segments come out as 0
+            seg = F.avg_pool1d(x * mask, kernel_size=seg_len, stride=seg_len, ceil_mode=True)
+            seg = seg / F.avg_pool1d(mask, kernel_size=seg_len, stride=seg_len, ceil_mode=True).clamp(min=1e-8)
+        elif stype == "avg":
             seg = F.avg_pool1d(x, kernel_size=seg_len, stride=seg_len, ceil_mode=True)
         elif stype == "max":
+            if mask is not None:
+                x = x.masked_fill(mask == 0, float("-inf"))
             seg = F.max_pool1d(x, kernel_size=seg_len, stride=seg_len, ceil_mode=True)
         else:
             raise ValueError("Wrong segment pooling type.")
@@ -266,12 +327,12 @@ class CAMDenseTDNNLayer(torch.nn.Module):
     def bn_function(self, x):
         return self.linear1(self.nonlinear1(x))
 
-    def forward(self, x):
+    def forward(self, x, mask=None):
         if self.training and self.memory_efficient:
             x = cp.checkpoint(self.bn_function, x)
         else:
             x = self.bn_function(x)
-        x = self.cam_layer(self.nonlinear2(x))
+        x = self.cam_layer(self.nonlinear2(x), mask=mask)
         return x
 
 
@@ -304,9 +365,9 @@ class CAMDenseTDNNBlock(torch.nn.ModuleList):
             )
             self.add_module("tdnnd%d" % (i + 1), layer)
 
-    def forward(self, x):
+    def forward(self, x, mask=None):
         for layer in self:
-            x = torch.cat([x, layer(x)], dim=1)
+            x = torch.cat([x, layer(x, mask)], dim=1)
         return x
 
 
@@ -414,15 +475,53 @@ class CAMPPlus(torch.nn.Module):
                 if m.bias is not None:
                     torch.nn.init.zeros_(m.bias)
 
-    def forward(self, x):
+    def forward(self, x, x_lens=None):
+        """
+        x: (B, T, F) fbank features. With `x_lens` (B,), the frames past each row's length are padding: every
+        conv over time, context and statistics pooling leaves them out, so each embedding is the one of the row
+        alone. Without it, all the frames are used.
+        """
         x = x.permute(0, 2, 1)  # (B,T,F) => (B,F,T)
-        x = self.head(x)
-        x = self.xvector(x)
+        if x_lens is None:
+            x = self.head(x)
+            x = self.xvector(x)
+        else:
+            mask = (torch.arange(x.size(2), device=x.device) < x_lens.to(x.device)[:, None])
+            mask = mask.unsqueeze(1).to(x.dtype)  # (B, 1, T)
+            x = self.head(x, mask)
+            for layer in self.xvector:
+                if isinstance(layer, TDNNLayer):
+                    x = layer(masked(x, mask))
+                    mask = mask[..., ::layer.linear.stride[0]]
+                elif isinstance(layer, (CAMDenseTDNNBlock, StatsPool)):
+                    x = layer(x, mask)
+                else:
+                    x = layer(x)
         if self.output_level == "frame":
             x = x.transpose(1, 2)
         return x
 
+    @torch.no_grad()
+    def fuse_for_inference(self):
+        """
+        Folds every BatchNorm that directly follows a conv into it. The BatchNorms that precede a conv (after a
+        ReLU) stay. Eval mode only; the weights can't be trained afterwards.
+        """
+        for m in list(self.modules()):
+            if isinstance(m, (BasicResBlock, FCM)):
+                fuse_conv_bn(m, "conv1", m, "bn1")
+                fuse_conv_bn(m, "conv2", m, "bn2")
+            if isinstance(m, BasicResBlock) and len(m.shortcut) > 0:
+                fuse_conv_bn(m.shortcut, "0", m.shortcut, "1")
+            if isinstance(m, (TDNNLayer, DenseLayer)) and hasattr(m.nonlinear, "batchnorm"):
+                fuse_conv_bn(m, "linear", m.nonlinear, "batchnorm")
+            if isinstance(m, CAMDenseTDNNLayer) and hasattr(m.nonlinear2, "batchnorm"):
+                fuse_conv_bn(m, "linear1", m.nonlinear2, "batchnorm")
+
     def inference(self, audio_list):
+        """Speaker embeddings (B, embedding_size) of a list of 1D 16 kHz waveforms, in one batched pass."""
         speech, speech_lengths, speech_times = extract_feature(audio_list)
-        results = self.forward(speech.to(torch.float32))
+        # padding only when the lengths differ
+        x_lens = torch.tensor(speech_lengths) if min(speech_lengths) < speech.size(1) else None
+        results = self.forward(speech.to(torch.float32), x_lens)
         return results
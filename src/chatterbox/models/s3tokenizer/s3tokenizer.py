@@ -4,7 +4,6 @@ import numpy as np
 import librosa
 import torch
 import torch.nn.functional as F
-from s3tokenizer.utils import padding
 from s3tokenizer.model_v2 import (
     S3TokenizerV2,
     ModelConfig,
@@ -96,7 +95,8 @@ class S3Tokenizer(S3TokenizerV2):
     ) -> Tuple[torch.Tensor, torch.LongTensor]:
         """
         NOTE: mel-spec has a hop size of 160 points (100 frame/sec).
-        FIXME: this class inherits `nn.Module` but doesn't accept `torch.Tensor` and handles a list of wavs one by one, which is unexpected.
+        FIXME: this class inherits `nn.Module` but takes a list of wavs (or a batch tensor, iterated over rows).
+        The wavs are padded and go through one batched log-mel and `quantize` pass.
 
         Args
         ----
@@ -105,15 +105,11 @@ class S3Tokenizer(S3TokenizerV2):
         NOTE: please pad the waveform if longer sequence is needed.
         """
         processed_wavs = self._prepare_audio(wavs)
-        mels, mel_lens = [], []
-        for wav in processed_wavs:
-            wav = wav.to(self.device)
-            mel = self.log_mel_spectrogram(wav)  # [B=1, F, T]
-            if max_len is not None:
-                mel = mel[..., :max_len * 4]  # num_mel_frames = 4 * num_tokens
-            mels.append(mel.squeeze(0))
-
-        mels, mel_lens = padding(mels)
+        mels, mel_lens = self.batch_log_mel_spectrogram(processed_wavs)
+        if max_len is not None:
+            mels = mels[..., :max_len * 4]  # num_mel_frames = 4 * num_tokens
+            mel_lens = mel_lens.clamp(max=max_len * 4)
+
         if accelerator is None:
             tokenizer = self
         else:
@@ -125,6 +121,34 @@ class S3Tokenizer(S3TokenizerV2):
             speech_token_lens.long().detach(),
         )
 
+    def batch_log_mel_spectrogram(self, wavs: List[torch.Tensor]) -> Tuple[torch.Tensor, torch.LongTensor]:
+        """
+        `log_mel_spectrogram` of a list of (1, n_samples) wavs in one STFT and mel pass: (B, F, T) log-mels, zero
+        past each wav's frames (as `s3tokenizer.utils.padding` would), and the (B,) frame counts. Each wav gets its
+        own reflect padding and dynamic range (max - 8) over its own frames, so the output matches a wav alone.
+        """
+        half = self.n_fft // 2
+        # the reflect padding of `torch.stft(center=True)`, per wav, then zeros to a common length
+        audio = [F.pad(wav.to(self.device).reshape(1, -1), (half, half), mode="reflect")[0] for wav in wavs]
+        mel_lens = torch.tensor([(a.size(0) - 2 * half) // S3_HOP for a in audio], device=self.device)
+        audio = torch.nn.utils.rnn.pad_sequence(audio, batch_first=True)
+        stft = torch.stft(
+            audio, self.n_fft, S3_HOP,
+            window=self.window.to(self.device),
+            center=False,
+            return_complex=True
+        )
+        magnitudes = stft[..., :mel_lens.max()].abs()**2
+
+        mel_spec = self._mel_filters.to(self.device) @ magnitudes
+
+        mask = (torch.arange(mel_spec.size(-1), device=self.device) < mel_lens[:, None])[:, None, :]
+        log_spec = torch.clamp(mel_spec, min=1e-10).log10()
+        log_max = log_spec.masked_fill(~mask, float("-inf")).amax(dim=(1, 2), keepdim=True)
+        log_spec = torch.maximum(log_spec, log_max - 8.0)
+        log_spec = (log_spec + 4.0) / 4.0
+        return log_spec.masked_fill(~mask, 0.0), mel_lens
+
     def log_mel_spectrogram(
         self,
         audio: torch.Tensor,
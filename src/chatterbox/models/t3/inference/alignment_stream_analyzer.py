@@ -2,9 +2,11 @@
 # Author: John Meade, Jeremy Hsu
 # MIT License
 import logging
+import math
 import torch
+import torch.nn.functional as F
 from dataclasses import dataclass
-from types import MethodType
+from transformers.models.llama.modeling_llama import rotate_half
 
 
 logger = logging.getLogger(__name__)
@@ -13,6 +15,36 @@ logger = logging.getLogger(__name__)
 LLAMA_ALIGNED_HEADS = [(12, 15), (13, 11), (9, 2)]
 
 
+def single_head_attention(attn, head_idx, args, kwargs):
+    """
+    Recomputes the attention weights of one head of a `LlamaAttention` layer from the inputs of its forward
+    call and the keys it has just written to the KV cache, so the layer itself can keep its SDPA kernel.
+
+    Returns (B, T, L) attention weights, L being the size of the layer's key cache.
+    """
+    hidden_states = kwargs["hidden_states"] if "hidden_states" in kwargs else args[0]
+    cos, sin = kwargs["position_embeddings"]
+    head_dim = attn.head_dim
+
+    head = slice(head_idx * head_dim, (head_idx + 1) * head_dim)
+    q_bias = attn.q_proj.bias[head] if attn.q_proj.bias is not None else None
+    query = F.linear(hidden_states, attn.q_proj.weight[head], q_bias)  # (B, T, head_dim)
+    query = query * cos + rotate_half(query) * sin
+
+    kv_head_idx = head_idx // attn.num_key_value_groups
+    key = kwargs["past_key_value"].key_cache[attn.layer_idx][:, kv_head_idx]  # (B, L, head_dim)
+    scores = torch.matmul(query, key.transpose(1, 2)) / math.sqrt(head_dim)  # (B, T, L)
+
+    attention_mask = kwargs.get("attention_mask")
+    if attention_mask is not None:
+        scores = scores + attention_mask[:, 0, :, :key.size(1)]
+    else:
+        cache_position = kwargs["cache_position"]
+        future = torch.arange(key.size(1), device=key.device)[None] > cache_position[:, None]
+        scores = scores.masked_fill(future, -math.inf)
+    return scores.float().softmax(dim=-1)
+
+
 @dataclass
 class AlignmentAnalysisResult:
     # was this frame detected as being part of a noisy beginning chunk with potential hallucinations?
@@ -30,149 +62,193 @@ class AlignmentAnalysisResult:
 
 
 class AlignmentStreamAnalyzer:
-    def __init__(self, tfmr, queue, text_tokens_slice, alignment_layer_idx=9, eos_idx=0):
+    def __init__(self, tfmr, queue, text_tokens_slice, alignment_layer_idx=9, eos_idx=0, query_offset=0):
         """
         Some transformer TTS models implicitly solve text-speech alignment in one or more of their self-attention
         activation maps. This module exploits this to perform online integrity checks which streaming.
         A hook is injected into the specified attention layer, and heuristics are used to determine alignment
         position, repetition, etc.
 
-        NOTE: currently requires no queues.
+        The alignment matrix itself is not kept: the heuristics only need a few running statistics, which live
+        on the device of the attention maps, so a step costs O(S) and never waits on the device.
+
+        NOTE: currently requires no queues. With `tfmr=None` no hooks are added and the caller fills
+        `last_aligned_attns` before each step.
+
+        `query_offset` is the position of the first prefilled query, ie the length of a KV cache the prefill
+        started from (see `T3.prefill_conditioning`).
+
+        The hooks stay registered until `remove_hooks` is called; use the analyzer as a context manager to scope
+        them to one generation:
+
+            with AlignmentStreamAnalyzer(tfmr, None, text_tokens_slice, eos_idx=eos_idx) as analyzer:
+                ...
         """
         # self.queue = queue
         self.text_tokens_slice = (i, j) = text_tokens_slice
         self.eos_idx = eos_idx
-        self.alignment = torch.zeros(0, j-i)
-        # self.alignment_bin = torch.zeros(0, j-i)
+        self.query_offset = query_offset
+        self.n_text_tokens = j - i
         self.curr_frame_pos = 0
-        self.text_position = 0
-
-        self.started = False
-        self.started_at = None
-
-        self.complete = False
-        self.completed_at = None
-        
-        # Track generated tokens for repetition detection
-        self.generated_tokens = []
+        self.num_frames = 0
+
+        # running statistics, created on the device of the first attention chunk
+        self.text_position = None  # alignment position, updated unless the jump is a discontinuity
+        self.cur_text_position = None  # argmax of the latest frame
+        self.discontinuity = None
+        self.started = None
+        self.complete = None
+        self.first_tokens_max = None  # max activation of the first 4 text tokens over all frames
+        self.last_frame_tail_max = None  # max activation of the last 2 text tokens in the latest frame
+        self.tail_sums = None  # per-token activation of the last 3 text tokens, summed over frames after completion
+        self.repetition_sum = None  # max activation over the earlier text tokens, summed over frames after completion
+        self.long_tail = None
+        self.alignment_repetition = None
+        self.token_repetition = None
+
+        # Track the last two generated tokens for repetition detection
+        self.num_generated_tokens = 0
+        self.last_tokens = None
 
         # Using `output_attentions=True` is incompatible with optimized attention kernels, so
-        # using it for all layers slows things down too much. We can apply it to just one layer
-        # by intercepting the kwargs and adding a forward hook (credit: jrm)
+        # using it for all layers slows things down too much. Instead, forward hooks recompute the
+        # weights of just the aligned heads from the attention inputs and the KV cache.
         self.last_aligned_attns = []
+        self._hook_handles = []
         for i, (layer_idx, head_idx) in enumerate(LLAMA_ALIGNED_HEADS):
             self.last_aligned_attns += [None]
-            self._add_attention_spy(tfmr, i, layer_idx, head_idx)
+            if tfmr is not None:
+                self._add_attention_spy(tfmr, i, layer_idx, head_idx)
 
     def _add_attention_spy(self, tfmr, buffer_idx, layer_idx, head_idx):
         """
-        Adds a forward hook to a specific attention layer to collect outputs.
+        Adds a forward hook to a specific attention layer to collect the attention weights of one head.
         """
-        def attention_forward_hook(module, input, output):
+        def attention_forward_hook(module, args, kwargs, output):
             """
-            See `LlamaAttention.forward`; the output is a 3-tuple: `attn_output, attn_weights, past_key_value`.
-            NOTE:
-            - When `output_attentions=True`, `LlamaSdpaAttention.forward` calls `LlamaAttention.forward`.
-            - `attn_output` has shape [B, H, T0, T0] for the 0th entry, and [B, H, 1, T0+i] for the rest i-th.
+            See `LlamaDecoderLayer.forward`, which calls `self_attn` with keyword arguments only.
+            NOTE: the weights have shape [T0, T0] on the first call, and [1, T0+i] for the rest i-th.
             """
-            if isinstance(output, tuple) and len(output) > 1 and output[1] is not None:
-                step_attention = output[1].cpu()  # (B, n_heads, T0, Ti)
-                self.last_aligned_attns[buffer_idx] = step_attention[0, head_idx]  # (T0, Ti)
+            step_attention = single_head_attention(module, head_idx, args, kwargs)  # (B, T0, Ti)
+            self.last_aligned_attns[buffer_idx] = step_attention[0]  # (T0, Ti)
 
         target_layer = tfmr.layers[layer_idx].self_attn
         # Register hook and store the handle
-        target_layer.register_forward_hook(attention_forward_hook)
-        if hasattr(tfmr, 'config') and hasattr(tfmr.config, 'output_attentions'):
-            self.original_output_attentions = tfmr.config.output_attentions
-            tfmr.config.output_attentions = True
+        handle = target_layer.register_forward_hook(attention_forward_hook, with_kwargs=True)
+        self._hook_handles.append(handle)
+
+    def remove_hooks(self):
+        for handle in self._hook_handles:
+            handle.remove()
+        self._hook_handles = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.remove_hooks()
+
+    def _init_state(self, device):
+        zero = torch.zeros((), device=device)
+        false = torch.zeros((), dtype=torch.bool, device=device)
+        self.text_position = torch.zeros((), dtype=torch.long, device=device)
+        self.cur_text_position = self.text_position
+        self.discontinuity = self.started = self.complete = false
+        self.long_tail = self.alignment_repetition = self.token_repetition = false
+        self.first_tokens_max = self.last_frame_tail_max = self.repetition_sum = zero
+        self.tail_sums = torch.zeros(3, device=device)
 
     def step(self, logits, next_token=None):
         """
-        Emits an AlignmentAnalysisResult into the output queue, and potentially modifies the logits to force an EOS.
+        Updates the alignment statistics with the attention of the latest frame(s), and potentially modifies the
+        logits to force an EOS. Use `result()` to read the analysis on the host.
         """
         # extract approximate alignment matrix chunk (1 frame at a time after the first chunk)
         aligned_attn = torch.stack(self.last_aligned_attns).mean(dim=0) # (N, N)
         i, j = self.text_tokens_slice
         if self.curr_frame_pos == 0:
-            # first chunk has conditioning info, text tokens, and BOS token
-            A_chunk = aligned_attn[j:, i:j].clone().cpu() # (T, S)
+            # first chunk has conditioning info (unless it was cached), text tokens, and BOS token
+            A_chunk = aligned_attn[j - self.query_offset:, i:j].float() # (T, S)
+            self._init_state(A_chunk.device)
         else:
             # subsequent chunks have 1 frame due to KV-caching
-            A_chunk = aligned_attn[:, i:j].clone().cpu() # (1, S)
+            A_chunk = aligned_attn[:, i:j].float() # (1, S)
 
         # TODO: monotonic masking; could have issue b/c spaces are often skipped.
+        A_chunk = A_chunk.clone()
         A_chunk[:, self.curr_frame_pos + 1:] = 0
 
-
-        self.alignment = torch.cat((self.alignment, A_chunk), dim=0)
-
-        A = self.alignment
-        T, S = A.shape
+        S = self.n_text_tokens
+        was_complete = self.complete
+        self.num_frames += A_chunk.size(0)
 
         # update position
         cur_text_posn = A_chunk[-1].argmax()
-        discontinuity = not(-4 < cur_text_posn - self.text_position < 7) # NOTE: very lenient!
-        if not discontinuity:
-            self.text_position = cur_text_posn
+        jump = cur_text_posn - self.text_position
+        self.discontinuity = ~((jump > -4) & (jump < 7)) # NOTE: very lenient!
+        self.text_position = torch.where(self.discontinuity, self.text_position, cur_text_posn)
+        self.cur_text_position = cur_text_posn
 
         # Hallucinations at the start of speech show up as activations at the bottom of the attention maps!
         # To mitigate this, we just wait until there are no activations far off-diagonal in the last 2 tokens,
         # and there are some strong activations in the first few tokens.
-        false_start = (not self.started) and (A[-2:, -2:].max() > 0.1 or A[:, :4].max() < 0.5)
-        self.started = not false_start
-        if self.started and self.started_at is None:
-            self.started_at = T
-
-        # Is generation likely complete?
-        self.complete = self.complete or self.text_position >= S - 3
-        if self.complete and self.completed_at is None:
-            self.completed_at = T
+        chunk_tail_max = A_chunk[-2:, -2:].max()
+        if A_chunk.size(0) == 1:
+            chunk_tail_max = torch.maximum(chunk_tail_max, self.last_frame_tail_max)
+        self.last_frame_tail_max = A_chunk[-1, -2:].max()
+        self.first_tokens_max = torch.maximum(self.first_tokens_max, A_chunk[:, :4].max())
+        false_start = ~self.started & ((chunk_tail_max > 0.1) | (self.first_tokens_max < 0.5))
+        self.started = ~false_start
+
+        # Is generation likely complete? Only frames after the one where it completed count below.
+        self.complete = self.complete | (self.text_position >= S - 3)
+        after_completion = was_complete.to(A_chunk.dtype)
 
         # NOTE: EOS rarely assigned activations, and second-last token is often punctuation, so use last 3 tokens.
-        # NOTE: due to the false-start behaviour, we need to make sure we skip activations for the first few tokens.
-        last_text_token_duration = A[15:, -3:].sum()
-
         # Activations for the final token that last too long are likely hallucinations.
-        long_tail = self.complete and (A[self.completed_at:, -3:].sum(dim=0).max() >= 5) # 200ms
+        self.tail_sums = self.tail_sums + after_completion * A_chunk[:, -3:].sum(dim=0)
+        self.long_tail = self.complete & (self.tail_sums.max() >= 5) # 200ms
 
         # If there are activations in previous tokens after generation has completed, assume this is a repetition error.
-        alignment_repetition = self.complete and (A[self.completed_at:, :-5].max(dim=1).values.sum() > 5)
-        
+        if S > 5:
+            self.repetition_sum = self.repetition_sum + after_completion * A_chunk[:, :-5].max(dim=1).values.sum()
+        self.alignment_repetition = self.complete & (self.repetition_sum > 5)
+
         # Track generated tokens for repetition detection
         if next_token is not None:
-            # Convert tensor to scalar if needed
-            if isinstance(next_token, torch.Tensor):
-                token_id = next_token.item() if next_token.numel() == 1 else next_token.view(-1)[0].item()
-            else:
-                token_id = next_token
-            self.generated_tokens.append(token_id)
-            
-            # Keep only last 8 tokens to prevent memory issues
-            if len(self.generated_tokens) > 8:
-                self.generated_tokens = self.generated_tokens[-8:]
-            
+            token = torch.as_tensor(next_token, device=A_chunk.device).view(-1)[:1]
+            self.last_tokens = token if self.last_tokens is None else torch.cat([self.last_tokens[-1:], token])
+            self.num_generated_tokens += 1
+
         # Check for excessive token repetition (3x same token in a row)
-        token_repetition = (
-            # self.complete and 
-            len(self.generated_tokens) >= 3 and
-            len(set(self.generated_tokens[-2:])) == 1
-        )
-        
-        if token_repetition:
-            repeated_token = self.generated_tokens[-1]
-            logger.warning(f"🚨 Detected 2x repetition of token {repeated_token}")
-            
+        if self.num_generated_tokens >= 3:
+            self.token_repetition = self.last_tokens[0] == self.last_tokens[1]
+
         # Suppress EoS to prevent early termination
-        if cur_text_posn < S - 3 and S > 5:  # Only suppress if text is longer than 5 tokens
-            logits[..., self.eos_idx] = -2**15
+        if S > 5:  # Only suppress if text is longer than 5 tokens
+            eos_logits = logits[..., self.eos_idx]
+            logits[..., self.eos_idx] = torch.where(cur_text_posn < S - 3, torch.full_like(eos_logits, -2**15), eos_logits)
 
         # If a bad ending is detected, force emit EOS by modifying logits
         # NOTE: this means logits may be inconsistent with latents!
-        if long_tail or alignment_repetition or token_repetition:
-            logger.warning(f"forcing EOS token, {long_tail=}, {alignment_repetition=}, {token_repetition=}")
-            # (±2**15 is safe for all dtypes >= 16bit)
-            logits = -(2**15) * torch.ones_like(logits)
-            logits[..., self.eos_idx] = 2**15
+        # (±2**15 is safe for all dtypes >= 16bit)
+        forced_logits = torch.full_like(logits, -2**15)
+        forced_logits[..., self.eos_idx] = 2**15
+        force_eos = self.long_tail | self.alignment_repetition | self.token_repetition
+        logits = torch.where(force_eos, forced_logits, logits)
 
         self.curr_frame_pos += 1
         return logits
+
+    def result(self) -> AlignmentAnalysisResult:
+        """
+        The analysis of the latest step, copied to the host. Meant to be read once generation has stopped.
+        """
+        return AlignmentAnalysisResult(
+            false_start=not bool(self.started),
+            long_tail=bool(self.long_tail),
+            repetition=bool(self.alignment_repetition | self.token_repetition),
+            discontinuity=bool(self.discontinuity),
+            complete=bool(self.complete),
+            position=int(self.text_position),
+        )
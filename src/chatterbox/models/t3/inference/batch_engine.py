@@ -0,0 +1,333 @@
+# Copyright (c) 2025 Resemble AI
+# MIT License
+import logging
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Optional, List, Deque
+
+import torch
+import torch.nn.functional as F
+from torch import Tensor
+from transformers import DynamicCache
+
+from ..modules.cond_enc import T3Cond
+from .sampler import T3Sampler
+from .runaway_guard import RunawayGuard
+
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class T3Request:
+    """
+    One utterance to be decoded by `T3BatchEngine`, with its own sampling parameters.
+
+    `text_tokens` is a 1D tensor that already includes the start / stop text tokens. A positive `cfg_weight`
+    gives the request two rows in the batch (cond and uncond), otherwise it decodes a single cond row.
+    """
+    t3_cond: T3Cond
+    text_tokens: Tensor
+    cfg_weight: float = 0.5
+    temperature: float = 0.8
+    top_p: float = 1.0
+    min_p: float = 0.05
+    repetition_penalty: float = 1.2
+    max_new_tokens: int = 1000
+    runaway_guard: bool = True  # stop early on loops, long silences or too many tokens, see `RunawayGuard`
+
+    # populated by the engine
+    request_id: Optional[int] = None
+    speech_tokens: Optional[Tensor] = None  # (1, n) sampled tokens, including the EOS token if one was sampled
+    stop_reason: Optional[str] = None  # "eos", "max_new_tokens" or a `RunawayGuard` reason
+    finished: bool = False
+
+
+@dataclass
+class _ActiveRequest:
+    request: T3Request
+    n_rows: int
+    guard: Optional[RunawayGuard] = None
+    tokens: List[int] = field(default_factory=list)
+
+
+def _left_pad(x: Tensor, n: int, dim: int):
+    if n == 0:
+        return x
+    shape = list(x.shape)
+    shape[dim] = n
+    return torch.cat([x.new_zeros(shape), x], dim=dim)
+
+
+class T3BatchEngine:
+    """
+    Continuous-batching decode loop for `T3`: runs a single forward pass per step over every live request.
+
+    Each request owns one or two (CFG) rows of a left-padded KV cache, with its own position offset, sampling
+    parameters and EOS state. Finished requests leave the batch at the end of the step they finish on, and
+    queued requests are prefilled together and join at the start of the next step, so the batch stays full
+    while there is work.
+
+    Usage:
+        engine = T3BatchEngine(t3, max_batch_size=8)
+        for text_tokens in texts:
+            engine.submit(T3Request(t3_cond=conds, text_tokens=text_tokens))
+        for request in engine.run():
+            ... request.speech_tokens ...
+
+    The engine is not thread safe; drive `submit` and `step` from a single loop.
+    """
+
+    def __init__(self, t3: 'T3', max_batch_size: int = 8):
+        if t3.is_gpt:
+            raise NotImplementedError("batched decoding is only implemented for the Llama backbone")
+        if t3.hp.is_multilingual:
+            raise NotImplementedError("batched decoding does not run the alignment stream analyzer yet")
+        self.t3 = t3
+        self.max_batch_size = max_batch_size
+
+        self._queue: Deque[T3Request] = deque()
+        self._active: List[_ActiveRequest] = []
+        self._next_id = 0
+
+        # batch state, one row per (request, cfg branch)
+        self._cache: Optional[DynamicCache] = None
+        self._attention_mask: Optional[Tensor] = None  # (N, L), left padded
+        self._seq_lens: Optional[Tensor] = None  # (N,) number of valid cache entries per row
+        self._prefix_lens: Optional[Tensor] = None  # (N,) length of the prefilled prompt per row
+        self._logits: Optional[Tensor] = None  # (N, V) logits for the next token of every row
+
+        # request state, one row per request
+        self._sampler: Optional[T3Sampler] = None
+        self._cfg_weights: Optional[Tensor] = None  # (R, 1)
+        self._cond_rows: Optional[Tensor] = None  # (R,) batch row of each request's cond branch
+        self._uncond_rows: Optional[Tensor] = None  # (R,) uncond branch, or the cond row without CFG
+        self._row_requests: Optional[Tensor] = None  # (N,) request index of every batch row
+
+    @property
+    def has_work(self):
+        return len(self._queue) > 0 or len(self._active) > 0
+
+    @property
+    def num_active(self):
+        return len(self._active)
+
+    def submit(self, request: T3Request) -> int:
+        """Queue a request; it joins the batch at the next step with a free slot."""
+        request.request_id = self._next_id
+        self._next_id += 1
+        self._queue.append(request)
+        return request.request_id
+
+    @torch.inference_mode()
+    def run(self) -> List[T3Request]:
+        """Step until every queued request has finished. Returns them in order of completion."""
+        finished = []
+        while self.has_work:
+            finished.extend(self.step())
+        return finished
+
+    @torch.inference_mode()
+    def step(self) -> List[T3Request]:
+        """
+        Admit queued requests, sample one token for every live request and advance the batch by one forward
+        pass. Returns the requests that finished during this step.
+        """
+        joining = []
+        while self._queue and len(self._active) + len(joining) < self.max_batch_size:
+            joining.append(self._queue.popleft())
+        if joining:
+            self._admit(joining)
+
+        if not self._active:
+            return []
+
+        # sample the next token of every request at once
+        cond = self._logits.index_select(0, self._cond_rows)
+        uncond = self._logits.index_select(0, self._uncond_rows)
+        next_tokens = self._sampler(cond + self._cfg_weights * (cond - uncond))  # (R, 1)
+        row_tokens = next_tokens.index_select(0, self._row_requests)  # (N, 1)
+
+        finished, keep_requests, keep_rows = [], [], []
+        row = 0
+        for request_idx, (active, token) in enumerate(zip(self._active, next_tokens.view(-1).tolist())):
+            active.tokens.append(token)
+            request = active.request
+            if token == self.t3.hp.stop_speech_token:
+                request.stop_reason = "eos"
+            elif active.guard is not None and (reason := active.guard.step(token)) is not None:
+                logger.warning(f"runaway generation ({reason}) in request {request.request_id}")
+                del active.tokens[len(active.tokens) - active.guard.num_trim:]
+                request.stop_reason = reason
+            elif len(active.tokens) >= request.max_new_tokens:
+                request.stop_reason = "max_new_tokens"
+
+            if request.stop_reason is not None:
+                self.t3.stop_counts[request.stop_reason] += 1
+                request.speech_tokens = torch.tensor([active.tokens], dtype=torch.long, device=next_tokens.device)
+                request.finished = True
+                finished.append(active)
+            else:
+                keep_requests.append(request_idx)
+                keep_rows.extend(range(row, row + active.n_rows))
+            row += active.n_rows
+
+        if finished:
+            self._active = [a for a in self._active if not a.request.finished]
+            self._evict(keep_requests, keep_rows)
+            if keep_rows:
+                row_tokens = row_tokens.index_select(0, self._row_index(keep_rows))
+
+        if self._active:
+            self._decode(row_tokens)
+
+        return [a.request for a in finished]
+
+    def _row_index(self, rows: List[int]):
+        return torch.tensor(rows, dtype=torch.long, device=self._attention_mask.device)
+
+    def _admit(self, requests: List[T3Request]):
+        t3 = self.t3
+        device = t3.device
+        bos_token = torch.tensor([[t3.hp.start_speech_token]], dtype=torch.long, device=device)
+
+        embeds, samplers = [], []
+        for request in requests:
+            n_rows = 2 if request.cfg_weight > 0.0 else 1
+            text_tokens = torch.atleast_2d(request.text_tokens).to(dtype=torch.long, device=device)
+            text_tokens = text_tokens[:1].expand(n_rows, -1)
+            request_embeds, _ = t3.prepare_inference_embeds(
+                t3_cond=request.t3_cond,
+                text_tokens=text_tokens,
+                cfg_weight=request.cfg_weight,
+            )
+            embeds.append(request_embeds)
+
+            # the BOS token counts as generated for the repetition penalty
+            sampler = T3Sampler(
+                1,
+                t3.hp.speech_tokens_dict_size,
+                temperature=request.temperature,
+                top_p=request.top_p,
+                min_p=request.min_p,
+                repetition_penalty=float(request.repetition_penalty),
+                device=device,
+            )
+            sampler.update(bos_token)
+            samplers.append(sampler)
+
+        # left-pad the joining prefixes to a common length and prefill them together
+        max_len = max(e.size(1) for e in embeds)
+        inputs_embeds = torch.cat([_left_pad(e, max_len - e.size(1), dim=1) for e in embeds], dim=0)
+        attention_mask = torch.cat([
+            _left_pad(torch.ones(e.size(0), e.size(1), dtype=torch.long, device=device), max_len - e.size(1), dim=1)
+            for e in embeds
+        ], dim=0)
+        position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)
+
+        output = t3.tfmr(
+            inputs_embeds=inputs_embeds,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=DynamicCache(),
+            use_cache=True,
+            return_dict=True,
+        )
+        logits = t3.speech_head(output.last_hidden_state[:, -1])
+        self._merge(output.past_key_values, attention_mask, logits)
+
+        cfg_weights = torch.tensor([[r.cfg_weight] for r in requests], dtype=logits.dtype, device=device)
+        if self._sampler is None:
+            self._sampler, self._cfg_weights = T3Sampler.cat(samplers), cfg_weights
+        else:
+            self._sampler = T3Sampler.cat([self._sampler] + samplers)
+            self._cfg_weights = torch.cat([self._cfg_weights, cfg_weights])
+
+        self._active.extend(
+            _ActiveRequest(r, e.size(0), guard=t3.new_runaway_guard(r.text_tokens) if r.runaway_guard else None)
+            for r, e in zip(requests, embeds)
+        )
+        self._update_row_maps()
+
+    def _update_row_maps(self):
+        cond_rows, uncond_rows, row_requests = [], [], []
+        for request_idx, active in enumerate(self._active):
+            cond_rows.append(len(row_requests))
+            uncond_rows.append(len(row_requests) + active.n_rows - 1)
+            row_requests.extend([request_idx] * active.n_rows)
+        self._cond_rows = self._row_index(cond_rows)
+        self._uncond_rows = self._row_index(uncond_rows)
+        self._row_requests = self._row_index(row_requests)
+
+    def _merge(self, cache: DynamicCache, attention_mask: Tensor, logits: Tensor):
+        seq_lens = attention_mask.sum(-1)
+        if self._cache is None:
+            self._cache, self._attention_mask, self._logits = cache, attention_mask, logits
+            self._seq_lens, self._prefix_lens = seq_lens, seq_lens
+            return
+
+        # left-pad whichever side is shorter, then stack the rows
+        old_len, new_len = self._attention_mask.size(1), attention_mask.size(1)
+        old_pad, new_pad = max(new_len - old_len, 0), max(old_len - new_len, 0)
+        for layer_idx in range(len(self._cache.key_cache)):
+            for old, new in (
+                (self._cache.key_cache, cache.key_cache),
+                (self._cache.value_cache, cache.value_cache),
+            ):
+                old[layer_idx] = torch.cat([
+                    _left_pad(old[layer_idx], old_pad, dim=2),
+                    _left_pad(new[layer_idx], new_pad, dim=2),
+                ], dim=0)
+        self._attention_mask = torch.cat([
+            _left_pad(self._attention_mask, old_pad, dim=1),
+            _left_pad(attention_mask, new_pad, dim=1),
+        ], dim=0)
+        self._seq_lens = torch.cat([self._seq_lens, seq_lens])
+        self._prefix_lens = torch.cat([self._prefix_lens, seq_lens])
+        self._logits = torch.cat([self._logits, logits])
+
+    def _evict(self, keep_requests: List[int], keep_rows: List[int]):
+        if not keep_rows:
+            self._cache = self._attention_mask = self._logits = None
+            self._seq_lens = self._prefix_lens = None
+            self._sampler = self._cfg_weights = None
+            self._cond_rows = self._uncond_rows = self._row_requests = None
+            return
+
+        keep_requests = self._row_index(keep_requests)
+        self._sampler.select(keep_requests)
+        self._cfg_weights = self._cfg_weights.index_select(0, keep_requests)
+
+        keep = self._row_index(keep_rows)
+        self._attention_mask = self._attention_mask.index_select(0, keep)
+        self._seq_lens = self._seq_lens.index_select(0, keep)
+        self._prefix_lens = self._prefix_lens.index_select(0, keep)
+        self._logits = self._logits.index_select(0, keep)
+        self._update_row_maps()
+
+        # drop leading columns that are padding for every remaining row
+        trim = int((self._attention_mask.size(1) - self._seq_lens).min())
+        self._attention_mask = self._attention_mask[:, trim:]
+        for cache_list in (self._cache.key_cache, self._cache.value_cache):
+            for layer_idx in range(len(cache_list)):
+                cache_list[layer_idx] = cache_list[layer_idx].index_select(0, keep)[:, :, trim:]
+
+    def _decode(self, next_tokens: Tensor):
+        t3 = self.t3
+        # the n-th sampled token sits at speech position n (the start-of-speech token is at 0)
+        positions = (self._seq_lens - self._prefix_lens + 1)[:, None]
+
+        inputs_embeds = t3.speech_emb(next_tokens) + t3.speech_pos_emb.get_fixed_embedding(positions)
+        self._attention_mask = F.pad(self._attention_mask, (0, 1), value=1)
+
+        output = t3.tfmr(
+            inputs_embeds=inputs_embeds,
+            attention_mask=self._attention_mask,
+            position_ids=self._seq_lens[:, None],
+            past_key_values=self._cache,
+            use_cache=True,
+            return_dict=True,
+        )
+        self._cache = output.past_key_values
+        self._seq_lens = self._seq_lens + 1
+        self._logits = t3.speech_head(output.last_hidden_state[:, -1])
@@ -0,0 +1,45 @@
+from dataclasses import dataclass
+from typing import List
+
+from torch import Tensor
+from transformers import DynamicCache
+
+
+@dataclass
+class T3PrefixCache:
+    """
+    Key / value snapshot of the T3 conditioning prefix (speaker, prompt speech, emotion) for one voice and
+    exaggeration value, as produced by `T3.prefill_conditioning`. Every layer holds (B_cond, H, len_cond, head_dim),
+    with B_cond = 1 unless the conditionals themselves are batched.
+
+    The prefix only attends to itself, so the snapshot is valid for any text that follows it, and a single row
+    serves both the cond and uncond CFG rows. The tensors are never written to: dynamic caches built from it concatenate into
+    new tensors, and static caches receive a copy.
+    """
+    key_cache: List[Tensor]
+    value_cache: List[Tensor]
+
+    @property
+    def len_cond(self):
+        return self.key_cache[0].size(2)
+
+    def to(self, device):
+        self.key_cache = [k.to(device=device) for k in self.key_cache]
+        self.value_cache = [v.to(device=device) for v in self.value_cache]
+        return self
+
+    def legacy_cache(self, batch_size=1):
+        """Tuple of per-layer (key, value), as taken by HF's GPT2Model, broadcast to `batch_size` rows."""
+        return tuple(
+            (k.expand(batch_size, -1, -1, -1), v.expand(batch_size, -1, -1, -1))
+            for k, v in zip(self.key_cache, self.value_cache)
+        )
+
+    def dynamic_cache(self, batch_size=1) -> DynamicCache:
+        return DynamicCache.from_legacy_cache(self.legacy_cache(batch_size))
+
+    def copy_to(self, cache):
+        """Writes the snapshot at the start of a preallocated (static) cache, broadcast over its batch."""
+        for k_buf, v_buf, k, v in zip(cache.key_cache, cache.value_cache, self.key_cache, self.value_cache):
+            k_buf[:, :, :k.size(2)].copy_(k)
+            v_buf[:, :, :v.size(2)].copy_(v)
@@ -0,0 +1,79 @@
+from typing import List, Optional
+
+from ...s3gen.const import S3GEN_SIL
+
+
+# reasons reported by `RunawayGuard.step`
+TOKEN_BUDGET = "token_budget"
+LOOP = "loop"
+SILENCE = "silence"
+
+
+class RunawayGuard:
+    """
+    Stops speech token generation that has gone off the rails, from the sampled tokens alone (no attention
+    maps, unlike `AlignmentStreamAnalyzer`), for one sequence:
+        * token budget: more speech tokens than `tokens_per_text_token` per text token (plus `min_budget`)
+        * loop: the last tokens repeat with a period of up to `max_period` tokens, at least `min_repeats`
+          times and over at least `min_loop_len` tokens; runs of the silence token are left to the next check
+        * silence: more than `max_silence_run` silence tokens in a row (25 tokens per second)
+
+    `step` costs O(max_period) python operations per token. When it fires, `num_trim` is the number of trailing
+    tokens that are repetitions, which the caller should drop.
+    """
+
+    def __init__(
+        self,
+        n_text_tokens: int,
+        *,
+        tokens_per_text_token: float = 6.0,
+        min_budget: int = 50,
+        max_period: int = 50,
+        min_repeats: int = 3,
+        min_loop_len: int = 40,
+        silence_token: int = S3GEN_SIL,
+        max_silence_run: int = 50,
+    ):
+        self.budget = int(min_budget + tokens_per_text_token * n_text_tokens)
+        self.max_period = max_period
+        self.min_repeats = min_repeats
+        self.min_loop_len = min_loop_len
+        self.silence_token = silence_token
+        self.max_silence_run = max_silence_run
+
+        self.tokens: List[int] = []
+        # matches[p - 1]: how many of the latest tokens equal the token p steps before them
+        self._matches = [0] * max_period
+        # index of the latest non-silence token, to leave loops of pure silence to the silence check
+        self._last_non_silence = -1
+        self._silence_run = 0
+        self.num_trim = 0
+
+    def step(self, token: int) -> Optional[str]:
+        """Records the next sampled token. Returns the reason to stop generating, or None."""
+        tokens = self.tokens
+        t = len(tokens)
+        tokens.append(token)
+
+        if token == self.silence_token:
+            self._silence_run += 1
+        else:
+            self._silence_run = 0
+            self._last_non_silence = t
+
+        for p in range(1, min(self.max_period, t) + 1):
+            matches = self._matches[p - 1] + 1 if tokens[t - p] == token else 0
+            self._matches[p - 1] = matches
+            # the latest `matches + p` tokens have period p
+            if (
+                matches >= max(p * (self.min_repeats - 1), self.min_loop_len - p)
+                and self._last_non_silence > t - p
+            ):
+                self.num_trim = matches  # keep a single period
+                return LOOP
+
+        if self._silence_run > self.max_silence_run:
+            return SILENCE
+        if len(tokens) > self.budget:
+            return TOKEN_BUDGET
+        return None
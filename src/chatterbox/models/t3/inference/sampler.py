@@ -0,0 +1,138 @@
+import math
+from typing import Union, List, Optional
+
+import torch
+from torch import Tensor
+
+
+def _per_row(value: Union[float, Tensor], batch_size: int, dtype, device):
+    value = torch.as_tensor(value, dtype=dtype, device=device).reshape(-1)
+    return value.expand(batch_size).unsqueeze(1).contiguous()  # (B, 1)
+
+
+class T3Sampler:
+    """
+    Fused, batched sampling stage for speech tokens. Applies the repetition penalty, temperature, top-k,
+    min-p and top-p in one vectorized pass, with a single sort of the vocabulary, and samples the next token.
+
+    Previously sampled tokens are tracked in a per-sequence `counts` tensor (B, V) instead of a growing list of
+    ids. Every sampling parameter is either a python scalar shared by all rows or a (B,) tensor.
+
+    The filters follow the semantics of HF's `RepetitionPenaltyLogitsProcessor`, `TemperatureLogitsWarper`,
+    `TopKLogitsWarper`, `MinPLogitsWarper` and `TopPLogitsWarper`, applied in that order. Disabled values
+    are `repetition_penalty=1`, `temperature=1`, `top_k=0`, `min_p=0` and `top_p=1`.
+
+    With `penalty_last`, the repetition penalty comes after the other filters instead, and only reweights the
+    tokens they kept: the order of the processor list Turbo has always sampled with.
+    """
+
+    # per-row tensors, (B, V) or (B, 1)
+    ROW_STATE = ("counts", "repetition_penalty", "temperature", "top_k", "log_min_p", "top_p")
+
+    def __init__(
+        self,
+        batch_size: int,
+        vocab_size: int,
+        *,
+        temperature: Union[float, Tensor] = 1.0,
+        top_k: Union[int, Tensor] = 0,
+        top_p: Union[float, Tensor] = 1.0,
+        min_p: Union[float, Tensor] = 0.0,
+        repetition_penalty: Union[float, Tensor] = 1.0,
+        penalty_last: bool = False,
+        device=None,
+    ):
+        self.vocab_size = vocab_size
+        self.penalty_last = penalty_last
+        self.counts = torch.zeros(batch_size, vocab_size, dtype=torch.int32, device=device)
+
+        f32 = torch.float32
+        self.repetition_penalty = _per_row(repetition_penalty, batch_size, f32, device)
+        self.temperature = _per_row(temperature, batch_size, f32, device)
+        top_k = _per_row(top_k, batch_size, torch.long, device)
+        self.top_k = torch.where(top_k > 0, top_k, vocab_size)
+        # min-p compared in log space, relative to the top logit; log(0) = -inf disables it
+        self.log_min_p = _per_row(min_p, batch_size, f32, device).log()
+        # top-p >= 1 disables it, so also ignore rounding error in the cumulative sum
+        top_p = _per_row(top_p, batch_size, f32, device)
+        self.top_p = torch.where(top_p < 1.0, top_p, math.inf)
+
+        self._ranks = torch.arange(vocab_size, device=device)
+
+    @property
+    def batch_size(self):
+        return self.counts.size(0)
+
+    def update(self, tokens: Tensor, count: int = 1):
+        """Record `tokens` (B, n) as generated, for the repetition penalty; `count=-1` forgets them again."""
+        tokens = tokens.view(self.batch_size, -1)
+        self.counts.scatter_add_(1, tokens, torch.full_like(tokens, count, dtype=self.counts.dtype))
+
+    def select(self, rows: Tensor):
+        """Keep only `rows` (in the given order), eg when finished sequences leave a batch."""
+        for name in self.ROW_STATE:
+            setattr(self, name, getattr(self, name).index_select(0, rows))
+        return self
+
+    @classmethod
+    def cat(cls, samplers: List['T3Sampler']) -> 'T3Sampler':
+        """
+        A new sampler with the rows of `samplers` stacked, eg when sequences join a batch. They must share the
+        vocabulary and `penalty_last`; the inputs are left untouched.
+        """
+        first = samplers[0]
+        assert all(s.vocab_size == first.vocab_size for s in samplers), "samplers with different vocabularies"
+        assert all(s.penalty_last == first.penalty_last for s in samplers), "samplers with different penalty orders"
+        out = cls.__new__(cls)
+        out.vocab_size = first.vocab_size
+        out.penalty_last = first.penalty_last
+        out._ranks = first._ranks
+        for name in cls.ROW_STATE:
+            setattr(out, name, torch.cat([getattr(s, name) for s in samplers]))
+        return out
+
+    def _penalize(self, logits: Tensor, counts: Tensor):
+        penalized = torch.where(logits < 0, logits * self.repetition_penalty, logits / self.repetition_penalty)
+        return torch.where(counts > 0, penalized, logits)
+
+    def _sorted_probs(self, logits: Tensor, counts: Tensor):
+        logits = logits.float()
+
+        if not self.penalty_last:
+            logits = self._penalize(logits, counts)
+        logits = logits / self.temperature
+
+        sorted_logits, sorted_idx = logits.sort(dim=-1, descending=True)
+        remove = self._ranks >= self.top_k
+        remove |= sorted_logits < sorted_logits[:, :1] + self.log_min_p
+        sorted_logits = sorted_logits.masked_fill(remove, -math.inf)
+
+        # drop a token once the more likely tokens already cover `top_p`; the most likely one is always kept
+        probs = sorted_logits.softmax(dim=-1)
+        exclusive_cumsum = probs.cumsum(dim=-1) - probs
+        if not self.penalty_last:
+            probs = probs.masked_fill(exclusive_cumsum >= self.top_p, 0.0)
+            return probs, sorted_idx
+
+        sorted_logits = sorted_logits.masked_fill(exclusive_cumsum >= self.top_p, -math.inf)
+        sorted_logits = self._penalize(sorted_logits, counts.gather(-1, sorted_idx))
+        return sorted_logits.softmax(dim=-1), sorted_idx
+
+    def probs(self, logits: Tensor, counts: Optional[Tensor] = None) -> Tensor:
+        """
+        The (unnormalized) distribution `__call__` samples from, in vocabulary order, without sampling or
+        recording anything. `counts` overrides the generated token counts, eg to score several candidate
+        continuations of a single sequence at once: (N, V) counts and logits with a sampler of batch size 1.
+        """
+        probs, sorted_idx = self._sorted_probs(logits, self.counts if counts is None else counts)
+        return torch.zeros_like(probs).scatter_(-1, sorted_idx, probs)
+
+    def __call__(self, logits: Tensor) -> Tensor:
+        """
+        Samples the next token of every row from `logits` (B, V) and records it. Returns (B, 1) token ids.
+        """
+        probs, sorted_idx = self._sorted_probs(logits, self.counts)
+        choice = torch.multinomial(probs, num_samples=1)
+        next_tokens = sorted_idx.gather(-1, choice)  # (B, 1)
+        self.update(next_tokens)
+        return next_tokens
@@ -0,0 +1,224 @@
+import logging
+from typing import List, Optional, Sequence
+
+import torch
+import torch.nn.functional as F
+from torch import Tensor
+
+from ..modules.cond_enc import T3Cond
+from .prefix_cache import T3PrefixCache
+from .runaway_guard import RunawayGuard
+from .sampler import T3Sampler
+
+
+logger = logging.getLogger(__name__)
+
+
+class PromptLookupDrafter:
+    """
+    Drafts speech tokens by prompt lookup: finds the latest earlier occurrence of the last `max_ngram` (down to
+    `min_ngram`) tokens among the voice's prompt speech tokens and the tokens generated so far, and proposes the
+    tokens that followed it. A draft costs a few dict lookups and needs no model.
+    """
+
+    def __init__(self, prompt_tokens: Sequence[int] = (), max_ngram: int = 3, min_ngram: int = 1):
+        self.max_ngram = max_ngram
+        self.min_ngram = min_ngram
+        self.history: List[int] = []
+        # n-gram -> index of the token that followed its latest occurrence
+        self._tables = {n: {} for n in range(min_ngram, max_ngram + 1)}
+        self.extend(prompt_tokens)
+
+    def extend(self, tokens: Sequence[int]):
+        for token in tokens:
+            t = len(self.history)
+            for n, table in self._tables.items():
+                if t >= n:
+                    table[tuple(self.history[t - n:t])] = t
+            self.history.append(token)
+
+    def propose(self, k: int) -> List[int]:
+        if k <= 0:
+            return []
+        for n in range(self.max_ngram, self.min_ngram - 1, -1):
+            if len(self.history) < n:
+                continue
+            start = self._tables[n].get(tuple(self.history[-n:]))
+            if start is not None:
+                return self.history[start:start + k]
+        return []
+
+
+class T3SpeculativeDecoder:
+    """
+    Speculative decoding for `T3`: a `PromptLookupDrafter` proposes up to `num_draft_tokens` speech tokens, and
+    T3 scores the pending token and all drafts (both CFG rows) in a single forward pass.
+
+    Drafts are accepted by exact rejection sampling against the distribution `T3.inference` samples from (CFG,
+    repetition penalty, temperature, min-p, top-p): draft `d` is kept with probability p(d), and on rejection
+    the token is resampled from p with `d` removed. As the drafter is deterministic, this is the standard
+    speculative sampling rule, so the output distribution is unchanged. The KV cache is cropped back past
+    the rejected drafts.
+
+    Statistics accumulate over every `generate` call, eg to report the acceptance rate.
+    """
+
+    def __init__(self, t3: 'T3', num_draft_tokens: int = 4, max_ngram: int = 3):
+        if t3.is_gpt:
+            raise NotImplementedError("speculative decoding is only implemented for the Llama backbone")
+        if t3.hp.is_multilingual:
+            raise NotImplementedError("speculative decoding does not run the alignment stream analyzer")
+        self.t3 = t3
+        self.num_draft_tokens = num_draft_tokens
+        self.max_ngram = max_ngram
+
+        self.num_steps = 0  # forward passes, including the prefill
+        self.num_drafted = 0
+        self.num_accepted = 0
+        self.num_generated = 0
+        self.stop_reason = None  # of the latest `generate` call
+
+    @property
+    def acceptance_rate(self):
+        return self.num_accepted / max(self.num_drafted, 1)
+
+    @property
+    def tokens_per_step(self):
+        return self.num_generated / max(self.num_steps, 1)
+
+    def _forward(self, inputs_embeds: Tensor, past_key_values, cfg: Tensor, num_logits_to_keep: int):
+        t3 = self.t3
+        output = t3.tfmr(
+            inputs_embeds=inputs_embeds,
+            past_key_values=past_key_values,
+            use_cache=True,
+            return_dict=True,
+        )
+        logits = t3.speech_head(output.last_hidden_state[:, -num_logits_to_keep:])  # (rows, T, V)
+        cond, uncond = logits[0], logits[-1]
+        return cond + cfg * (cond - uncond), output.past_key_values  # (T, V)
+
+    @torch.inference_mode()
+    def generate(
+        self,
+        *,
+        t3_cond: T3Cond,
+        text_tokens: Tensor,
+        cfg_weight=0.5,
+        temperature=0.8,
+        top_p=1.0,
+        min_p=0.05,
+        repetition_penalty=1.2,
+        max_new_tokens=1000,
+        stop_on_eos=True,
+        prefix_cache: Optional[T3PrefixCache] = None,
+        runaway_guard: Optional[RunawayGuard] = None,
+    ) -> Tensor:
+        """
+        Same arguments and output as the dynamic cache path of `T3.inference`: (1, n) speech tokens, including
+        the EOS token if one was sampled. Accepted tokens are fed to `runaway_guard` one at a time.
+        """
+        t3, hp = self.t3, self.t3.hp
+        text_tokens = torch.atleast_2d(text_tokens).to(dtype=torch.long, device=t3.device)
+        if prefix_cache is None:
+            prefix_cache = t3.prefill_conditioning(t3_cond)
+        inputs_embeds, _ = t3.prepare_inference_embeds(
+            t3_cond=t3_cond,
+            text_tokens=text_tokens,
+            cfg_weight=cfg_weight,
+            prefix_cache=prefix_cache,
+        )
+        device, n_rows = inputs_embeds.device, inputs_embeds.size(0)
+        cfg = torch.as_tensor(cfg_weight, device=device, dtype=inputs_embeds.dtype)
+
+        # the BOS token counts as generated for the repetition penalty
+        sampler = T3Sampler(
+            1,
+            hp.speech_tokens_dict_size,
+            temperature=temperature,
+            top_p=top_p,
+            min_p=min_p,
+            repetition_penalty=float(repetition_penalty),
+            device=device,
+        )
+        sampler.update(torch.tensor([[hp.start_speech_token]], dtype=torch.long, device=device))
+
+        prompt_tokens = t3_cond.cond_prompt_speech_tokens
+        drafter = PromptLookupDrafter(
+            [] if prompt_tokens is None else prompt_tokens[0].tolist(),
+            max_ngram=self.max_ngram,
+        )
+
+        # prefill; the first token has nothing to draft from
+        logits, past = self._forward(inputs_embeds, prefix_cache.dynamic_cache(n_rows), cfg, num_logits_to_keep=1)
+        tokens = [int(sampler(logits))]
+        drafter.extend(tokens)
+        self.num_steps += 1
+        if runaway_guard is not None:
+            runaway_guard.step(tokens[0])  # a single token never trips it
+
+        self.stop_reason = None
+        while self.stop_reason is None:
+            if stop_on_eos and tokens[-1] == hp.stop_speech_token:
+                self.stop_reason = "eos"
+                break
+            if len(tokens) >= max_new_tokens:
+                self.stop_reason = "max_new_tokens"
+                break
+
+            # the last sampled token is not in the cache yet; it sits at speech position len(tokens)
+            n = len(tokens)
+            drafts = drafter.propose(min(self.num_draft_tokens, max_new_tokens - n - 1))
+            input_ids = torch.tensor([[tokens[-1]] + drafts], dtype=torch.long, device=device)  # (1, m)
+            m = input_ids.size(1)
+            positions = torch.arange(n, n + m, device=device)
+            embeds = t3.speech_emb(input_ids) + t3.speech_pos_emb.get_fixed_embedding(positions)
+            logits, past = self._forward(embeds.expand(n_rows, -1, -1), past, cfg, num_logits_to_keep=m)  # (m, V)
+
+            # row j is the distribution after the first j drafts, so its repetition penalty counts them too
+            counts = sampler.counts.expand(m, -1).clone()
+            draft_ids = input_ids[0, 1:]
+            if drafts:
+                counts[1:] += F.one_hot(draft_ids, hp.speech_tokens_dict_size).cumsum(0).to(counts.dtype)
+            probs = sampler.probs(logits, counts)
+            probs = probs / probs.sum(dim=-1, keepdim=True)
+
+            num_accepted = 0
+            if drafts:
+                p_drafts = probs[:-1].gather(-1, draft_ids[:, None])[:, 0]
+                accepted = torch.rand_like(p_drafts) < p_drafts
+                num_accepted = int(accepted.long().cumprod(0).sum())
+
+            next_probs = probs[num_accepted]
+            if num_accepted < len(drafts):
+                # residual distribution max(0, p - q) for the deterministic draft q = one-hot(draft)
+                next_probs = next_probs.clone()
+                next_probs[drafts[num_accepted]] = 0
+            new_tokens = drafts[:num_accepted] + [int(torch.multinomial(next_probs, num_samples=1))]
+
+            # drop the rejected drafts from the cache
+            past.crop(past.get_seq_length() - (len(drafts) - num_accepted))
+
+            if stop_on_eos and hp.stop_speech_token in new_tokens:
+                new_tokens = new_tokens[:new_tokens.index(hp.stop_speech_token) + 1]
+            if runaway_guard is not None:
+                for j, token in enumerate(new_tokens):
+                    if stop_on_eos and token == hp.stop_speech_token:
+                        break
+                    self.stop_reason = runaway_guard.step(token)
+                    if self.stop_reason is not None:
+                        logger.warning(f"runaway generation ({self.stop_reason}), stopping at step {n + j + 1}")
+                        new_tokens = new_tokens[:j + 1]
+                        break
+            tokens.extend(new_tokens)
+            sampler.update(torch.tensor([new_tokens], dtype=torch.long, device=device))
+            drafter.extend(new_tokens)
+            if self.stop_reason is not None:
+                del tokens[len(tokens) - runaway_guard.num_trim:]
+
+            self.num_steps += 1
+            self.num_drafted += len(drafts)
+            self.num_accepted += num_accepted
+
+        self.num_generated += len(tokens)
+        return torch.tensor([tokens], dtype=torch.long, device=device)
@@ -0,0 +1,59 @@
+import torch
+import torch.nn.functional as F
+from torch import Tensor
+from transformers import GPT2Model
+
+
+class GPT2StaticCache:
+    """
+    Preallocated key / value buffers for every layer of a `GPT2Model`, written in place by
+    `gpt2_static_forward`. HF's GPT2 only supports the growing tuple cache, which concatenates on every step.
+    """
+
+    def __init__(self, config, batch_size: int, max_cache_len: int, device=None, dtype=torch.float32):
+        self.max_cache_len = max_cache_len
+        head_dim = config.n_embd // config.n_head
+        shape = (batch_size, config.n_head, max_cache_len, head_dim)
+        self.key_cache = [torch.zeros(shape, device=device, dtype=dtype) for _ in range(config.n_layer)]
+        self.value_cache = [torch.zeros(shape, device=device, dtype=dtype) for _ in range(config.n_layer)]
+        self.positions = torch.arange(max_cache_len, device=device)
+        # keep the buffers at fixed addresses across compiled steps
+        for buf in self.key_cache + self.value_cache:
+            torch._dynamo.mark_static_address(buf)
+
+
+def gpt2_static_forward(gpt2: GPT2Model, inputs_embeds: Tensor, cache: GPT2StaticCache, cache_position: Tensor):
+    """
+    Inference-only equivalent of `GPT2Model.forward` with a `GPT2StaticCache`: writes the keys / values of
+    `inputs_embeds` (B, T, C) at `cache_position` (T,) and attends to every earlier position. Shapes do not
+    depend on how much of the cache is filled, so the step can be captured by `torch.compile`.
+
+    Returns the final hidden states, (B, T, C).
+    """
+    B, T, C = inputs_embeds.shape
+    n_head = gpt2.config.n_head
+    head_dim = C // n_head
+
+    hidden_states = inputs_embeds + gpt2.wpe(cache_position)[None]
+    attn_mask = cache.positions[None, :] <= cache_position[:, None]  # (T, max_cache_len)
+
+    for layer_idx, block in enumerate(gpt2.h):
+        residual = hidden_states
+        hidden_states = block.ln_1(hidden_states)
+        query, key, value = block.attn.c_attn(hidden_states).split(C, dim=2)
+        query = query.view(B, T, n_head, head_dim).transpose(1, 2)
+        key = key.view(B, T, n_head, head_dim).transpose(1, 2)
+        value = value.view(B, T, n_head, head_dim).transpose(1, 2)
+
+        key_cache, value_cache = cache.key_cache[layer_idx], cache.value_cache[layer_idx]
+        key_cache.index_copy_(2, cache_position, key)
+        value_cache.index_copy_(2, cache_position, value)
+
+        attn_output = F.scaled_dot_product_attention(query, key_cache, value_cache, attn_mask=attn_mask)
+        attn_output = attn_output.transpose(1, 2).reshape(B, T, C)
+        hidden_states = residual + block.attn.c_proj(attn_output)
+
+        residual = hidden_states
+        hidden_states = residual + block.mlp(block.ln_2(hidden_states))
+
+    return gpt2.ln_f(hidden_states)
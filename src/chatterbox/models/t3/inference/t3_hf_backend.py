@@ -78,19 +78,19 @@ class T3HuggingfaceBackend(LlamaPreTrainedModel, GenerationMixin):
         output_attentions=False,
         output_hidden_states=True,
         return_dict=True,
+        num_logits_to_keep=0,
     ):
         """
         This is a method used by huggingface's generate() method.
         Overridden here to apply our custom layer norm and speech logit projection layers.
 
         :param inputs_embeds: (B, S, C) float32 tensor of conditioning inputs. If past key values are given,
-        S should be 1.
+        S is 1, unless they only hold the conditioning prefix (see `T3.prefill_conditioning`).
+        :param num_logits_to_keep: only project the last `num_logits_to_keep` positions to logits (0 for all).
+        With `output_attentions=False` and `output_hidden_states=False` this is the lean decoding path: every
+        layer keeps its SDPA kernel and only the final hidden state is kept.
         """
-        is_large_input = inputs_embeds.size(1) != 1
-        has_cache = past_key_values is not None and len(past_key_values) > 0
-        assert not (is_large_input and has_cache)
         assert return_dict
-        assert output_hidden_states
 
         tfmr_out = self.model(
             inputs_embeds=inputs_embeds,
@@ -100,9 +100,9 @@ class T3HuggingfaceBackend(LlamaPreTrainedModel, GenerationMixin):
             output_hidden_states=output_hidden_states,
             return_dict=True,
         )
-        hidden_states = tfmr_out.hidden_states[-1]  # (B, seq, dim)
+        hidden_states = tfmr_out.last_hidden_state  # (B, seq, dim), same as `hidden_states[-1]`
 
-        logits = self.speech_head(hidden_states)
+        logits = self.speech_head(hidden_states[:, -num_logits_to_keep:, :])
         # assert inputs_embeds.size(0) == 1 # (disabled for CFG)
 
         # NOTE: hallucination handler may modify logits to force emit an EOS token
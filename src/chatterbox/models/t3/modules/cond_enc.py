@@ -1,4 +1,4 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field, replace
 from typing import Optional
 
 import torch
@@ -13,6 +13,11 @@ class T3Cond:
     """
     Dataclass container for most / all conditioning info.
     TODO: serialization methods aren't used, keeping them around for convenience
+
+    `voice_cond_emb` memoizes the conditioning embeddings that do not depend on `emotion_adv` (see `T3CondEnc`);
+    it is computed on first use by the model and never saved. `voice_cond_key` ties it to the module and weights
+    that produced it and to the voice fields it was computed from (see `T3CondEnc.voice_key`), so it is computed
+    again after a weight or dtype change, by another model, or once a voice field is reassigned or moved.
     """
 
     speaker_emb: Tensor
@@ -20,9 +25,21 @@ class T3Cond:
     cond_prompt_speech_tokens: Optional[Tensor] = None
     cond_prompt_speech_emb: Optional[Tensor] = None
     emotion_adv: Optional[Tensor] = 0.5
+    voice_cond_emb: Optional[Tensor] = None
+    voice_cond_key: Optional[tuple] = field(default=None, repr=False)
+
+    def with_emotion_adv(self, emotion_adv) -> 'T3Cond':
+        "The same voice with another `emotion_adv`, sharing the voice embeddings computed so far."
+        return replace(self, emotion_adv=emotion_adv)
+
+    def saved_dict(self) -> dict:
+        "The fields to save, without the memoized embeddings."
+        return {k: v for k, v in self.__dict__.items() if k not in ("voice_cond_emb", "voice_cond_key")}
 
     def to(self, *, device=None, dtype=None):
-        "Cast to a device and dtype. Dtype casting is ignored for long/int tensors."
+        "Cast to a device and dtype. Dtype casting is ignored for long/int tensors; a dtype drops voice_cond_emb."
+        if dtype is not None:
+            self.voice_cond_emb = self.voice_cond_key = None
         for k, v in self.__dict__.items():
             if torch.is_tensor(v):
                 is_fp = type(v.view(-1)[0].item()) is not int
@@ -30,7 +47,7 @@ class T3Cond:
         return self
 
     def save(self, fpath):
-        torch.save(self.__dict__, fpath)
+        torch.save(self.saved_dict(), fpath)
 
     @staticmethod
     def load(fpath, map_location="cpu"):
@@ -61,7 +78,8 @@ class T3CondEnc(nn.Module):
         if hp.use_perceiver_resampler:
             self.perceiver = Perceiver()
 
-    def forward(self, cond: T3Cond):
+    def voice_embeds(self, cond: T3Cond):
+        """The conditioning embeddings of the voice: speaker, CLAP and prompt, ie all but the emotion one."""
         # Validate
         assert (cond.cond_prompt_speech_tokens is None) == (cond.cond_prompt_speech_emb is None), \
             "no embeddings for cond_prompt_speech_tokens"
@@ -81,17 +99,39 @@ class T3CondEnc(nn.Module):
         elif self.hp.use_perceiver_resampler:
             cond_prompt_speech_emb = self.perceiver(cond_prompt_speech_emb)
 
+        return torch.cat((cond_spkr, cond_clap, cond_prompt_speech_emb), dim=1)
+
+    def voice_key(self, cond: T3Cond) -> tuple:
+        """
+        What `voice_embeds(cond)` depends on: this module and the storage and version of its voice weights (which a
+        cast or `load_state_dict` change), and the storage of the voice fields of `cond`. A field written in place
+        is not detected; assign a new tensor instead.
+        """
+        params = [*self.spkr_enc.parameters(), *(self.perceiver.parameters() if self.perceiver is not None else [])]
+        weights = tuple((p.data_ptr(), p.dtype, 0 if p.is_inference() else p._version) for p in params)
+        fields = tuple(
+            None if t is None else t.data_ptr()
+            for t in (cond.speaker_emb, cond.clap_emb, cond.cond_prompt_speech_emb)
+        )
+        return id(self), weights, fields
+
+    def forward(self, cond: T3Cond):
+        # The voice embeddings (the Perceiver included) do not depend on the exaggeration, so outside of autograd
+        # they are computed once per voice and kept on `cond`; only the emotion embedding is added per call
+        if torch.is_grad_enabled():
+            voice_embeds = self.voice_embeds(cond)
+        else:
+            key = self.voice_key(cond)
+            if cond.voice_cond_emb is None or cond.voice_cond_key != key:
+                cond.voice_cond_emb = self.voice_embeds(cond)
+                cond.voice_cond_key = key
+            voice_embeds = cond.voice_cond_emb
+
         # Emotion Adv: must provide a value if this model uses emotion conditioning
-        cond_emotion_adv = empty  # (B, 0, dim)
-        if self.hp.emotion_adv:
-            assert cond.emotion_adv is not None
-            cond_emotion_adv = self.emotion_adv_fc(cond.emotion_adv.view(-1, 1, 1))
+        if not self.hp.emotion_adv:
+            return voice_embeds
+        assert cond.emotion_adv is not None
+        cond_emotion_adv = self.emotion_adv_fc(cond.emotion_adv.view(-1, 1, 1))
 
         # Concat and return
-        cond_embeds = torch.cat((
-            cond_spkr,
-            cond_clap,
-            cond_prompt_speech_emb,
-            cond_emotion_adv,
-        ), dim=1)
-        return cond_embeds
+        return torch.cat((voice_embeds, cond_emotion_adv), dim=1)
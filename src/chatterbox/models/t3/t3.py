@@ -1,6 +1,8 @@
 # Copyright (c) 2025 Resemble AI
 # MIT License
 import logging
+from collections import Counter
+from contextlib import nullcontext
 from typing import Union, Optional, List
 
 logger = logging.getLogger(__name__)
@@ -9,15 +11,7 @@ from tqdm import tqdm
 import torch
 import torch.nn.functional as F
 from torch import nn, Tensor
-from transformers import LlamaModel, LlamaConfig, GPT2Config, GPT2Model
-from transformers.generation.logits_process import (
-    LogitsProcessorList,
-    RepetitionPenaltyLogitsProcessor,
-    TemperatureLogitsWarper,
-    TopKLogitsWarper,
-    TopPLogitsWarper,
-    MinPLogitsWarper,
-)
+from transformers import LlamaModel, LlamaConfig, GPT2Config, GPT2Model, StaticCache, DynamicCache
 from .modules.learned_pos_emb import LearnedPositionEmbeddings
 
 from .modules.cond_enc import T3CondEnc, T3Cond
@@ -25,12 +19,20 @@ from .modules.t3_config import T3Config
 from .llama_configs import LLAMA_CONFIGS
 from .inference.t3_hf_backend import T3HuggingfaceBackend
 from .inference.alignment_stream_analyzer import AlignmentStreamAnalyzer
+from .inference.static_cache import GPT2StaticCache, gpt2_static_forward
+from .inference.sampler import T3Sampler
+from .inference.prefix_cache import T3PrefixCache
+from .inference.speculative import T3SpeculativeDecoder
+from .inference.runaway_guard import RunawayGuard
 from ..utils import AttrDict
 
 
 logger = logging.getLogger(__name__)
 
 
+STATIC_CACHE_BUCKET = 256
+
+
 def _ensure_BOT_EOT(text_tokens: Tensor, hp):
     B = text_tokens.size(0)
     assert (text_tokens == hp.start_text_token).int().sum() >= B, "missing start_text_token"
@@ -85,6 +87,9 @@ class T3(nn.Module):
         self.text_head = nn.Linear(self.cfg.hidden_size, hp.text_tokens_dict_size, bias=False)
         self.speech_head = nn.Linear(self.cfg.hidden_size, hp.speech_tokens_dict_size, bias=self.is_gpt)
         self.compiled = False
+        self._compiled_static_step = None
+        # why generations stopped: "eos", "max_new_tokens" or a `RunawayGuard` reason
+        self.stop_counts = Counter()
 
     @property
     def device(self):
@@ -100,6 +105,40 @@ class T3(nn.Module):
                 t3_cond.cond_prompt_speech_emb += self.speech_pos_emb(t3_cond.cond_prompt_speech_tokens)
         return self.cond_enc(t3_cond)  # (B, len_cond, dim)
 
+    @torch.inference_mode()
+    def prefill_conditioning(self, t3_cond: T3Cond) -> T3PrefixCache:
+        """
+        Runs the backbone over the conditioning prefix alone and returns its KV cache. The prefix does not depend
+        on the text, so the snapshot can be passed as `prefix_cache` to every generation with the same
+        conditionals, whose prefill then only covers the text and start-of-speech positions.
+        """
+        cond_emb = self.prepare_conditioning(t3_cond)  # (B_cond, len_cond, dim), usually B_cond = 1
+        if self.is_gpt:
+            # HF's GPT2 returns the legacy tuple of per-layer (key, value)
+            past_key_values = self.tfmr(inputs_embeds=cond_emb, use_cache=True, return_dict=True).past_key_values
+            key_cache = [k for k, _ in past_key_values]
+            value_cache = [v for _, v in past_key_values]
+        else:
+            past_key_values = self.tfmr(
+                inputs_embeds=cond_emb,
+                past_key_values=DynamicCache(),
+                use_cache=True,
+                return_dict=True,
+            ).past_key_values
+            key_cache, value_cache = list(past_key_values.key_cache), list(past_key_values.value_cache)
+        return T3PrefixCache(key_cache=key_cache, value_cache=value_cache)
+
+    def _embed_text_and_speech(self, text_tokens: Tensor, speech_tokens: Tensor, cfg_weight: float = 0.0):
+        text_emb = self.text_emb(text_tokens)  # (B, len_text, dim)
+        if cfg_weight > 0.0 and not self.is_gpt:
+            text_emb[1].zero_()  # CFG uncond
+
+        speech_emb = self.speech_emb(speech_tokens)  # (B, len_speech, dim)
+        if self.hp.input_pos_emb == "learned":
+            text_emb = text_emb + self.text_pos_emb(text_tokens)
+            speech_emb = speech_emb + self.speech_pos_emb(speech_tokens)
+        return text_emb, speech_emb
+
     def prepare_input_embeds(
         self,
         *,
@@ -110,14 +149,7 @@ class T3(nn.Module):
     ):
         # prepare input embeddings (skip backbone tranformer embeddings)
         cond_emb = self.prepare_conditioning(t3_cond)  # (B, len_cond, dim)
-        text_emb = self.text_emb(text_tokens)  # (B, len_text, dim)
-        if cfg_weight > 0.0 and not self.is_gpt:
-            text_emb[1].zero_()  # CFG uncond
-
-        speech_emb = self.speech_emb(speech_tokens)  # (B, len_speech, dim)
-        if self.hp.input_pos_emb == "learned":
-            text_emb = text_emb + self.text_pos_emb(text_tokens)
-            speech_emb = speech_emb + self.speech_pos_emb(speech_tokens)
+        text_emb, speech_emb = self._embed_text_and_speech(text_tokens, speech_tokens, cfg_weight)
         len_cond = cond_emb.size(1)
 
         if cond_emb.size(0) != text_emb.size(0):
@@ -130,6 +162,84 @@ class T3(nn.Module):
         ])  # (B, length, dim)
         return embeds, len_cond
 
+    def prepare_inference_embeds(
+        self,
+        *,
+        t3_cond: T3Cond,
+        text_tokens: torch.LongTensor,
+        initial_speech_tokens: Optional[Tensor] = None,
+        cfg_weight: float = 0.0,
+        prefix_cache: Optional[T3PrefixCache] = None,
+    ):
+        """
+        Prefill embeds for speech token inference: conditioning, text, initial speech tokens and a trailing
+        start-of-speech embedding, which is how the released checkpoints have always been sampled. With a
+        `prefix_cache`, the conditioning is already in the cache and is left out of the embeds.
+
+        Returns `(embeds, len_cond)` with one row per row of `text_tokens`.
+        """
+        if initial_speech_tokens is None:
+            initial_speech_tokens = self.hp.start_speech_token * torch.ones_like(text_tokens[:, :1])
+
+        if prefix_cache is None:
+            embeds, len_cond = self.prepare_input_embeds(
+                t3_cond=t3_cond,
+                text_tokens=text_tokens,
+                speech_tokens=initial_speech_tokens,
+                cfg_weight=cfg_weight,
+            )
+        else:
+            text_emb, speech_emb = self._embed_text_and_speech(text_tokens, initial_speech_tokens, cfg_weight)
+            embeds, len_cond = torch.cat([text_emb, speech_emb], dim=1), prefix_cache.len_cond
+
+        bos_token = torch.tensor([[self.hp.start_speech_token]], dtype=torch.long, device=embeds.device)
+        bos_embed = self.speech_emb(bos_token)  # shape: (1, 1, embed_dim)
+        bos_embed = bos_embed + self.speech_pos_emb.get_fixed_embedding(0)
+        bos_embed = bos_embed.expand(embeds.size(0), -1, -1)
+
+        return torch.cat([embeds, bos_embed], dim=1), len_cond
+
+    def new_runaway_guard(self, text_tokens: Tensor) -> RunawayGuard:
+        """A `RunawayGuard` with a speech token budget for the (last dim of) `text_tokens`."""
+        # GPT2's BPE tokens (Turbo) span several characters, the English tokenizer's one or two
+        tokens_per_text_token = 20.0 if self.is_gpt else 6.0
+        return RunawayGuard(text_tokens.size(-1), tokens_per_text_token=tokens_per_text_token)
+
+    def _new_static_cache(self, batch_size: int, max_cache_len: int, device, dtype):
+        # round the capacity up so that prompts of similar lengths share one compiled step
+        max_cache_len = -(-max_cache_len // STATIC_CACHE_BUCKET) * STATIC_CACHE_BUCKET
+        if self.is_gpt:
+            return GPT2StaticCache(self.cfg, batch_size, max_cache_len, device=device, dtype=dtype)
+        return StaticCache(config=self.cfg, batch_size=batch_size, max_cache_len=max_cache_len, device=device, dtype=dtype)
+
+    def _static_step(self, inputs_embeds: Tensor, past_key_values, cache_position: Tensor):
+        """
+        Runs the backbone over `inputs_embeds` with a preallocated cache, writing at `cache_position`.
+        Returns the speech logits of the last position, (B, V).
+        """
+        if self.is_gpt:
+            hidden_states = gpt2_static_forward(self.tfmr, inputs_embeds, past_key_values, cache_position)
+        else:
+            hidden_states = self.tfmr(
+                inputs_embeds=inputs_embeds,
+                past_key_values=past_key_values,
+                cache_position=cache_position,
+                use_cache=True,
+                return_dict=True,
+            ).last_hidden_state
+        return self.speech_head(hidden_states[:, -1])
+
+    def get_static_step(self, compile=False):
+        """
+        The single-token decode step for the static cache. With `compile`, the step is compiled once per
+        model; its shapes are fixed so later generations reuse the same graph.
+        """
+        if not compile:
+            return self._static_step
+        if self._compiled_static_step is None:
+            self._compiled_static_step = torch.compile(self._static_step, dynamic=False)
+        return self._compiled_static_step
+
     def forward(
         self,
         *,
@@ -245,58 +355,101 @@ class T3(nn.Module):
         length_penalty=1.0,
         repetition_penalty=1.2,
         cfg_weight=0.5,
+
+        # decoding backend
+        cache_implementation="dynamic",
+        compile=False,
+        prefix_cache: Optional[T3PrefixCache]=None,
+        num_draft_tokens=0,
+        runaway_guard=True,
     ):
         """
         Args:
             text_tokens: a 1D (unbatched) or 2D (batched) tensor.
+            cache_implementation: "dynamic" grows HF's KV cache every step; "static" preallocates it for
+                the prompt plus `max_new_tokens` and writes in place, so every decode step has the same shape.
+            compile: `torch.compile` the static decode step (ignored for the dynamic cache, and while the
+                alignment stream analyzer is attached).
+            prefix_cache: the snapshot returned by `prefill_conditioning(t3_cond)`, reused across calls. Without
+                it, the snapshot is computed for this call only.
+            num_draft_tokens: with a positive value, decode speculatively (see `T3SpeculativeDecoder`), verifying
+                up to this many drafted tokens per forward pass. The sampled distribution is unchanged. Only for
+                the English model with the dynamic cache.
+            runaway_guard: stop early on speech token loops, long silences or too many tokens for the text (see
+                `RunawayGuard`). Only used without the alignment stream analyzer, ie for the English model.
         """
         # Validate / sanitize inputs
         assert prepend_prompt_speech_tokens is None, "not implemented"
         _ensure_BOT_EOT(text_tokens, self.hp)
         text_tokens = torch.atleast_2d(text_tokens).to(dtype=torch.long, device=self.device)
 
-        # Default initial speech to a single start-of-speech token
-        if initial_speech_tokens is None:
-            initial_speech_tokens = self.hp.start_speech_token * torch.ones_like(text_tokens[:, :1])
+        # The conditioning prefix is identical for the CFG cond and uncond rows: run it through the backbone
+        # once, and fork its KV cache into both rows before the text, which is all the prefill below covers.
+        if prefix_cache is None:
+            prefix_cache = self.prefill_conditioning(t3_cond)
+
+        guard = self.new_runaway_guard(text_tokens) if runaway_guard and not self.hp.is_multilingual else None
+
+        if num_draft_tokens > 0:
+            assert cache_implementation == "dynamic", "speculative decoding crops the dynamic cache"
+            decoder = T3SpeculativeDecoder(self, num_draft_tokens=num_draft_tokens)
+            speech_tokens = decoder.generate(
+                t3_cond=t3_cond,
+                text_tokens=text_tokens,
+                cfg_weight=cfg_weight,
+                temperature=temperature,
+                top_p=top_p,
+                min_p=min_p,
+                repetition_penalty=repetition_penalty,
+                max_new_tokens=max_new_tokens or self.hp.max_speech_tokens,
+                stop_on_eos=stop_on_eos,
+                prefix_cache=prefix_cache,
+                runaway_guard=guard,
+            )
+            self.stop_counts[decoder.stop_reason] += 1
+            logger.info(f"speculative decoding: {decoder.acceptance_rate:.0%} of drafts accepted, "
+                        f"{decoder.tokens_per_step:.2f} tokens per forward pass")
+            return speech_tokens
 
-        # Prepare custom input embeds
-        embeds, len_cond = self.prepare_input_embeds(
+        # Prepare custom input embeds (text and start-of-speech)
+        inputs_embeds, len_cond = self.prepare_inference_embeds(
             t3_cond=t3_cond,
             text_tokens=text_tokens,
-            speech_tokens=initial_speech_tokens,
+            initial_speech_tokens=initial_speech_tokens,
             cfg_weight=cfg_weight,
+            prefix_cache=prefix_cache,
         )
 
         # In order to use the standard HF generate method, we need to extend some methods to inject our custom logic
         # Note the llama-specific logic. Other tfmr types can be added later.
 
-        self.compiled = False
-
         # TODO? synchronize the expensive compile function
         # with self.compile_lock:
         if not self.compiled:
-            # Default to None for English models, only create for multilingual
-            alignment_stream_analyzer = None
-            if self.hp.is_multilingual:
-                alignment_stream_analyzer = AlignmentStreamAnalyzer(
-                    self.tfmr,
-                    None,
-                    text_tokens_slice=(len_cond, len_cond + text_tokens.size(-1)),
-                    alignment_layer_idx=9, # TODO: hparam or something?
-                    eos_idx=self.hp.stop_speech_token,
-                )
-                assert alignment_stream_analyzer.eos_idx == self.hp.stop_speech_token
-
+            # Built once per model; it holds no per-request state.
             patched_model = T3HuggingfaceBackend(
                 config=self.cfg,
                 llama=self.tfmr,
                 speech_enc=self.speech_emb,
                 speech_head=self.speech_head,
-                alignment_stream_analyzer=alignment_stream_analyzer,
             )
             self.patched_model = patched_model
             self.compiled = True
 
+        # Default to None for English models, only create for multilingual. Its hooks are attached for this call
+        # only, and removed when the `with` block below exits.
+        alignment_stream_analyzer = None
+        if self.hp.is_multilingual:
+            alignment_stream_analyzer = AlignmentStreamAnalyzer(
+                self.tfmr,
+                None,
+                text_tokens_slice=(len_cond, len_cond + text_tokens.size(-1)),
+                alignment_layer_idx=9, # TODO: hparam or something?
+                eos_idx=self.hp.stop_speech_token,
+                query_offset=len_cond,
+            )
+            assert alignment_stream_analyzer.eos_idx == self.hp.stop_speech_token
+
         # # Run normal generate method, which calls our custom extended methods
         # return self.patched_model.generate(
         #     inputs=initial_speech_tokens,
@@ -314,174 +467,236 @@ class T3(nn.Module):
         #     # cache_implementation=None if not self.compiled else "static",
         # )
 
-        device = embeds.device
-
-        bos_token = torch.tensor([[self.hp.start_speech_token]], dtype=torch.long, device=device)
-        bos_embed = self.speech_emb(bos_token)  # shape: (B, 1, embed_dim)
-        bos_embed = bos_embed + self.speech_pos_emb.get_fixed_embedding(0)
-
-        # batch_size=2 for CFG
-        bos_embed = torch.cat([bos_embed, bos_embed])
-
-        # Combine condition and BOS token for the initial input
-        inputs_embeds = torch.cat([embeds, bos_embed], dim=1)
-
-        # Track generated token ids; start with the BOS token.
-        generated_ids = bos_token.clone()
-        predicted = []  # To store the predicted tokens
-
-        # Instantiate the logits processors.
-        top_p_warper = TopPLogitsWarper(top_p=top_p)
-        min_p_warper = MinPLogitsWarper(min_p=min_p)
-        top_p_warper = TopPLogitsWarper(top_p=top_p)
-        repetition_penalty_processor = RepetitionPenaltyLogitsProcessor(penalty=float(repetition_penalty))
-
-        # ---- Initial Forward Pass (no kv_cache yet) ----
-        output = self.patched_model(
-            inputs_embeds=inputs_embeds,
-            past_key_values=None,
-            use_cache=True,
-            output_attentions=True,
-            output_hidden_states=True,
-            return_dict=True,
-        )
-        # Initialize kv_cache with the full context.
-        past = output.past_key_values
-
-        # ---- Generation Loop using kv_cache ----
-        for i in tqdm(range(max_new_tokens), desc="Sampling", dynamic_ncols=True):
-            logits_step = output.logits[:, -1, :]
-            # CFG combine  → (1, V)
-            cond   = logits_step[0:1, :]
-            uncond = logits_step[1:2, :]
-            cfg = torch.as_tensor(cfg_weight, device=cond.device, dtype=cond.dtype)
-            logits = cond + cfg * (cond - uncond)
-            
-            # Apply alignment stream analyzer integrity checks
-            if self.patched_model.alignment_stream_analyzer is not None:
-                if logits.dim() == 1:            # guard in case something upstream squeezed
-                    logits = logits.unsqueeze(0) # (1, V)
-                # Pass the last generated token for repetition tracking
-                last_token = generated_ids[0, -1].item() if len(generated_ids[0]) > 0 else None
-                logits = self.patched_model.alignment_stream_analyzer.step(logits, next_token=last_token)  # (1, V)
-
-            # Apply repetition penalty
-            ids_for_proc = generated_ids[:1, ...]   # batch = 1
-            logits = repetition_penalty_processor(ids_for_proc, logits)  # expects (B,V)
-            
-            # Apply temperature scaling.
-            if temperature != 1.0:
-                logits = logits / temperature
-                
-            # Apply min_p and top_p filtering
-            logits = min_p_warper(ids_for_proc, logits)
-            logits = top_p_warper(ids_for_proc, logits)
-
-            # Convert logits to probabilities and sample the next token.
-            probs = torch.softmax(logits, dim=-1)
-            next_token = torch.multinomial(probs, num_samples=1)  # shape: (B, 1)
-
-            predicted.append(next_token)
-            generated_ids = torch.cat([generated_ids, next_token], dim=1)
-
-            # Check for EOS token.
-            if next_token.view(-1) == self.hp.stop_speech_token:
-                logger.info(f"✅ EOS token detected! Stopping generation at step {i+1}")
-                break
-
-            # Get embedding for the new token.
-            next_token_embed = self.speech_emb(next_token)
-            next_token_embed = next_token_embed + self.speech_pos_emb.get_fixed_embedding(i + 1)
-
-            #  For CFG
-            next_token_embed = torch.cat([next_token_embed, next_token_embed])
-
-            # Forward pass with only the new token and the cached past.
-            output = self.patched_model(
-                inputs_embeds=next_token_embed,
-                past_key_values=past,
-                output_attentions=True,
-                output_hidden_states=True,
-                return_dict=True,
+        with alignment_stream_analyzer if alignment_stream_analyzer is not None else nullcontext():
+            device = inputs_embeds.device
+            bos_token = torch.tensor([[self.hp.start_speech_token]], dtype=torch.long, device=device)
+            max_new_tokens = max_new_tokens or self.hp.max_speech_tokens
+            use_static_cache = cache_implementation == "static"
+
+            # Preallocated buffer for the predicted tokens
+            predicted = torch.empty(1, max_new_tokens, dtype=torch.long, device=device)
+            num_predicted = 0
+
+            # Repetition penalty, temperature, min_p and top_p; the BOS token counts as generated.
+            sampler = T3Sampler(
+                1,
+                self.hp.speech_tokens_dict_size,
+                temperature=temperature,
+                top_p=top_p,
+                min_p=min_p,
+                repetition_penalty=float(repetition_penalty),
+                device=device,
             )
-            # Update the kv_cache.
-            past = output.past_key_values
+            sampler.update(bos_token)
+            last_token = bos_token
+
+            # ---- Initial Forward Pass (the kv_cache holds the conditioning prefix) ----
+            if use_static_cache:
+                len_prefix = len_cond + inputs_embeds.size(1)
+                past = self._new_static_cache(inputs_embeds.size(0), len_prefix + max_new_tokens, device, inputs_embeds.dtype)
+                prefix_cache.copy_to(past)
+                cache_positions = torch.arange(len_prefix + max_new_tokens, device=device)
+                # the analyzer reads attentions through hooks, which a compiled graph would bypass
+                step = self.get_static_step(compile and alignment_stream_analyzer is None)
+                logits_step = self._static_step(inputs_embeds, past, cache_positions[len_cond:len_prefix])
+            else:
+                output = self.patched_model(
+                    inputs_embeds=inputs_embeds,
+                    past_key_values=prefix_cache.dynamic_cache(inputs_embeds.size(0)),
+                    use_cache=True,
+                    output_attentions=False,
+                    output_hidden_states=False,
+                    return_dict=True,
+                    num_logits_to_keep=1,
+                )
+                # Initialize kv_cache with the full context.
+                past = output.past_key_values
+                logits_step = output.logits[:, -1, :]
+
+            # ---- Generation Loop using kv_cache ----
+            for i in tqdm(range(max_new_tokens), desc="Sampling", dynamic_ncols=True):
+                # CFG combine  → (1, V)
+                cond   = logits_step[0:1, :]
+                uncond = logits_step[1:2, :]
+                cfg = torch.as_tensor(cfg_weight, device=cond.device, dtype=cond.dtype)
+                logits = cond + cfg * (cond - uncond)
+            
+                # Apply alignment stream analyzer integrity checks
+                if alignment_stream_analyzer is not None:
+                    if logits.dim() == 1:            # guard in case something upstream squeezed
+                        logits = logits.unsqueeze(0) # (1, V)
+                    # Pass the last generated token for repetition tracking
+                    logits = alignment_stream_analyzer.step(logits, next_token=last_token)  # (1, V)
+
+                # Sample the next token.
+                next_token = sampler(logits)  # shape: (B, 1)
+
+                predicted[:, i:i + 1] = next_token
+                num_predicted = i + 1
+                last_token = next_token
+
+                # Check for EOS token.
+                if stop_on_eos and next_token.view(-1) == self.hp.stop_speech_token:
+                    logger.info(f"✅ EOS token detected! Stopping generation at step {i+1}")
+                    if alignment_stream_analyzer is not None:
+                        result = alignment_stream_analyzer.result()
+                        if result.long_tail or result.repetition:
+                            logger.warning(f"forced EOS token, {result.long_tail=}, {result.repetition=}")
+                    self.stop_counts["eos"] += 1
+                    break
+
+                # Check for runaway generation.
+                if guard is not None and (reason := guard.step(int(next_token))) is not None:
+                    logger.warning(f"runaway generation ({reason}), stopping at step {i+1}")
+                    num_predicted -= guard.num_trim
+                    self.stop_counts[reason] += 1
+                    break
+
+                # Get embedding for the new token.
+                next_token_embed = self.speech_emb(next_token)
+                next_token_embed = next_token_embed + self.speech_pos_emb.get_fixed_embedding(i + 1)
+
+                #  For CFG
+                next_token_embed = torch.cat([next_token_embed, next_token_embed])
+
+                # Forward pass with only the new token and the cached past.
+                if use_static_cache:
+                    logits_step = step(next_token_embed, past, cache_positions[len_prefix + i:len_prefix + i + 1])
+                    continue
+
+                output = self.patched_model(
+                    inputs_embeds=next_token_embed,
+                    past_key_values=past,
+                    output_attentions=False,
+                    output_hidden_states=False,
+                    return_dict=True,
+                    num_logits_to_keep=1,
+                )
+                # Update the kv_cache.
+                past = output.past_key_values
+                logits_step = output.logits[:, -1, :]
+            else:
+                self.stop_counts["max_new_tokens"] += 1
 
-        # Concatenate all predicted tokens along the sequence dimension.
-        predicted_tokens = torch.cat(predicted, dim=1)  # shape: (B, num_tokens)
-        return predicted_tokens
+            return predicted[:, :num_predicted]  # shape: (B, num_tokens)
 
     @torch.inference_mode()
     def inference_turbo(self, t3_cond, text_tokens, temperature=0.8, top_k=1000, top_p=0.95, repetition_penalty=1.2,
-                        max_gen_len=1000):
-
-        logits_processors = LogitsProcessorList()
-        if temperature > 0 and temperature != 1.0:
-            logits_processors.append(TemperatureLogitsWarper(temperature))
-        if top_k > 0:
-            logits_processors.append(TopKLogitsWarper(top_k))
-        if top_p < 1.0:
-            logits_processors.append(TopPLogitsWarper(top_p))
-        if repetition_penalty != 1.0:
-            logits_processors.append(RepetitionPenaltyLogitsProcessor(repetition_penalty))
-
-
+                        max_gen_len=1000, cache_implementation="dynamic", compile=False, prefix_cache=None,
+                        runaway_guard=True):
+        """
+        Args:
+            cache_implementation: "dynamic" (HF's growing tuple cache) or "static" (preallocated for the prompt
+                plus `max_gen_len` tokens and written in place).
+            compile: `torch.compile` the static decode step.
+            prefix_cache: the snapshot returned by `prefill_conditioning(t3_cond)`, so the prefill skips the
+                speaker and prompt speech positions.
+            runaway_guard: stop a single sequence early on speech token loops, long silences or too many tokens
+                for the text (see `RunawayGuard`).
+        """
         speech_start_token = self.hp.start_speech_token * torch.ones_like(text_tokens[:, :1])
-        embeds, _ = self.prepare_input_embeds(
-            t3_cond=t3_cond,
-            text_tokens=text_tokens,
-            speech_tokens=speech_start_token,
-            cfg_weight=0.0,
-        )
-
-        generated_speech_tokens = []
-
-        llm_outputs = self.tfmr(
-            inputs_embeds=embeds,
-            use_cache=True
+        if prefix_cache is None:
+            embeds, _ = self.prepare_input_embeds(
+                t3_cond=t3_cond,
+                text_tokens=text_tokens,
+                speech_tokens=speech_start_token,
+                cfg_weight=0.0,
+            )
+            len_cached = 0
+        else:
+            text_emb, speech_emb = self._embed_text_and_speech(text_tokens, speech_start_token)
+            embeds = torch.cat([text_emb, speech_emb], dim=1)
+            len_cached = prefix_cache.len_cond
+
+        sampler = T3Sampler(
+            embeds.size(0),
+            self.hp.speech_tokens_dict_size,
+            temperature=temperature if temperature > 0 else 1.0,
+            top_k=top_k,
+            top_p=top_p,
+            repetition_penalty=repetition_penalty,
+            penalty_last=True,
+            device=embeds.device,
         )
+        sampler.update(speech_start_token)
+        generated_speech_tokens = torch.empty(embeds.size(0), max_gen_len + 1, dtype=torch.long, device=embeds.device)
+
+        use_static_cache = cache_implementation == "static"
+        if use_static_cache:
+            len_prefix = len_cached + embeds.size(1)
+            # the loop below runs up to `max_gen_len` forward passes after the prefill
+            past_key_values = self._new_static_cache(embeds.size(0), len_prefix + max_gen_len, embeds.device, embeds.dtype)
+            if prefix_cache is not None:
+                prefix_cache.copy_to(past_key_values)
+            cache_positions = torch.arange(len_prefix + max_gen_len, device=embeds.device)
+            step = self.get_static_step(compile)
+            speech_logits = self._static_step(embeds, past_key_values, cache_positions[len_cached:len_prefix])
+        elif prefix_cache is not None:
+            # an explicit mask, so that the text attends to the cached prefix
+            attention_mask = torch.ones(embeds.size(0), len_cached + embeds.size(1), dtype=torch.long, device=embeds.device)
+            llm_outputs = self.tfmr(
+                inputs_embeds=embeds,
+                past_key_values=prefix_cache.legacy_cache(embeds.size(0)),
+                attention_mask=attention_mask,
+                use_cache=True
+            )
+        else:
+            llm_outputs = self.tfmr(
+                inputs_embeds=embeds,
+                use_cache=True
+            )
+        if not use_static_cache:
+            hidden_states = llm_outputs[0]
+            past_key_values = llm_outputs.past_key_values
 
-        hidden_states = llm_outputs[0]
-        past_key_values = llm_outputs.past_key_values
-
-        speech_hidden = hidden_states[:, -1:]
-        speech_logits = self.speech_head(speech_hidden)
+            speech_hidden = hidden_states[:, -1:]
+            speech_logits = self.speech_head(speech_hidden)[:, -1, :]
 
-        processed_logits = logits_processors(speech_start_token, speech_logits[:, -1, :])
-        probs = F.softmax(processed_logits, dim=-1)
-        next_speech_token = torch.multinomial(probs, num_samples=1)
+        next_speech_token = sampler(speech_logits)
+        # the start token is only penalized for the first token, as Turbo's processor list always did
+        sampler.update(speech_start_token, count=-1)
 
-        generated_speech_tokens.append(next_speech_token)
+        generated_speech_tokens[:, :1] = next_speech_token
+        num_generated = 1
         current_speech_token = next_speech_token
 
-        for _ in tqdm(range(max_gen_len)):
-            current_speech_embed = self.speech_emb(current_speech_token)
+        guard = self.new_runaway_guard(text_tokens) if runaway_guard and embeds.size(0) == 1 else None
+        if guard is not None:
+            guard.step(next_speech_token.item())  # a single token never trips it
 
-            llm_outputs = self.tfmr(
-                inputs_embeds=current_speech_embed,
-                past_key_values=past_key_values,
-                use_cache=True
-            )
+        for i in tqdm(range(max_gen_len)):
+            current_speech_embed = self.speech_emb(current_speech_token)
 
-            hidden_states = llm_outputs[0]
-            past_key_values = llm_outputs.past_key_values
-            speech_logits = self.speech_head(hidden_states)
+            if use_static_cache:
+                speech_logits = step(current_speech_embed, past_key_values, cache_positions[len_prefix + i:len_prefix + i + 1])
+            else:
+                llm_outputs = self.tfmr(
+                    inputs_embeds=current_speech_embed,
+                    past_key_values=past_key_values,
+                    use_cache=True
+                )
 
-            input_ids = torch.cat(generated_speech_tokens, dim=1)
-            processed_logits = logits_processors(input_ids, speech_logits[:, -1, :])
-            if torch.all(processed_logits == -float("inf")):
-                print("Warning: All logits are -inf")
-                break
+                hidden_states = llm_outputs[0]
+                past_key_values = llm_outputs.past_key_values
+                speech_logits = self.speech_head(hidden_states)[:, -1, :]
 
-            probs = F.softmax(processed_logits, dim=-1)
-            next_speech_token = torch.multinomial(probs, num_samples=1)
+            next_speech_token = sampler(speech_logits)
 
-            generated_speech_tokens.append(next_speech_token)
+            generated_speech_tokens[:, i + 1:i + 2] = next_speech_token
+            num_generated = i + 2
             current_speech_token = next_speech_token
             if torch.all(next_speech_token == self.hp.stop_speech_token):
+                stop_reason = "eos"
+                break
+            if guard is not None and (stop_reason := guard.step(next_speech_token.item())) is not None:
+                logger.warning(f"runaway generation ({stop_reason}), stopping at step {num_generated}")
+                num_generated -= guard.num_trim
                 break
+        else:
+            stop_reason = "max_new_tokens"
+        self.stop_counts[stop_reason] += 1
 
-        all_tokens = torch.cat(generated_speech_tokens, dim=1)
+        all_tokens = generated_speech_tokens[:, :num_generated]
 
         # Remove EOS token if present
         if all_tokens.size(1) > 0 and all_tokens[0, -1] == self.hp.stop_speech_token:
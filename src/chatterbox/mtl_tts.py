@@ -1,10 +1,9 @@
-from dataclasses import dataclass
+from collections import OrderedDict
+from dataclasses import dataclass, field
 from pathlib import Path
 import os
 
 
-import librosa
-import numpy as np
 import torch
 import perth
 import torch.nn.functional as F
@@ -13,11 +12,13 @@ from huggingface_hub import snapshot_download
 
 from .models.t3 import T3
 from .models.t3.modules.t3_config import T3Config
-from .models.s3tokenizer import S3_SR, drop_invalid_tokens
+from .models.s3tokenizer import S3_SR, S3_TOKEN_HOP, drop_invalid_tokens
 from .models.s3gen import S3GEN_SR, S3Gen
 from .models.tokenizers import MTLTokenizer
 from .models.voice_encoder import VoiceEncoder
 from .models.t3.modules.cond_enc import T3Cond
+from .models.t3.inference.prefix_cache import T3PrefixCache
+from .reference import ConditionalsCache, ReferenceAudio
 
 
 REPO_ID = "ResembleAI/chatterbox"
@@ -108,21 +109,45 @@ class Conditionals:
         - prompt_feat
         - prompt_feat_len
         - embedding
+        - prompt_cache (optional, flow encoder state of the prompt tokens, never saved)
+    - T3 conditioning prefix KV caches, per exaggeration value (computed on demand, never saved), the
+      `max_prefix_caches` most recently used ones
     """
     t3: T3Cond
     gen: dict
+    t3_prefix_caches: OrderedDict = field(default_factory=OrderedDict, repr=False)
+    max_prefix_caches: int = field(default=4, repr=False)
 
     def to(self, device):
         self.t3 = self.t3.to(device=device)
         for k, v in self.gen.items():
-            if torch.is_tensor(v):
+            if torch.is_tensor(v) or k == "prompt_cache":
                 self.gen[k] = v.to(device=device)
+        for prefix_cache in self.t3_prefix_caches.values():
+            prefix_cache.to(device=device)
         return self
 
+    def t3_prefix_cache(self, t3: T3) -> T3PrefixCache:
+        """
+        The KV cache of the T3 conditioning prefix for the current `t3` conditionals. It only depends on the voice
+        and the exaggeration, so it is computed once per exaggeration value and reused by every generation. Only
+        the `max_prefix_caches` most recently used exaggeration values are kept.
+        """
+        exaggeration = float(self.t3.emotion_adv.view(-1)[0]) if self.t3.emotion_adv is not None else None
+        if exaggeration in self.t3_prefix_caches:
+            self.t3_prefix_caches.move_to_end(exaggeration)
+            return self.t3_prefix_caches[exaggeration]
+        prefix_cache = t3.prefill_conditioning(self.t3)
+        if self.max_prefix_caches > 0:
+            self.t3_prefix_caches[exaggeration] = prefix_cache
+            while len(self.t3_prefix_caches) > self.max_prefix_caches:
+                self.t3_prefix_caches.popitem(last=False)
+        return prefix_cache
+
     def save(self, fpath: Path):
         arg_dict = dict(
-            t3=self.t3.__dict__,
-            gen=self.gen
+            t3=self.t3.saved_dict(),
+            gen={k: v for k, v in self.gen.items() if k != "prompt_cache"},
         )
         torch.save(arg_dict, fpath)
 
@@ -144,6 +169,7 @@ class ChatterboxMultilingualTTS:
         tokenizer: MTLTokenizer,
         device: str,
         conds: Conditionals = None,
+        conds_cache_size: int = 32,
     ):
         self.sr = S3GEN_SR  # sample rate of synthesized audio
         self.t3 = t3
@@ -152,6 +178,8 @@ class ChatterboxMultilingualTTS:
         self.tokenizer = tokenizer
         self.device = device
         self.conds = conds
+        # conditionals of the reference clips seen so far, see `prepare_conditionals`
+        self.conds_cache = ConditionalsCache(conds_cache_size)
         self.watermarker = perth.PerthImplicitWatermarker()
 
     @classmethod
@@ -236,28 +264,52 @@ class ChatterboxMultilingualTTS:
             )
         return cls.from_local(ckpt_dir, device)
     
-    def prepare_conditionals(self, wav_fpath, exaggeration=0.5):
-        ## Load reference wav
-
-        s3gen_ref_wav, _sr = librosa.load(wav_fpath, sr=S3GEN_SR)
-        s3gen_ref_wav = s3gen_ref_wav.astype(np.float32)
-
-        ref_16k_wav = librosa.resample(s3gen_ref_wav, orig_sr=S3GEN_SR, target_sr=S3_SR)
-        ref_16k_wav = ref_16k_wav.astype(np.float32)
+    def fuse_for_inference(self):
+        """
+        Fuses S3Gen for inference in place (see `S3Token2Wav.fuse_for_inference`): same outputs up to float
+        rounding, but the model can no longer be trained or have weights loaded into it.
+        """
+        self.s3gen.fuse_for_inference()
+        return self
 
-        s3gen_ref_wav = s3gen_ref_wav[:self.DEC_COND_LEN]
+    def prepare_conditionals(self, wav_fpath, exaggeration=0.5, cache_s3gen_prompt=False, s3gen_prompt_sec=None):
+        ## Decode the reference wav; it is only resampled if the voice is not cached
+        wav_24, digest = ReferenceAudio.decode(wav_fpath)
+
+        # a voice seen before skips the whole pipeline; the exaggeration is only a T3 scalar, so it is not part of
+        # the key and the cached conditionals (and their per-exaggeration T3 prefix caches) serve every value
+        key = (digest, cache_s3gen_prompt, s3gen_prompt_sec)
+        if (conds := self.conds_cache.get(key)) is not None:
+            if float(exaggeration) != float(conds.t3.emotion_adv[0, 0, 0]):
+                conds.t3 = conds.t3.with_emotion_adv(exaggeration * torch.ones(1, 1, 1)).to(device=self.device)
+            self.conds = conds
+            return
+
+        ## Resample the reference wav, once at each of the S3Gen and S3 rates
+        ref = ReferenceAudio.from_decoded(wav_24, self.device, digest=digest)
+
+        # the S3Gen prompt is the start of the clip, or its most voiced `s3gen_prompt_sec` (shorter is faster)
+        if s3gen_prompt_sec is None:
+            # one tokenizer pass over the start of the clip serves both the T3 and the S3Gen prompts
+            prompt_ref = ref.head(max(self.ENC_COND_LEN / S3_SR, self.DEC_COND_LEN / S3GEN_SR))
+            s3gen_ref = prompt_ref.head(self.DEC_COND_LEN / S3GEN_SR)
+        else:
+            prompt_ref = s3gen_ref = ref
+            s3gen_prompt_sec = min(s3gen_prompt_sec, self.DEC_COND_LEN / S3GEN_SR)
+        speech_tokens = prompt_ref.tokenize(self.s3gen.tokenizer)
 
-        s3gen_ref_dict = self.s3gen.embed_ref(s3gen_ref_wav, S3GEN_SR, device=self.device)
+        s3gen_ref_dict = self.s3gen.embed_ref(
+            s3gen_ref.wav_24, S3GEN_SR, device=self.device, cache_prompt=cache_s3gen_prompt,
+            prompt_budget_s=s3gen_prompt_sec, ref_wav_16=s3gen_ref.wav_16, ref_speech_tokens=speech_tokens,
+        )
 
         # Speech cond prompt tokens
         t3_cond_prompt_tokens = None
         if plen := self.t3.hp.speech_cond_prompt_len:
-            s3_tokzr = self.s3gen.tokenizer
-            t3_cond_prompt_tokens, _ = s3_tokzr.forward([ref_16k_wav[:self.ENC_COND_LEN]], max_len=plen)
-            t3_cond_prompt_tokens = torch.atleast_2d(t3_cond_prompt_tokens).to(self.device)
+            t3_cond_prompt_tokens = speech_tokens[:, :min(plen, self.ENC_COND_LEN // S3_TOKEN_HOP)]
 
         # Voice-encoder speaker embedding
-        ve_embed = torch.from_numpy(self.ve.embeds_from_wavs([ref_16k_wav], sample_rate=S3_SR))
+        ve_embed = torch.from_numpy(self.ve.embeds_from_wavs([ref.wav_16.cpu().numpy()], sample_rate=S3_SR))
         ve_embed = ve_embed.mean(axis=0, keepdim=True).to(self.device)
 
         t3_cond = T3Cond(
@@ -266,6 +318,7 @@ class ChatterboxMultilingualTTS:
             emotion_adv=exaggeration * torch.ones(1, 1, 1),
         ).to(device=self.device)
         self.conds = Conditionals(t3_cond, s3gen_ref_dict)
+        self.conds_cache.put(key, self.conds)
 
     def generate(
         self,
@@ -294,12 +347,8 @@ class ChatterboxMultilingualTTS:
 
         # Update exaggeration if needed
         if float(exaggeration) != float(self.conds.t3.emotion_adv[0, 0, 0].item()):
-            _cond: T3Cond = self.conds.t3
-            self.conds.t3 = T3Cond(
-                speaker_emb=_cond.speaker_emb,
-                cond_prompt_speech_tokens=_cond.cond_prompt_speech_tokens,
-                emotion_adv=exaggeration * torch.ones(1, 1, 1),
-            ).to(device=self.device)
+            # same voice: the T3 voice embeddings computed so far are kept, only the emotion one changes
+            self.conds.t3 = self.conds.t3.with_emotion_adv(exaggeration * torch.ones(1, 1, 1)).to(device=self.device)
 
         # Norm and tokenize text
         text = punc_norm(text)
@@ -321,6 +370,7 @@ class ChatterboxMultilingualTTS:
                 repetition_penalty=repetition_penalty,
                 min_p=min_p,
                 top_p=top_p,
+                prefix_cache=self.conds.t3_prefix_cache(self.t3),
             )
             # Extract only the conditional batch.
             speech_tokens = speech_tokens[0]
@@ -0,0 +1,110 @@
+import hashlib
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Callable, Hashable, Optional, Tuple
+
+import librosa
+import numpy as np
+import torch
+
+from .models.s3tokenizer import S3_SR
+from .models.s3gen import S3GEN_SR
+from .models.s3gen.s3gen import get_resampler
+
+
+@dataclass
+class ReferenceAudio:
+    """
+    A reference clip decoded once, and resampled once per consumer rate with the cached resampler kernels:
+    - wav_24 (L,): at S3GEN_SR, for the S3Gen prompt mels
+    - wav_16 (L * 2 / 3,): at S3_SR, for the S3 tokenizer, the S3Gen speaker encoder and the voice encoder
+    - speech_tokens (1, T): S3 tokens of wav_16 (`tokenize`), shared by the T3 and S3Gen prompts
+    - digest: hash of the decoded clip (before `transform`), the `ConditionalsCache` key of the voice
+    """
+    wav_24: torch.Tensor
+    wav_16: torch.Tensor
+    speech_tokens: Optional[torch.Tensor] = None
+    digest: Optional[str] = None
+
+    @staticmethod
+    def decode(wav_fpath) -> Tuple[np.ndarray, str]:
+        """
+        The clip decoded at S3GEN_SR (L,) and its digest, enough to look the voice up in a `ConditionalsCache`
+        before paying for any resampling.
+        """
+        wav_24, _sr = librosa.load(wav_fpath, sr=S3GEN_SR)
+        wav_24 = wav_24.astype(np.float32)
+        return wav_24, hashlib.sha1(wav_24.tobytes()).hexdigest()
+
+    @classmethod
+    def from_decoded(
+        cls, wav_24: np.ndarray, device, digest: Optional[str] = None, transform: Optional[Callable] = None,
+    ) -> 'ReferenceAudio':
+        """`transform(wav, sr)` (eg loudness normalization) applies to the decoded clip before resampling."""
+        if transform is not None:
+            wav_24 = transform(wav_24, S3GEN_SR).astype(np.float32)
+        wav_24 = torch.from_numpy(wav_24).to(device)
+        wav_16 = get_resampler(S3GEN_SR, S3_SR, device)(wav_24)
+        return cls(wav_24, wav_16, digest=digest)
+
+    @classmethod
+    def load(cls, wav_fpath, device, transform: Optional[Callable] = None) -> 'ReferenceAudio':
+        """`decode` then `from_decoded`."""
+        wav_24, digest = cls.decode(wav_fpath)
+        return cls.from_decoded(wav_24, device, digest=digest, transform=transform)
+
+    @property
+    def duration(self) -> float:
+        return self.wav_24.size(0) / S3GEN_SR
+
+    def head(self, seconds: float) -> 'ReferenceAudio':
+        """The first `seconds` of the clip, at both rates (the tokens are dropped)."""
+        return ReferenceAudio(self.wav_24[:int(seconds * S3GEN_SR)], self.wav_16[:int(seconds * S3_SR)])
+
+    def tokenize(self, tokenizer) -> torch.Tensor:
+        """S3 tokens (1, T) of the whole clip, computed once."""
+        if self.speech_tokens is None:
+            self.speech_tokens, _ = tokenizer([self.wav_16])
+        return self.speech_tokens
+
+
+class ConditionalsCache:
+    """
+    In-process LRU cache of the `Conditionals` of the TTS wrappers, keyed by the `ReferenceAudio.digest` of the
+    reference clip and the `prepare_conditionals` options that shape them, so that a voice sent again skips the
+    whole conditioning pipeline. Holds at most `max_size` entries (0 disables it); `hits` and `misses` count the
+    lookups.
+    """
+
+    def __init__(self, max_size: int = 32):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key: Hashable):
+        conds = self.entries.get(key)
+        if conds is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return conds
+
+    def put(self, key: Hashable, conds):
+        if self.max_size <= 0:
+            return
+        self.entries[key] = conds
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = self.misses = 0
+
+    def stats(self) -> dict:
+        return dict(hits=self.hits, misses=self.misses, size=len(self.entries), max_size=self.max_size)
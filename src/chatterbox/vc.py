@@ -2,7 +2,6 @@ from pathlib import Path
 
 
 import librosa
-import numpy as np
 import torch
 import perth
 from huggingface_hub import hf_hub_download
@@ -10,6 +9,7 @@ from safetensors.torch import load_file
 
 from .models.s3tokenizer import S3_SR
 from .models.s3gen import S3GEN_SR, S3Gen
+from .reference import ReferenceAudio
 
 
 REPO_ID = "ResembleAI/chatterbox"
@@ -89,14 +89,18 @@ class ChatterboxVC:
 
         return cls.from_local(Path(local_path).parent, device)
 
-    def set_target_voice(self, wav_fpath):
-        ## Load reference wav
-
-        s3gen_ref_wav, _sr = librosa.load(wav_fpath, sr=S3GEN_SR)
-        s3gen_ref_wav = s3gen_ref_wav.astype(np.float32)
+    def fuse_for_inference(self):
+        """
+        Fuses S3Gen for inference in place (see `S3Token2Wav.fuse_for_inference`): same outputs up to float
+        rounding, but the model can no longer be trained or have weights loaded into it.
+        """
+        self.s3gen.fuse_for_inference()
+        return self
 
-        s3gen_ref_wav = s3gen_ref_wav[:self.DEC_COND_LEN]
-        self.ref_dict = self.s3gen.embed_ref(s3gen_ref_wav, S3GEN_SR, device=self.device)
+    def set_target_voice(self, wav_fpath):
+        ## Load reference wav, once at each of the S3Gen and S3 rates
+        ref = ReferenceAudio.load(wav_fpath, self.device).head(self.DEC_COND_LEN / S3GEN_SR)
+        self.ref_dict = self.s3gen.embed_ref(ref.wav_24, S3GEN_SR, device=self.device, ref_wav_16=ref.wav_16)
 
     def generate(
         self,
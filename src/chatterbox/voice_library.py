@@ -0,0 +1,132 @@
+import json
+import os
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Iterable
+
+import torch
+from safetensors import safe_open
+from safetensors.torch import save_file
+
+from .models.t3.modules.cond_enc import T3Cond
+from .reference import ConditionalsCache
+
+
+class VoiceLibrary:
+    """
+    On-disk library of enrolled voices (the `Conditionals` of the TTS wrappers), for thousands of voices.
+
+    Layout of the `root` directory:
+    - shard-XXXXX.safetensors: one per `add` call. Every conditioning tensor name (eg "t3.speaker_emb",
+      "gen.prompt_feat") has one flat pool there, with the tensors of all the voices of the shard back to back
+      (floats as float32, integers as int64).
+    - index.json: per voice, its shard and, per tensor, its offset and shape in the pool; the non-tensor values
+      (eg a float `emotion_adv`, a None `prompt_feat_len`) are stored as is.
+
+    Shards are memory-mapped (`safe_open`) on first use and a voice only reads its own slices of the pools, so a
+    cold lookup costs a few small reads and the resident memory follows the voices in use. At most
+    `max_open_shards` shards stay mapped; the least recently used one is unmapped first. Looked-up voices are
+    kept on `device` in an LRU of `max_resident` entries (`resident.stats()` for the hit/miss counters).
+
+        library = VoiceLibrary("voices/", device="cuda")
+        library.add({"alice": tts.conds})
+        tts.conds = library.get("alice")
+    """
+    INDEX = "index.json"
+
+    def __init__(self, root, device="cpu", max_resident: int = 256, max_open_shards: int = 16, conds_cls=None):
+        if conds_cls is None:
+            from .tts import Conditionals as conds_cls
+        self.root = Path(root)
+        self.device = device
+        self.conds_cls = conds_cls
+        self.resident = ConditionalsCache(max_resident)
+        self.max_open_shards = max_open_shards
+        self._shards = OrderedDict()  # open safe_open handles, per shard, least recently used first
+        index_path = self.root / self.INDEX
+        if index_path.exists():
+            self.index = json.loads(index_path.read_text())
+        else:
+            self.index = dict(version=1, shards=[], voices={})
+
+    def __len__(self):
+        return len(self.index["voices"])
+
+    def __contains__(self, voice_id: str):
+        return voice_id in self.index["voices"]
+
+    def voice_ids(self) -> Iterable[str]:
+        return self.index["voices"].keys()
+
+    def add(self, voices: Dict[str, "Conditionals"]):
+        """Writes `voices` (voice id -> Conditionals) to a new shard; a voice id that exists is replaced."""
+        if not voices:
+            return
+        self.root.mkdir(parents=True, exist_ok=True)
+        shard_id = len(self.index["shards"])
+        shard_name = f"shard-{shard_id:05d}.safetensors"
+        pools, pool_sizes, entries = {}, {}, {}
+        for voice_id, conds in voices.items():
+            tensors, values = {}, {}
+            items = [("t3." + k, v) for k, v in conds.t3.saved_dict().items()]
+            items += [("gen." + k, v) for k, v in conds.gen.items() if k != "prompt_cache"]
+            for name, value in items:
+                if not torch.is_tensor(value):
+                    values[name] = value
+                    continue
+                value = value.detach().cpu()
+                value = value.float() if value.is_floating_point() else value.long()
+                offset = pool_sizes.get(name, 0)
+                pools.setdefault(name, []).append(value.reshape(-1))
+                pool_sizes[name] = offset + value.numel()
+                tensors[name] = [offset, list(value.shape)]
+            entries[voice_id] = dict(shard=shard_id, tensors=tensors, values=values)
+
+        save_file({name: torch.cat(parts) for name, parts in pools.items()}, str(self.root / shard_name))
+        self.index["shards"].append(shard_name)
+        self.index["voices"].update(entries)
+        # replace the index atomically, so that a reader never sees a partial one
+        tmp_path = self.root / (self.INDEX + ".tmp")
+        tmp_path.write_text(json.dumps(self.index))
+        os.replace(tmp_path, self.root / self.INDEX)
+        for voice_id in entries:
+            self.resident.entries.pop(voice_id, None)
+
+    def _shard(self, shard_id: int):
+        if shard_id in self._shards:
+            self._shards.move_to_end(shard_id)
+            return self._shards[shard_id]
+        path = self.root / self.index["shards"][shard_id]
+        shard = safe_open(str(path), framework="pt", device="cpu")
+        if self.max_open_shards > 0:
+            self._shards[shard_id] = shard
+            # the mapping is released with the last reference to the handle
+            while len(self._shards) > self.max_open_shards:
+                self._shards.popitem(last=False)
+        return shard
+
+    def _load(self, voice_id: str):
+        entry = self.index["voices"][voice_id]
+        shard = self._shard(entry["shard"])
+        t3, gen = {}, {}
+        for name, (offset, shape) in entry["tensors"].items():
+            numel = 1
+            for size in shape:
+                numel *= size
+            tensor = shard.get_slice(name)[offset:offset + numel].reshape(shape).to(self.device)
+            group, key = name.split(".", 1)
+            (t3 if group == "t3" else gen)[key] = tensor
+        for name, value in entry["values"].items():
+            group, key = name.split(".", 1)
+            (t3 if group == "t3" else gen)[key] = value
+        return self.conds_cls(T3Cond(**t3), gen)
+
+    def get(self, voice_id: str):
+        """The Conditionals of `voice_id` on `device`, read from disk unless resident."""
+        conds = self.resident.get(voice_id)
+        if conds is None:
+            if voice_id not in self.index["voices"]:
+                raise KeyError(f"unknown voice {voice_id!r}")
+            conds = self._load(voice_id)
+            self.resident.put(voice_id, conds)
+        return conds
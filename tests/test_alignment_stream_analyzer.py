@@ -0,0 +1,200 @@
+import pytest
+import torch
+
+from chatterbox.models.t3.inference.alignment_stream_analyzer import AlignmentStreamAnalyzer, LLAMA_ALIGNED_HEADS
+
+
+EOS_IDX = 7
+VOCAB_SIZE = 16
+LEN_COND = 6
+KINDS = ("clean", "false_start", "long_tail", "repetition", "token_repetition", "discontinuity")
+
+
+class LegacyAlignmentStreamAnalyzer:
+    """
+    The original `step` heuristics, which kept the full alignment matrix and re-scanned it every step, verbatim
+    apart from the hooks (attentions are set by the caller) and the `S > 5` guard of the alignment repetition
+    check: the original raised on the empty `A[:, :-5]` there, see `test_short_text_skips_alignment_repetition`.
+    """
+
+    def __init__(self, text_tokens_slice, eos_idx=0):
+        self.text_tokens_slice = (i, j) = text_tokens_slice
+        self.eos_idx = eos_idx
+        self.alignment = torch.zeros(0, j-i)
+        self.curr_frame_pos = 0
+        self.text_position = 0
+        self.started = False
+        self.started_at = None
+        self.complete = False
+        self.completed_at = None
+        self.generated_tokens = []
+        self.last_aligned_attns = [None] * len(LLAMA_ALIGNED_HEADS)
+
+    def step(self, logits, next_token=None):
+        aligned_attn = torch.stack(self.last_aligned_attns).mean(dim=0) # (N, N)
+        i, j = self.text_tokens_slice
+        if self.curr_frame_pos == 0:
+            A_chunk = aligned_attn[j:, i:j].clone().cpu() # (T, S)
+        else:
+            A_chunk = aligned_attn[:, i:j].clone().cpu() # (1, S)
+        A_chunk[:, self.curr_frame_pos + 1:] = 0
+        self.alignment = torch.cat((self.alignment, A_chunk), dim=0)
+
+        A = self.alignment
+        T, S = A.shape
+
+        cur_text_posn = A_chunk[-1].argmax()
+        discontinuity = not(-4 < cur_text_posn - self.text_position < 7) # NOTE: very lenient!
+        if not discontinuity:
+            self.text_position = cur_text_posn
+
+        false_start = (not self.started) and (A[-2:, -2:].max() > 0.1 or A[:, :4].max() < 0.5)
+        self.started = not false_start
+        if self.started and self.started_at is None:
+            self.started_at = T
+
+        self.complete = self.complete or self.text_position >= S - 3
+        if self.complete and self.completed_at is None:
+            self.completed_at = T
+
+        long_tail = self.complete and (A[self.completed_at:, -3:].sum(dim=0).max() >= 5) # 200ms
+        alignment_repetition = self.complete and S > 5 and (A[self.completed_at:, :-5].max(dim=1).values.sum() > 5)
+
+        if next_token is not None:
+            if isinstance(next_token, torch.Tensor):
+                token_id = next_token.item() if next_token.numel() == 1 else next_token.view(-1)[0].item()
+            else:
+                token_id = next_token
+            self.generated_tokens.append(token_id)
+            if len(self.generated_tokens) > 8:
+                self.generated_tokens = self.generated_tokens[-8:]
+
+        token_repetition = (
+            len(self.generated_tokens) >= 3 and
+            len(set(self.generated_tokens[-2:])) == 1
+        )
+
+        if cur_text_posn < S - 3 and S > 5:
+            logits[..., self.eos_idx] = -2**15
+
+        if long_tail or alignment_repetition or token_repetition:
+            logits = -(2**15) * torch.ones_like(logits)
+            logits[..., self.eos_idx] = 2**15
+
+        self.curr_frame_pos += 1
+        return logits
+
+
+def synthetic_trace(seed, kind, S):
+    """
+    Attention maps of the aligned heads, as the hooks would capture them, for a made-up utterance of `S` text
+    tokens. Returns the text token slice and a list of (attentions, next_token) steps.
+    """
+    g = torch.Generator().manual_seed(seed)
+    i, j = LEN_COND, LEN_COND + S
+    T0 = j + 2  # conditioning, text, and the two start-of-speech embeddings
+    n_frames = 4 * S + 12
+
+    def position(k):
+        pos = min(S - 1, int(k / 2.5))
+        if kind == "false_start" and k < 6:
+            return S - 1
+        if kind == "repetition" and k > 2.5 * S + 4:
+            return int(torch.randint(0, max(S - 5, 1), (1,), generator=g))
+        if kind == "discontinuity" and k % 7 == 6:
+            return int(torch.randint(0, S, (1,), generator=g))
+        if kind == "long_tail":
+            return pos
+        return pos if k < 2.5 * S + 4 else max(S - 5, 0)
+
+    def frame(k, width):
+        row = 0.04 * torch.rand(width, generator=g)
+        row[i + position(k)] += 0.4 + 0.6 * float(torch.rand(1, generator=g))
+        if kind == "false_start" and k < 6:
+            row[i:i + 4] = 0.0
+        return row
+
+    steps, token = [], 6561
+    for k in range(n_frames):
+        heads = []
+        for _ in LLAMA_ALIGNED_HEADS:
+            if k == 0:
+                attn = 0.04 * torch.rand(T0, T0, generator=g)
+                attn[j] = frame(0, T0)
+                attn[j + 1] = frame(0, T0)
+            else:
+                attn = frame(k, T0 + k)[None]
+            heads.append(attn)
+        steps.append((heads, token))
+        token = int(torch.randint(0, 6561, (1,), generator=g))
+        if kind == "token_repetition" and k > S:
+            token = 42
+    return (i, j), steps
+
+
+def replay(text_tokens_slice, steps):
+    """Yields the (legacy, incremental) logits and analyzers of every step."""
+    legacy = LegacyAlignmentStreamAnalyzer(text_tokens_slice, eos_idx=EOS_IDX)
+    incremental = AlignmentStreamAnalyzer(None, None, text_tokens_slice, eos_idx=EOS_IDX)
+    g = torch.Generator().manual_seed(0)
+    for attns, token in steps:
+        logits = torch.randn(1, VOCAB_SIZE, generator=g)
+        legacy.last_aligned_attns = list(attns)
+        incremental.last_aligned_attns = list(attns)
+        expected = legacy.step(logits.clone(), next_token=token)
+        actual = incremental.step(logits.clone(), next_token=token)
+        yield expected, actual, legacy, incremental
+
+
+@pytest.mark.parametrize("S", [3, 5, 6, 12, 30])
+@pytest.mark.parametrize("kind", KINDS)
+@pytest.mark.parametrize("seed", [0, 1])
+def test_matches_legacy_analyzer(seed, kind, S):
+    """The incremental statistics give the same logits and state as re-scanning the full alignment matrix."""
+    for k, (expected, actual, legacy, incremental) in enumerate(replay(*synthetic_trace(seed, kind, S))):
+        result = incremental.result()
+        assert torch.equal(expected, actual), f"logits differ at step {k}"
+        assert result.position == int(legacy.text_position), f"position differs at step {k}"
+        assert result.complete == bool(legacy.complete), f"completion differs at step {k}"
+
+
+def one_hot_trace(S, positions):
+    """
+    Aligned heads that attend to exactly one text token per frame, at `positions` (at most the frame index, see
+    the analyzer's monotonic masking), with distinct tokens.
+    """
+    i, j = LEN_COND, LEN_COND + S
+    T0 = j + 2
+    steps = []
+    for k, position in enumerate(positions):
+        attn = torch.zeros(T0 if k == 0 else 1, T0 + k)
+        attn[-1, i + position] = 1.0
+        if k == 0:
+            attn[-2, i + position] = 1.0
+        steps.append(([attn] * len(LLAMA_ALIGNED_HEADS), 6561 + k))
+    return (i, j), steps
+
+
+@pytest.mark.parametrize("S", [3, 4, 5])
+def test_short_text_skips_alignment_repetition(S):
+    """
+    With 5 text tokens or fewer there are no earlier tokens to repeat: going back to the first text token after
+    completion is never an alignment repetition, and EOS is never suppressed.
+    """
+    # read the text through to completion, then attend to the first token for the rest of the utterance
+    trace = one_hot_trace(S, list(range(S)) + [0] * 20)
+    for k, (expected, actual, legacy, incremental) in enumerate(replay(*trace)):
+        assert torch.equal(expected, actual), f"logits differ at step {k}"
+        assert not bool(incremental.alignment_repetition)
+        assert not (actual[..., EOS_IDX] == -2**15).any()
+    assert incremental.result().complete
+
+
+def test_alignment_repetition_forces_eos():
+    """The same trace with more than 5 text tokens is a repetition, which forces EOS."""
+    S = 12
+    trace = one_hot_trace(S, list(range(S)) + [0] * 20)
+    for _, actual, _, incremental in replay(*trace):
+        pass
+    assert incremental.result().repetition
+    assert actual.argmax(dim=-1).item() == EOS_IDX
@@ -0,0 +1,62 @@
+import torch
+
+from chatterbox.models.t3.modules.cond_enc import T3Cond, T3CondEnc
+from chatterbox.models.t3.modules.t3_config import T3Config
+
+
+def make_cond_enc():
+    hp = T3Config.english_only()
+    hp.use_perceiver_resampler = False
+    torch.manual_seed(0)
+    return T3CondEnc(hp).eval()
+
+
+def make_cond(cond_enc):
+    hp = cond_enc.hp
+    return T3Cond(
+        speaker_emb=torch.randn(1, hp.speaker_embed_size),
+        cond_prompt_speech_tokens=torch.randint(0, 6561, (1, 4)),
+        cond_prompt_speech_emb=torch.randn(1, 4, hp.n_channels),
+        emotion_adv=0.5 * torch.ones(1, 1, 1),
+    )
+
+
+@torch.no_grad()
+def test_voice_embeds_shared_across_exaggerations():
+    cond_enc = make_cond_enc()
+    cond = make_cond(cond_enc)
+    cond_enc(cond)
+    memo = cond.voice_cond_emb
+
+    other = cond.with_emotion_adv(1.5 * torch.ones(1, 1, 1))
+    embeds = cond_enc(other)
+    assert other.voice_cond_emb is memo
+    torch.testing.assert_close(embeds[:, :-1], cond_enc.voice_embeds(other))
+
+
+@torch.no_grad()
+def test_voice_embeds_recomputed_after_changes():
+    cond_enc = make_cond_enc()
+    cond = make_cond(cond_enc)
+    cond_enc(cond)
+
+    # new weights, loaded in place
+    state_dict = {k: torch.randn_like(v) for k, v in cond_enc.state_dict().items()}
+    cond_enc.load_state_dict(state_dict)
+    torch.testing.assert_close(cond_enc(cond)[:, :-1], cond_enc.voice_embeds(cond))
+
+    # another model
+    other_enc = make_cond_enc()
+    torch.testing.assert_close(other_enc(cond)[:, :-1], other_enc.voice_embeds(cond))
+
+    # a reassigned voice field
+    cond.speaker_emb = torch.randn_like(cond.speaker_emb)
+    torch.testing.assert_close(other_enc(cond)[:, :-1], other_enc.voice_embeds(cond))
+
+    # a dtype cast of the conditionals and of the model
+    cond.to(dtype=torch.float64)
+    assert cond.voice_cond_emb is None
+    other_enc.to(dtype=torch.float64)
+    embeds = other_enc(cond)
+    assert embeds.dtype == torch.float64
+    torch.testing.assert_close(embeds[:, :-1], other_enc.voice_embeds(cond))
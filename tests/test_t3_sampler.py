@@ -0,0 +1,49 @@
+import torch
+from transformers.generation.logits_process import (
+    LogitsProcessorList,
+    RepetitionPenaltyLogitsProcessor,
+    TemperatureLogitsWarper,
+    TopKLogitsWarper,
+    TopPLogitsWarper,
+)
+
+from chatterbox.models.t3.inference.sampler import T3Sampler
+
+
+def test_penalty_last_matches_turbo_processor_list():
+    """`penalty_last` samples from the distribution of the HF processor list Turbo used before the fused sampler."""
+    torch.manual_seed(0)
+    vocab_size, temperature, top_k, top_p, repetition_penalty = 6563, 0.8, 1000, 0.95, 1.2
+    logits = 3 * torch.randn(1, vocab_size)
+    # previous tokens, some of them among the most likely ones so that the penalty reweights kept tokens
+    generated = torch.cat([logits.topk(5).indices, torch.randint(0, vocab_size, (1, 20))], dim=1)
+
+    processors = LogitsProcessorList([
+        TemperatureLogitsWarper(temperature),
+        TopKLogitsWarper(top_k),
+        TopPLogitsWarper(top_p),
+        RepetitionPenaltyLogitsProcessor(repetition_penalty),
+    ])
+    reference = processors(generated, logits.clone()).softmax(dim=-1)
+
+    sampler = T3Sampler(
+        1,
+        vocab_size,
+        temperature=temperature,
+        top_k=top_k,
+        top_p=top_p,
+        repetition_penalty=repetition_penalty,
+        penalty_last=True,
+    )
+    sampler.update(generated)
+    probs = sampler.probs(logits)
+
+    torch.testing.assert_close(probs, reference)
+
+
+def test_update_forgets_tokens():
+    sampler = T3Sampler(1, 10, repetition_penalty=2.0)
+    start_token = torch.tensor([[3]])
+    sampler.update(start_token)
+    sampler.update(start_token, count=-1)
+    assert not sampler.counts.any()
@@ -0,0 +1,45 @@
+import pytest
+import torch
+
+from chatterbox.models.t3.llama_configs import GPT2_MEDIUM_CONFIG, LLAMA_CONFIGS
+from chatterbox.models.t3.modules.cond_enc import T3Cond
+from chatterbox.models.t3.modules.t3_config import T3Config
+from chatterbox.models.t3.t3 import T3
+
+
+@pytest.fixture
+def turbo_t3(monkeypatch):
+    """A Turbo-shaped T3 (GPT2 backbone, no Perceiver or emotion) with a small random backbone."""
+    config = dict(GPT2_MEDIUM_CONFIG, n_embd=64, hidden_size=64, n_head=4, n_layer=2)
+    monkeypatch.setitem(LLAMA_CONFIGS, "GPT2_test", config)
+    hp = T3Config(text_tokens_dict_size=50276)
+    hp.llama_config_name = "GPT2_test"
+    hp.speech_tokens_dict_size = 6563
+    hp.input_pos_emb = None
+    hp.speech_cond_prompt_len = 375
+    hp.use_perceiver_resampler = False
+    hp.emotion_adv = False
+    torch.manual_seed(0)
+    return T3(hp).eval()
+
+
+def random_inputs(t3, n_text_tokens=20):
+    hp = t3.hp
+    t3_cond = T3Cond(
+        speaker_emb=torch.randn(1, hp.speaker_embed_size),
+        cond_prompt_speech_tokens=torch.randint(0, 6561, (1, hp.speech_cond_prompt_len)),
+    )
+    text_tokens = torch.randint(1, 50000, (1, n_text_tokens))
+    return t3_cond, text_tokens
+
+
+@pytest.mark.parametrize("cache_implementation", ["dynamic", "static"])
+def test_inference_turbo_prefix_cache(turbo_t3, cache_implementation):
+    t3_cond, text_tokens = random_inputs(turbo_t3)
+    kwargs = dict(top_k=1, max_gen_len=8, cache_implementation=cache_implementation)
+
+    reference = turbo_t3.inference_turbo(t3_cond, text_tokens, **kwargs)
+    prefix_cache = turbo_t3.prefill_conditioning(t3_cond)
+    tokens = turbo_t3.inference_turbo(t3_cond, text_tokens, prefix_cache=prefix_cache, **kwargs)
+
+    assert torch.equal(tokens, reference)